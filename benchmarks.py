@@ -0,0 +1,318 @@
+"""
+性能基准与结果一致性检查
+
+用法：
+    python benchmarks.py            # 运行全部基准
+    python benchmarks.py indicators # 只运行指定基准
+
+只依赖 numpy 和 pandas，使用随机生成的K线数据，不访问网络。
+pool 基准会在临时目录中建立本地日线仓库，结束后删除。
+"""
+import functools
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from numpy.lib.stride_tricks import sliding_window_view
+
+from charts import compose_kline_figure, period_ticks, volume_colors
+from compute_pool import ComputePool, compute_indicators_parallel, load_stacked_klines
+from indicators import INDICATOR_COLUMNS, compute_indicators, compute_universe_indicators, rolling_extrema, stack_frames
+from kline_store import ADJUST_QFQ, compact_klines, normalize_klines, save_klines, stored_codes
+from screening import TECHNICAL_BAR_COLUMNS, TECHNICAL_HISTORY_LENGTH, build_technical_snapshot_from_arrays
+
+
+def make_random_klines(n_stocks, n_days, seed=0):
+    """
+    生成随机游走的K线数据 {代码: DataFrame}
+    """
+    rng = np.random.default_rng(seed)
+    frames = {}
+    for i in range(n_stocks):
+        close = 10 + np.cumsum(rng.normal(0, 0.2, n_days))
+        frames[f"{i:06d}"] = pd.DataFrame({
+            "收盘": close,
+            "开盘": close + rng.normal(0, 0.05, n_days),
+            "最高": close + rng.uniform(0, 0.3, n_days),
+            "最低": close - rng.uniform(0, 0.3, n_days),
+            "成交量": rng.integers(1000, 100000, n_days).astype(float),
+        })
+    return frames
+
+
+def timed(func, *args, repeat=1):
+    """
+    返回 (结果, 平均耗时秒数)
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(*args)
+    return result, (time.perf_counter() - start) / repeat
+
+
+def pandas_indicators(df):
+    """
+    原 calculate_indicators 的 pandas 实现，作为一致性检查和性能比较的基准
+    """
+    df = df.copy()
+    df['MA5'] = df['收盘'].rolling(5).mean()
+    df['MA10'] = df['收盘'].rolling(10).mean()
+    df['MA20'] = df['收盘'].rolling(20).mean()
+
+    df['EMA12'] = df['收盘'].ewm(span=12, adjust=False).mean()
+    df['EMA26'] = df['收盘'].ewm(span=26, adjust=False).mean()
+    df['DIF'] = df['EMA12'] - df['EMA26']
+    df['DEA'] = df['DIF'].ewm(span=9, adjust=False).mean()
+    df['MACD'] = 2 * (df['DIF'] - df['DEA'])
+
+    low_9 = df['最低'].rolling(window=9).min()
+    high_9 = df['最高'].rolling(window=9).max()
+    df['RSV'] = (df['收盘'] - low_9) / (high_9 - low_9) * 100
+    df['K'] = df['RSV'].ewm(alpha=1/3, adjust=False).mean()
+    df['D'] = df['K'].ewm(alpha=1/3, adjust=False).mean()
+    df['J'] = 3 * df['K'] - 2 * df['D']
+
+    delta = df['收盘'].diff()
+    up = delta.clip(lower=0)
+    down = -1 * delta.clip(upper=0)
+    ema_up = up.ewm(com=13, adjust=False).mean()
+    ema_down = down.ewm(com=13, adjust=False).mean()
+    rs = ema_up / ema_down
+    df['RSI'] = 100 - (100 / (1 + rs))
+
+    period = 21
+    highest_high = df['最高'].rolling(window=period).max()
+    lowest_low = df['最低'].rolling(window=period).min()
+    df['WR21'] = abs(-100 * ((highest_high - df['收盘']) / (highest_high - lowest_low)))
+    return df
+
+
+def bench_indicators(n_stocks=5000, n_days=365, sample=200):
+    """
+    批量指标引擎 vs 逐只股票的pandas计算
+    """
+    frames = make_random_klines(n_stocks, n_days)
+    (codes, result, lengths), batch_time = timed(compute_universe_indicators, frames)
+
+    sample_codes = codes[:sample]
+    start = time.perf_counter()
+    mismatched = 0
+    for row, code in enumerate(sample_codes):
+        expected = pandas_indicators(frames[code])
+        n = lengths[row]
+        for name in INDICATOR_COLUMNS:
+            if not np.array_equal(result[name][row, -n:], expected[name].to_numpy(), equal_nan=True):
+                mismatched += 1
+    pandas_time = (time.perf_counter() - start) / len(sample_codes) * n_stocks
+
+    print(f"[indicators] {n_stocks} 只股票 × {n_days} 日")
+    print(f"  批量引擎: {batch_time:.2f}s")
+    print(f"  pandas逐只(按{sample}只推算): {pandas_time:.2f}s")
+    print(f"  不一致的指标序列: {mismatched}")
+
+
+def bench_rolling(n_stocks=5000, n_days=365, windows=(5, 9, 21, 60, 120, 250), sample=200):
+    """
+    多窗口滚动极值：rolling_extrema vs 滑动窗口直接求极值 vs pandas Series.rolling
+    """
+    frames = make_random_klines(n_stocks, n_days)
+    _, arrays, _ = stack_frames(frames, ("最高",), n_days)
+    high = arrays["最高"]
+    # 随机挖掉一部分数据，检查NaN的处理
+    rng = np.random.default_rng(1)
+    high[rng.random(high.shape) < 0.01] = np.nan
+
+    result, extrema_time = timed(rolling_extrema, high, windows, "max")
+
+    def sliding(values):
+        out = {}
+        for window in windows:
+            out[window] = np.full(values.shape, np.nan)
+            out[window][:, window - 1:] = sliding_window_view(values, window, axis=1).max(axis=-1)
+        return out
+
+    _, sliding_time = timed(sliding, high)
+
+    start = time.perf_counter()
+    mismatched = 0
+    for row in range(sample):
+        series = pd.Series(high[row])
+        for window in windows:
+            expected = series.rolling(window).max().to_numpy()
+            if not np.array_equal(result[window][row], expected, equal_nan=True):
+                mismatched += 1
+    pandas_time = (time.perf_counter() - start) / sample * n_stocks
+
+    print(f"[rolling] {n_stocks} 只股票 × {n_days} 日，窗口 {list(windows)}")
+    print(f"  rolling_extrema: {extrema_time:.2f}s")
+    print(f"  滑动窗口逐窗口求极值: {sliding_time:.2f}s")
+    print(f"  pandas Series.rolling逐只(按{sample}只推算): {pandas_time:.2f}s")
+    print(f"  不一致的序列: {mismatched}")
+
+
+def make_source_klines(n_stocks, n_days, seed=0):
+    """
+    生成与数据源返回格式相同的K线：日期为文字，数值为float64，每行带股票代码和名称
+    """
+    dates = pd.bdate_range("2023-01-02", periods=n_days).strftime("%Y-%m-%d")
+    frames = {}
+    for code, df in make_random_klines(n_stocks, n_days, seed).items():
+        df = df.round(2)
+        df.insert(0, "日期", dates)
+        df.insert(0, "股票代码", code)
+        df.insert(0, "股票名称", f"股票{code}")
+        df["成交额"] = df["成交量"] * df["收盘"] * 100
+        df["振幅"] = ((df["最高"] - df["最低"]) / df["收盘"] * 100).round(2)
+        df["涨跌额"] = df["收盘"].diff().round(2)
+        df["涨跌幅"] = df["收盘"].pct_change().round(4)
+        df["换手率"] = 1.5
+        frames[code] = df
+    return frames
+
+
+def bench_memory(n_stocks=500, n_days=365):
+    """
+    K线在内存中的占用：数据源原始格式 vs 紧凑格式
+    """
+    frames = make_source_klines(n_stocks, n_days)
+    compact, compact_time = timed(lambda: {code: compact_klines(df) for code, df in frames.items()})
+
+    def deep_size(items):
+        return sum(df.memory_usage(deep=True).sum() for df in items.values()) / 1024 ** 2
+
+    def pickled_size(items):
+        return sum(len(pickle.dumps(df)) for df in items.values()) / 1024 ** 2
+
+    before, after = deep_size(frames), deep_size(compact)
+    print(f"[memory] {n_stocks} 只股票 × {n_days} 日")
+    print(f"  原始格式: {before:.1f} MB（序列化 {pickled_size(frames):.1f} MB）")
+    print(f"  紧凑格式: {after:.1f} MB（序列化 {pickled_size(compact):.1f} MB），减少 {1 - after / before:.0%}")
+    print(f"  转换耗时: {compact_time:.2f}s")
+
+
+def bench_pool(n_stocks=2000, n_days=300):
+    """
+    生成技术面截面（读取本地日线 + 计算指标）放在后台线程 vs 计算进程池时，页面线程的响应
+    """
+    frames = make_source_klines(n_stocks, n_days)
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as store_dir:
+        # 子进程继承工作目录，在临时目录中建立本地日线仓库
+        os.chdir(store_dir)
+        try:
+            for code, df in frames.items():
+                save_klines(code, normalize_klines(df))
+            codes = stored_codes()
+
+            def build(pool):
+                arrays, lengths, last_dates, previous_dates = load_stacked_klines(
+                    codes, TECHNICAL_BAR_COLUMNS, TECHNICAL_HISTORY_LENGTH, ADJUST_QFQ, pool
+                )
+                compute = functools.partial(compute_indicators_parallel, pool=pool)
+                return build_technical_snapshot_from_arrays(
+                    codes, arrays, lengths, last_dates, previous_dates, None, compute=compute
+                )
+
+            inline = ComputePool()
+            inline.disabled = True
+            pool = ComputePool()
+            # 先启动子进程，不把进程启动时间计入
+            build(pool)
+
+            def page_while(pool):
+                # 模拟页面线程：反复执行小的pandas操作，记录每次的耗时
+                frame = pd.DataFrame({"x": np.arange(1000.0)})
+                result = {}
+                worker = threading.Thread(target=lambda: result.update(value=build(pool)))
+                worker.start()
+                ticks = []
+                while worker.is_alive():
+                    start = time.perf_counter()
+                    frame["x"].rolling(5).mean()
+                    ticks.append(time.perf_counter() - start)
+                    time.sleep(0.001)
+                worker.join()
+                return result["value"], np.array(ticks) * 1000
+
+            (expected, inline_ticks), inline_time = timed(page_while, inline)
+            (result, pool_ticks), pool_time = timed(page_while, pool)
+            pool.shutdown()
+        finally:
+            os.chdir(previous_dir)
+
+    same = expected.current.equals(result.current) and expected.previous.equals(result.previous)
+    print(f"[pool] {n_stocks} 只股票的技术面截面，{pool.max_workers} 个子进程")
+    for label, ticks, seconds in (("后台线程", inline_ticks, inline_time), ("计算进程池", pool_ticks, pool_time)):
+        print(f"  {label}: {seconds:.2f}s，页面线程完成 {len(ticks) / seconds:.0f} 次/秒，"
+              f"延迟 p50 {np.median(ticks):.2f}ms / p99 {np.percentile(ticks, 99):.2f}ms")
+    print(f"  结果一致: {same}")
+
+
+def iterrows_monthly_ticks(df):
+    """
+    原 get_monthly_ticks 的逐行实现，作为一致性检查和性能比较的基准
+    """
+    if '月份' not in df.columns:
+        df = df.copy()
+
+    df['月份'] = pd.to_datetime(df['日期']).dt.strftime('%Y-%m')
+    monthly_ticks = []
+    monthly_labels = []
+    prev_month = None
+
+    for i, row in df.iterrows():
+        current_month = row['月份']
+        if current_month != prev_month:
+            monthly_ticks.append(row['日期'])
+            monthly_labels.append(current_month)
+            prev_month = current_month
+
+    return monthly_ticks, monthly_labels
+
+
+def iterrows_volume_colors(df):
+    """
+    原 plot_volume 中逐行计算颜色的实现
+    """
+    return ['red' if row['收盘'] - row['开盘'] >= 0 else 'green' for _, row in df.iterrows()]
+
+
+def bench_chart(lengths=(250, 2500, 25000)):
+    """
+    图表准备：向量化的刻度和成交量颜色 vs 原逐行实现，以及整张K线图的构建耗时
+    """
+    print("[chart] 刻度 / 成交量颜色 / 整张图表")
+    for n_days in lengths:
+        df = make_source_klines(1, n_days)["000000"]
+        values = compute_indicators(*(df[[col]].to_numpy().T for col in ("收盘", "最高", "最低")))
+        df = df.assign(**{name: value[0] for name, value in values.items()})
+        ticks, vector_ticks_time = timed(period_ticks, df["日期"], "M", repeat=5)
+        expected_ticks, loop_ticks_time = timed(iterrows_monthly_ticks, df)
+        colors, vector_colors_time = timed(volume_colors, df, repeat=5)
+        expected_colors, loop_colors_time = timed(iterrows_volume_colors, df)
+        _, figure_time = timed(compose_kline_figure, df)
+        same = ticks == expected_ticks and colors.tolist() == expected_colors
+        print(f"  {n_days} 根K线: 刻度 {loop_ticks_time * 1000:.1f}ms -> {vector_ticks_time * 1000:.2f}ms，"
+              f"颜色 {loop_colors_time * 1000:.1f}ms -> {vector_colors_time * 1000:.2f}ms，"
+              f"整张图表 {figure_time * 1000:.0f}ms，结果一致: {same}")
+
+
+BENCHMARKS = {
+    "indicators": bench_indicators,
+    "rolling": bench_rolling,
+    "memory": bench_memory,
+    "pool": bench_pool,
+    "chart": bench_chart,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
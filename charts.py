@@ -0,0 +1,333 @@
+"""
+个股分析页的K线图表
+
+K线、成交量和各技术指标画在同一张多行子图中：所有面板共用一条按交易日排列的类别x轴，
+日期类别和月份刻度只计算、只传给浏览器一次，拖动和缩放时各面板保持同步。
+K线根数超过图表宽度能分辨的数量时，先按像素宽度降采样再绘图（见 downsample_klines）。
+只依赖 numpy、pandas 和 plotly，不依赖Streamlit。
+"""
+import json
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+
+# 可选的副图面板：名称 -> 高度（像素）
+INDICATOR_PANELS = {
+    "成交量": 150,
+    "MACD": 170,
+    "KDJ": 170,
+    "RSI": 170,
+    "WR": 170,
+}
+
+# 主图（K线）的高度（像素）
+MAIN_PANEL_HEIGHT = 450
+
+# 额外的非价格类指标（ATR、OBV等）各占一个面板的高度（像素）
+EXTRA_PANEL_HEIGHT = 150
+
+# K线主图上固定显示的均线及颜色
+MA_COLORS = {"MA5": "blue", "MA10": "orange", "MA20": "purple"}
+
+# 各副图面板绘制的指标列
+PANEL_COLUMNS = {
+    "成交量": (),
+    "MACD": ("DIF", "DEA", "MACD"),
+    "KDJ": ("K", "D", "J"),
+    "RSI": ("RSI",),
+    "WR": ("WR21",),
+}
+
+# 以柱状图绘制的指标列，降采样时取每个桶中绝对值最大的值
+BAR_INDICATOR_COLUMNS = ("MACD",)
+
+# 图表配色：背景色和网格线颜色，与页面的亮色/暗色主题对应
+CHART_THEMES = {
+    "light": {"plot_bgcolor": "white", "gridcolor": "lightgrey"},
+    "dark": {"plot_bgcolor": "#0e1117", "gridcolor": "#3a3f4b"},
+}
+
+# 图表最多绘制的K线根数：常见屏幕上图表约1200像素宽，每根K线至少占2个像素
+CHART_MAX_POINTS = 600
+
+
+def _period_codes(days, period):
+    # 每个日期所在周期的编号：W 周（周一开始）/ M 月 / Q 季
+    if period == "W":
+        # 1970-01-01 是周四，加3天后整除7即按周一分周
+        return (days.astype(np.int64) + 3) // 7
+    months = days.astype("datetime64[M]").astype(np.int64)
+    return months // 3 if period == "Q" else months
+
+
+def _period_label(day, period):
+    year, month = day.year, day.month
+    if period == "Q":
+        return f"{year}Q{(month - 1) // 3 + 1}"
+    if period == "W":
+        return day.strftime("%m-%d")
+    return f"{year}-{month:02d}"
+
+
+def period_ticks(dates, period="M"):
+    """
+    取每个周期（W 周 / M 月 / Q 季）的第一个交易日作为刻度，返回 (刻度值列表, 标签列表)
+
+    dates: 按时间排序的日期（文字或datetime64），刻度值与 dates 中的值相同；不修改输入
+    """
+    values = np.asarray(dates)
+    if len(values) == 0:
+        return [], []
+    days = values.astype("datetime64[D]")
+    codes = _period_codes(days, period)
+    starts = np.flatnonzero(np.diff(codes, prepend=codes[0] - 1))
+    labels = [_period_label(day, period) for day in days[starts].astype(object)]
+    return values[starts].tolist(), labels
+
+
+def tick_period(dates):
+    """
+    按日期跨度选择刻度的周期，使刻度数量保持在二三十个以内
+    """
+    if len(dates) == 0:
+        return "M"
+    first, last = np.asarray([dates[0], dates[-1]]).astype("datetime64[M]").astype(np.int64)
+    months = last - first
+    if months < 3:
+        return "W"
+    return "M" if months <= 24 else "Q"
+
+
+def volume_colors(df):
+    """
+    成交量柱的颜色：收盘不低于开盘为红色，否则为绿色
+    """
+    rising = df['收盘'].to_numpy(dtype=float) - df['开盘'].to_numpy(dtype=float) >= 0
+    return np.where(rising, 'red', 'green')
+
+
+def bucket_starts(n, max_points):
+    """
+    把 n 根K线按顺序分成不超过 max_points 个等长的桶，返回每个桶的起始行号
+    """
+    size = max(1, -(-n // max_points))
+    return np.arange(0, n, size)
+
+
+def lttb_select(values, starts):
+    """
+    Largest-Triangle-Three-Buckets 降采样：每个桶中选出一个点，使它与前一个选中点、
+    下一个桶的平均点构成的三角形面积最大，保留折线的峰谷形状
+
+    starts: 每个桶的起始行号（见 bucket_starts）；返回每个桶选中的行号
+    NaN 不参与选择，整个桶都是NaN时选桶的第一行（绘图时仍为缺口）
+    """
+    y = np.asarray(values, dtype=float)
+    n = len(y)
+    stops = np.append(starts[1:], n)
+    finite = np.isfinite(y)
+    x = np.arange(n, dtype=float)
+    # 每个桶有效点的平均位置和平均值，作为前一个桶选点时的第三个顶点
+    counts = np.add.reduceat(finite, starts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        avg_x = np.add.reduceat(np.where(finite, x, 0.0), starts) / counts
+        avg_y = np.add.reduceat(np.where(finite, y, 0.0), starts) / counts
+
+    selected = starts.copy()
+    prev = -1
+    last = len(starts) - 1
+    for bucket, (start, stop) in enumerate(zip(starts, stops)):
+        valid = np.flatnonzero(finite[start:stop])
+        if len(valid) == 0:
+            continue
+        if prev < 0 or bucket == 0:
+            # 第一个桶（或此前都是NaN）取第一个有效点
+            pick = valid[0]
+        elif bucket == last:
+            pick = valid[-1]
+        else:
+            px, py = x[prev], y[prev]
+            ax, ay = avg_x[bucket + 1], avg_y[bucket + 1]
+            if not np.isfinite(ay):
+                ax, ay = x[stop - 1], py
+            seg_x, seg_y = x[start:stop][valid], y[start:stop][valid]
+            areas = np.abs((px - ax) * (seg_y - py) - (px - seg_x) * (ay - py))
+            if ax == px or not areas.any():
+                areas = np.abs(seg_y - py)
+            pick = valid[np.argmax(areas)]
+        selected[bucket] = start + pick
+        prev = start + pick
+    return selected
+
+
+def downsample_klines(df, max_points=CHART_MAX_POINTS, line_columns=(), bar_columns=BAR_INDICATOR_COLUMNS):
+    """
+    按图表的像素宽度合并K线，不超过 max_points 根时原样返回
+
+    - K线：每个桶取第一根的开盘、最后一根的收盘、最高价的最大值和最低价的最小值，成交量求和
+    - 指标线（line_columns）：用LTTB每个桶选一个点
+    - 柱状指标（bar_columns）：取每个桶中绝对值最大的值
+    日期取每个桶第一根K线的日期；只返回绘图用到的列
+    """
+    n = len(df)
+    if n <= max_points:
+        return df
+    starts = bucket_starts(n, max_points)
+    stops = np.append(starts[1:], n)
+
+    out = {'日期': df['日期'].to_numpy()[starts]}
+    if {'开盘', '收盘', '最高', '最低'}.issubset(df.columns):
+        out['开盘'] = df['开盘'].to_numpy(dtype=float)[starts]
+        out['收盘'] = df['收盘'].to_numpy(dtype=float)[stops - 1]
+        out['最高'] = np.fmax.reduceat(df['最高'].to_numpy(dtype=float), starts)
+        out['最低'] = np.fmin.reduceat(df['最低'].to_numpy(dtype=float), starts)
+    if '成交量' in df.columns:
+        out['成交量'] = np.add.reduceat(np.nan_to_num(df['成交量'].to_numpy(dtype=float)), starts)
+    for name in bar_columns:
+        if name in df.columns:
+            values = df[name].to_numpy(dtype=float)
+            high = np.fmax.reduceat(values, starts)
+            low = np.fmin.reduceat(values, starts)
+            out[name] = np.where(np.abs(low) > np.abs(high), low, high)
+    for name in line_columns:
+        if name in df.columns and name not in out:
+            values = df[name].to_numpy(dtype=float)
+            out[name] = values[lttb_select(values, starts)]
+    return pd.DataFrame(out)
+
+
+def _add_line(fig, row, df, name, label=None, **line):
+    fig.add_trace(go.Scatter(
+        x=df['日期'], y=df[name], mode='lines', name=label or name,
+        line=dict(width=1, **line), connectgaps=False
+    ), row=row, col=1)
+
+
+def _add_reference_lines(fig, row, values):
+    for value, color in values:
+        fig.add_hline(y=value, line=dict(color=color, width=1, dash="dash"), row=row, col=1)
+
+
+def _draw_main(fig, row, df, overlays):
+    fig.add_trace(go.Candlestick(
+        x=df['日期'], open=df['开盘'], high=df['最高'], low=df['最低'], close=df['收盘'], name='K线'
+    ), row=row, col=1)
+    for name, color in MA_COLORS.items():
+        if name in df.columns:
+            _add_line(fig, row, df, name, color=color)
+    # 叠加额外选择的价格类指标
+    for name in overlays:
+        if name in df.columns:
+            _add_line(fig, row, df, name, dash='dot' if name.startswith('BOLL_') else 'solid')
+    fig.update_yaxes(title_text='价格', row=row, col=1)
+
+
+def _draw_volume(fig, row, df):
+    fig.add_trace(go.Bar(x=df['日期'], y=df['成交量'], marker_color=volume_colors(df), name='成交量'),
+                  row=row, col=1)
+
+
+def _draw_macd(fig, row, df):
+    _add_line(fig, row, df, 'DIF')
+    _add_line(fig, row, df, 'DEA')
+    fig.add_trace(go.Bar(x=df['日期'], y=df['MACD'], name='MACD柱'), row=row, col=1)
+
+
+def _draw_kdj(fig, row, df):
+    for name in ('K', 'D', 'J'):
+        _add_line(fig, row, df, name)
+
+
+def _draw_rsi(fig, row, df):
+    _add_line(fig, row, df, 'RSI')
+    # 超买超卖参考线
+    _add_reference_lines(fig, row, ((70, "red"), (30, "green")))
+
+
+def _draw_wr(fig, row, df):
+    _add_line(fig, row, df, 'WR21', label='WR(21)')
+    # 超买超卖参考线（取绝对值后，原来的-20变成20，-80变成80）
+    _add_reference_lines(fig, row, ((20, "red"), (80, "green")))
+    fig.update_yaxes(range=[0, 100], autorange=False, row=row, col=1)
+
+
+PANEL_DRAWERS = {
+    "成交量": _draw_volume,
+    "MACD": _draw_macd,
+    "KDJ": _draw_kdj,
+    "RSI": _draw_rsi,
+    "WR": _draw_wr,
+}
+
+
+def compose_kline_figure(df, panels=tuple(INDICATOR_PANELS), overlays=(), extra_panels=(),
+                         max_points=CHART_MAX_POINTS, theme="light"):
+    """
+    把K线主图和选择的副图面板组合成一张共用x轴的多行图表
+
+    df: 含 日期（文字）/开盘/收盘/最高/最低/成交量 及指标列的K线
+    panels: 要显示的副图面板，取自 INDICATOR_PANELS，按 INDICATOR_PANELS 的顺序排列
+    overlays: 叠加在K线上的价格类指标列
+    extra_panels: 各自单独一个面板的非价格类指标列
+    max_points: 超过该根数时先降采样（见 downsample_klines），None 表示不降采样
+    theme: CHART_THEMES 中的配色
+    """
+    if df.empty:
+        return go.Figure()
+
+    if max_points:
+        line_columns = [*MA_COLORS, *overlays, *extra_panels]
+        for name in panels:
+            line_columns += PANEL_COLUMNS.get(name, ())
+        df = downsample_klines(df, max_points, line_columns)
+
+    rows = [("K线", MAIN_PANEL_HEIGHT, None)]
+    rows += [(name, height, PANEL_DRAWERS[name]) for name, height in INDICATOR_PANELS.items() if name in panels]
+    rows += [(name, EXTRA_PANEL_HEIGHT, None) for name in extra_panels if name in df.columns]
+    heights = [height for _, height, _ in rows]
+
+    fig = make_subplots(
+        rows=len(rows), cols=1, shared_xaxes=True, vertical_spacing=0.03,
+        row_heights=heights, subplot_titles=[name for name, _, _ in rows]
+    )
+    for row, (name, _, drawer) in enumerate(rows, start=1):
+        if row == 1:
+            _draw_main(fig, row, df, overlays)
+        elif drawer is not None:
+            drawer(fig, row, df)
+        else:
+            _add_line(fig, row, df, name)
+
+    colors = CHART_THEMES.get(theme, CHART_THEMES["light"])
+    # 刻度只计算一次；其他面板的x轴都与最下方的x轴联动，日期类别只需写在最下方的x轴上
+    dates = df['日期'].to_numpy()
+    ticks, labels = period_ticks(dates, tick_period(dates))
+    fig.update_xaxes(
+        type='category',
+        tickmode='array',
+        tickvals=ticks,  # 只在周/月/季变化时显示刻度
+        ticktext=labels,
+        rangeslider_visible=False,
+        gridcolor=colors['gridcolor'],
+        # 鼠标悬停时在所有面板上显示同一日期的竖线
+        showspikes=True, spikemode='across', spikesnap='cursor', spikethickness=1
+    )
+    fig.update_xaxes(categoryorder='array', categoryarray=dates.tolist(), row=len(rows), col=1)
+    fig.update_yaxes(gridcolor=colors['gridcolor'])
+    fig.update_layout(
+        height=sum(heights) + 80,
+        margin=dict(l=10, r=10, t=60, b=10),
+        plot_bgcolor=colors['plot_bgcolor'],
+        hovermode='x',
+        legend=dict(orientation='h', yanchor='bottom', y=1.02, xanchor='left', x=0)
+    )
+    return fig
+
+
+def figure_from_spec(spec):
+    """
+    由 Figure.to_json() 的结果还原Figure；内容在生成时已经校验过，这里跳过逐项校验
+    """
+    return go.Figure(json.loads(spec), _validate=False)
@@ -0,0 +1,287 @@
+"""
+CPU密集型计算的进程池
+
+Streamlit 的所有会话共享同一个进程和GIL，全市场的日线读取、指标计算等耗时任务
+在脚本线程或后台线程中执行时，会拖慢其他会话的页面响应。这里把这类任务按行分块
+交给子进程执行：输入输出数组放在共享内存中，子进程直接读写各自负责的行，
+不需要序列化DataFrame或大数组。
+
+子进程以 spawn 方式启动，只导入不依赖Streamlit的引擎模块（indicators、kline_store）。
+进程池或共享内存不可用时自动退回在当前线程中计算，结果相同。
+"""
+import functools
+import multiprocessing
+import os
+import pickle
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from pickle import PicklingError
+
+import numpy as np
+
+# 行数少于该值时直接在当前线程计算，省去进程间调度的开销
+MIN_PARALLEL_ROWS = 500
+
+# 每个子进程至少处理的行数
+MIN_CHUNK_ROWS = 200
+
+
+def _open_shared_memory(name=None, size=0):
+    create = name is None
+    try:
+        # Python 3.13+：附加到已有共享内存时不登记到资源跟踪器，避免子进程退出时误删
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=create)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name, create=create, size=size)
+
+
+class SharedArrays:
+    """
+    放在同一块共享内存中的一组numpy数组
+
+    - create: 按 {名称: (形状, 类型)} 分配，fill 为初始值
+    - from_arrays: 分配并复制已有数组
+    - attach: 在子进程中按 descriptor() 附加到同一块内存，不复制数据
+    创建方负责 close()（同时释放共享内存），附加方只需 close()。
+    """
+
+    def __init__(self, shm, layout, owner):
+        self.shm = shm
+        self.layout = layout
+        self.owner = owner
+        self.arrays = {
+            key: np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+            for key, (shape, dtype, offset) in layout.items()
+        }
+
+    @classmethod
+    def create(cls, specs, fill=None):
+        layout = {}
+        size = 0
+        for key, (shape, dtype) in specs.items():
+            dtype = np.dtype(dtype)
+            shape = tuple(int(n) for n in shape)
+            layout[key] = (shape, dtype.str, size)
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            # 每个数组按64字节对齐
+            size += -(-nbytes // 64) * 64
+        shared = cls(_open_shared_memory(size=max(size, 1)), layout, owner=True)
+        if fill is not None:
+            for array in shared.arrays.values():
+                array.fill(fill)
+        return shared
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        arrays = {key: np.asarray(value) for key, value in arrays.items()}
+        shared = cls.create({key: (value.shape, value.dtype) for key, value in arrays.items()})
+        for key, value in arrays.items():
+            shared.arrays[key][...] = value
+        return shared
+
+    @classmethod
+    def attach(cls, descriptor):
+        name, layout = descriptor
+        return cls(_open_shared_memory(name=name), layout, owner=False)
+
+    def descriptor(self):
+        return self.shm.name, self.layout
+
+    def copy_arrays(self):
+        """
+        复制出普通数组，之后即可释放共享内存
+        """
+        return {key: array.copy() for key, array in self.arrays.items()}
+
+    def close(self):
+        self.arrays = {}
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _slice_arrays(shared, start, stop):
+    if shared is None:
+        return {}
+    return {key: array[start:stop] for key, array in shared.arrays.items()}
+
+
+def _run_chunk(func, inputs_descriptor, outputs_descriptor, start, stop):
+    # 在子进程中执行：附加到共享内存，处理 [start, stop) 行
+    inputs = SharedArrays.attach(inputs_descriptor) if inputs_descriptor else None
+    outputs = SharedArrays.attach(outputs_descriptor) if outputs_descriptor else None
+    try:
+        return func(_slice_arrays(inputs, start, stop), _slice_arrays(outputs, start, stop), start, stop)
+    finally:
+        if inputs is not None:
+            inputs.close()
+        if outputs is not None:
+            outputs.close()
+
+
+class ComputePool:
+    """
+    按行分块的计算进程池，进程在第一次使用时才启动，所有会话共享
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or max(1, min(4, (os.cpu_count() or 2) - 1))
+        self.disabled = False
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def _reset(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def chunks(self, n_rows):
+        count = max(1, min(self.max_workers * 2, n_rows // MIN_CHUNK_ROWS))
+        bounds = np.linspace(0, n_rows, count + 1).astype(int)
+        return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+    def map_rows(self, func, n_rows, inputs=None, outputs=None, min_rows=MIN_PARALLEL_ROWS):
+        """
+        把 [0, n_rows) 按行分块执行 func(输入切片, 输出切片, start, stop)，按块的顺序返回各块的返回值
+
+        inputs / outputs 为 SharedArrays 或 None，func 必须是可序列化的模块级函数（可用 functools.partial）。
+        行数较少、进程池不可用、func 无法序列化时在当前线程执行；func 自身抛出的异常原样抛出。
+        """
+        chunks = self.chunks(n_rows)
+        if n_rows >= min_rows and not self.disabled and len(chunks) > 1 and _picklable(func):
+            inputs_descriptor = inputs.descriptor() if inputs is not None else None
+            outputs_descriptor = outputs.descriptor() if outputs is not None else None
+            try:
+                executor = self._get_executor()
+                futures = [
+                    executor.submit(_run_chunk, func, inputs_descriptor, outputs_descriptor, start, stop)
+                    for start, stop in chunks
+                ]
+            except (BrokenProcessPool, OSError):
+                # 子进程无法启动，此后都在当前线程计算
+                self._disable()
+            else:
+                try:
+                    return [future.result() for future in futures]
+                except BrokenProcessPool:
+                    # 子进程意外退出，此后都在当前线程计算，本次重新计算全部分块
+                    self._disable()
+        return [
+            func(_slice_arrays(inputs, start, stop), _slice_arrays(outputs, start, stop), start, stop)
+            for start, stop in chunks
+        ]
+
+    def _disable(self):
+        self.disabled = True
+        self._reset()
+
+    def shutdown(self):
+        self._reset()
+
+
+def _picklable(func):
+    # 任务无法序列化（例如局部函数）时只是这一次在当前线程计算，不影响进程池
+    try:
+        pickle.dumps(func)
+        return True
+    except (PicklingError, AttributeError, TypeError):
+        return False
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_compute_pool():
+    """
+    获取进程内唯一的计算进程池
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ComputePool()
+        return _pool
+
+
+def _indicator_chunk(names, inputs, outputs, start, stop):
+    from indicators import registry
+
+    for name, value in registry.compute(inputs, names).items():
+        outputs[name][...] = value
+
+
+def compute_indicators_parallel(arrays, names, pool=None):
+    """
+    在进程池中按股票分块计算指标，arrays 为 {列名: 股票 × 交易日 的二维数组}，返回 {输出列名: 数组}
+    """
+    from indicators import registry
+
+    pool = pool or get_compute_pool()
+    arrays = {key: np.asarray(value, dtype=float) for key, value in arrays.items()}
+    shape = next(iter(arrays.values())).shape
+    output_names = list(registry.build(names))
+    with SharedArrays.from_arrays(arrays) as inputs, \
+            SharedArrays.create({name: (shape, np.float64) for name in output_names}) as outputs:
+        pool.map_rows(functools.partial(_indicator_chunk, tuple(names)), shape[0], inputs, outputs)
+        return outputs.copy_arrays()
+
+
+def _load_chunk(codes, columns, length, adjust, inputs, outputs, start, stop):
+    from kline_store import adjust_klines, load_adjust_factors, load_klines
+
+    rows = []
+    for offset, code in enumerate(codes[start:stop]):
+        df = load_klines(code, length)
+        if df is None or df.empty:
+            rows.append((0, None, None))
+            continue
+        if adjust:
+            df = adjust_klines(df, load_adjust_factors(code), adjust)
+        n = len(df)
+        for col in columns:
+            if col in df.columns:
+                outputs[col][offset, length - n:] = df[col].to_numpy(dtype=float, na_value=np.nan)
+        dates = df["日期"].dt.strftime("%Y-%m-%d").to_numpy()
+        rows.append((n, dates[-1], dates[-2] if n > 1 else None))
+    return rows
+
+
+def load_stacked_klines(codes, columns, length, adjust="", pool=None):
+    """
+    在进程池中读取多只股票的本地日线并按最后一个交易日右对齐堆叠
+
+    返回 ({列名: 股票 × 交易日 的二维数组}, 每只股票的有效长度, 最后交易日列表, 前一交易日列表)，
+    没有数据的股票长度为0、日期为None
+    """
+    pool = pool or get_compute_pool()
+    codes = list(codes)
+    with SharedArrays.create({col: ((len(codes), length), np.float64) for col in columns}, fill=np.nan) as outputs:
+        results = pool.map_rows(
+            functools.partial(_load_chunk, codes, tuple(columns), length, adjust),
+            len(codes), outputs=outputs
+        )
+        arrays = outputs.copy_arrays()
+    rows = [row for chunk in results for row in chunk]
+    lengths = np.array([row[0] for row in rows], dtype=np.int64)
+    return arrays, lengths, [row[1] for row in rows], [row[2] for row in rows]
@@ -3,20 +3,63 @@ import akshare as ak
 import plotly.express as px
 import pandas as pd
 import numpy as np
-import plotly.graph_objects as go
 from datetime import datetime, timedelta
 import time
 import os
 import requests
 import json
 import re
+import functools
 from io import StringIO
 import efinance as ef
 import traceback
+from indicators import (
+    DEFAULT_INDICATORS, INDICATOR_COLUMNS, IndicatorState, frame_fingerprint,
+    load_indicator_state, save_indicator_state, registry as indicator_registry
+)
+from kline_store import (
+    ADJUST_HFQ, ADJUST_NONE, ADJUST_QFQ, KLINE_APPENDED, KLINE_NEW, KLINE_REFETCHED, adjust_klines, compact_klines,
+    freeze_frame, load_adjust_factors, load_klines, merge_klines, resample_klines, stored_codes,
+    store_version, update_adjust_factors, update_klines
+)
+from screen_jobs import get_job_manager, JOB_DONE, JOB_FAILED
+from screening import (
+    ExpressionError, ColumnIndex, build_basic_predicates, describe_predicates,
+    evaluate_rule, get_incremental_screener, save_incremental_screener,
+    PARQUET_AVAILABLE, iter_export_chunks, write_export_file, ExportFile, start_export_cleaner,
+    TECHNICAL_BAR_COLUMNS, TECHNICAL_HISTORY_LENGTH, build_technical_snapshot_from_arrays, load_technical_snapshot,
+    save_technical_snapshot
+)
+from compute_pool import compute_indicators_parallel, load_stacked_klines
+from market_map import (
+    SnapshotPoller, board_treemap, boards_treemap, build_industry_map, load_board_constituents, load_industry_map,
+    market_open, market_treemap, merge_live_boards, normalize_board_snapshot, normalize_quotes, patch_boards_treemap,
+    save_board_constituents, save_industry_map, tile_budget
+)
+from charts import CHART_MAX_POINTS, CHART_THEMES, INDICATOR_PANELS, compose_kline_figure, figure_from_spec
 
-# 缓存数据获取函数（减少重复请求）
-@st.cache_data(ttl=3600)
+# 返回DataFrame的数据获取函数的缓存：缓存中的对象由所有会话共享，不像 st.cache_data 那样每次反序列化出一份完整副本；
+# 每次调用返回一个浅复制（Copy-on-Write下几乎没有开销），调用方增删列、排序或修改取值都只影响自己的副本
+def cache_shared_frame(**cache_args):
+    def decorator(func):
+        cached = st.cache_resource(**cache_args)(func)
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return cached(*args, **kwargs).copy(deep=False)
+        
+        wrapper.clear = cached.clear
+        return wrapper
+    return decorator
+
+# 板块数据在所有会话之间共享：派生列在获取时计算一次，之后每次重跑不再重算
+@cache_shared_frame(ttl=3600)
 def get_board_data():
+    df = fetch_board_data()
+    return freeze_frame(process_data(df)) if not df.empty else df
+
+# 获取各行业板块最近的行情（减少重复请求）
+def fetch_board_data():
     try:
         # 获取行业板块名称列表
         board_df = ak.stock_board_industry_name_em()
@@ -109,11 +152,170 @@ def get_board_data():
         
         return pd.DataFrame()
 
-# 获取A股股票列表
-@st.cache_data(ttl=86400)  # 缓存24小时
+# 板块成分股及其最新行情，按板块缓存：下钻时只请求所选板块，一次请求同时得到成分股列表和行情；
+# 每次成功获取后保存到本地，接口失败时使用本地保存的最近一次结果
+@cache_shared_frame(ttl=300, show_spinner=False)
+def get_board_constituents(board_name):
+    try:
+        df = ak.stock_board_industry_cons_em(symbol=board_name)
+        if df is not None and not df.empty:
+            df = normalize_quotes(df)
+            save_board_constituents(board_name, df)
+            return freeze_frame(df)
+        st.warning(f"未获取到'{board_name}'的成分股")
+    except Exception as e:
+        st.warning(f"获取'{board_name}'成分股失败: {e}")
+    
+    df = load_board_constituents(board_name)
+    if df is not None and not df.empty:
+        st.info("使用本地保存的成分股数据")
+        return freeze_frame(df)
+    return pd.DataFrame()
+
+# 实时模式的刷新间隔（秒）
+LIVE_REFRESH_SECONDS = 15
+
+# 第一次打开实时模式时等待后台线程获取快照的最长时间（秒），超时则先显示提示，下次刷新再显示
+LIVE_FIRST_FETCH_TIMEOUT = 10
+
+# 全部行业板块的最新行情，一次请求得到
+def fetch_board_snapshot():
+    return normalize_board_snapshot(ak.stock_board_industry_name_em())
+
+# 进程内所有会话共享一个板块行情轮询器，无论多少个页面打开实时模式，每个间隔只请求一次接口
+@st.cache_resource
+def get_board_poller():
+    return SnapshotPoller(fetch_board_snapshot, "板块名称", interval=LIVE_REFRESH_SECONDS)
+
+# 实时板块热力图：只有这一部分按间隔重跑，图表保存在会话中，每次只修改变化板块的颜色/面积，
+# 省去的只是服务端重建图表的时间；每次刷新 st.plotly_chart 仍会把整张图表发给浏览器，
+# 固定的 key 只让浏览器在原图上重绘而不是重新创建图表组件
+def show_live_board_treemap(base_df, size_metric, color_metric, color_scale):
+    poller = get_board_poller()
+    poller.subscribe()
+    # 第一次获取由后台线程完成，这里只等待它的结果，不再另外请求
+    poller.wait_first(timeout=LIVE_FIRST_FETCH_TIMEOUT)
+    
+    chart_key = (size_metric, color_metric, color_scale)
+    state = st.session_state.get('live_board_treemap')
+    seen = state['version'] if state and state['key'] == chart_key else -1
+    version, snapshot, changed = poller.changes_since(seen)
+    if snapshot is None:
+        if poller.error:
+            st.warning(f"获取实时板块行情失败: {poller.error}")
+        else:
+            st.info("正在获取实时板块行情...")
+        return
+    
+    live_df = merge_live_boards(base_df, snapshot)
+    if changed is None or seen < 0 or list(state['figure'].data[0].ids) != live_df['板块名称'].tolist():
+        state = {
+            'key': chart_key,
+            'version': version,
+            'figure': boards_treemap(live_df, size_metric, color_metric, color_scale)
+        }
+        st.session_state['live_board_treemap'] = state
+        updated = len(live_df)
+    else:
+        updated = patch_boards_treemap(state['figure'], live_df, changed, size_metric, color_metric)
+        state['version'] = version
+    
+    status = "交易中" if market_open() else "非交易时段，行情不再变化"
+    updated_at = poller.updated_at.strftime('%H:%M:%S') if poller.updated_at else "-"
+    st.caption(f"实时行情（{status}）更新于 {updated_at}，本次更新 {updated} 个板块，每 {LIVE_REFRESH_SECONDS} 秒刷新")
+    st.plotly_chart(state['figure'], use_container_width=True, key="live_board_treemap_chart")
+
+# 全市场个股地图的尺寸（图表高度，像素），尺寸越大每个行业显示的个股越多
+MARKET_MAP_HEIGHTS = {"标准": 700, "大屏": 1000, "超大屏": 1400}
+
+# 全市场个股的最新行情，一次请求得到，所有会话共享
+@cache_shared_frame(ttl=60, show_spinner=False)
+def get_market_snapshot():
+    try:
+        df = ak.stock_zh_a_spot_em()
+        if df is not None and not df.empty:
+            return freeze_frame(normalize_quotes(df))
+        st.error("未获取到全市场行情")
+    except Exception as e:
+        st.error(f"获取全市场行情失败: {e}")
+    return pd.DataFrame()
+
+# 逐个行业板块获取成分股，生成 代码 -> 行业 的映射，在后台线程中运行；各板块的成分股同时保存，供板块下钻使用
+def prepare_industry_map(params, job):
+    job.report(0.0, "正在获取行业板块列表...")
+    board_df = ak.stock_board_industry_name_em()
+    if board_df is None or board_df.empty:
+        raise RuntimeError("无法获取行业板块列表")
+    
+    def fetch_constituents(board_name):
+        df = ak.stock_board_industry_cons_em(symbol=board_name)
+        # 为避免频繁请求导致API限制，添加短暂延迟
+        time.sleep(0.2)
+        if df is None or df.empty:
+            return None
+        df = normalize_quotes(df)
+        save_board_constituents(board_name, df)
+        return df
+    
+    mapping, failed = build_industry_map(
+        board_df['板块名称'].tolist(),
+        fetch_constituents,
+        progress=lambda i, n: job.report(i / n, f"正在获取行业成分股: {i}/{n}")
+    )
+    if mapping.empty:
+        raise RuntimeError("所有行业板块的成分股获取失败")
+    save_industry_map(mapping)
+    job.note(f"行业映射已更新：{mapping['板块名称'].nunique()} 个行业，{len(mapping)} 只股票，{failed} 个板块获取失败")
+    return mapping
+
+# 全市场个股地图：一次获取全市场行情，按本地保存的行业映射分组
+def show_market_map(size_metric, color_metric, color_scale):
+    job_manager = get_job_manager()
+    size_col, button_col = st.columns(2)
+    with size_col:
+        map_size = st.selectbox("地图尺寸", options=list(MARKET_MAP_HEIGHTS), index=0, key="market_map_size")
+    with button_col:
+        if st.button("更新行业映射", help="逐个获取行业板块的成分股，约需一两分钟", key="update_industry_map"):
+            # 同一天内重复点击共享同一个任务
+            st.session_state['industry_map_job_id'] = job_manager.submit(
+                prepare_industry_map, {'day': datetime.now().strftime('%Y-%m-%d')})
+    
+    job_id = st.session_state.get('industry_map_job_id')
+    job = job_manager.get(job_id) if job_id else None
+    if job is not None:
+        if not job.finished:
+            st.info("正在后台生成行业映射，可切换页面，稍后回来查看")
+            show_job_progress(job.job_id)
+        else:
+            for note in job.snapshot()['notes']:
+                st.info(note)
+            if job.status == JOB_FAILED:
+                st.error(f"生成行业映射失败: {job.snapshot()['message']}")
+    
+    mapping = load_industry_map()
+    if mapping is None or mapping.empty:
+        st.info("首次使用请先点击“更新行业映射”")
+        return
+    
+    with st.spinner("正在获取全市场行情..."):
+        quotes = get_market_snapshot()
+    if quotes.empty:
+        return
+    
+    height = MARKET_MAP_HEIGHTS[map_size]
+    fig = market_treemap(quotes, mapping, size_metric, color_metric, color_scale, tile_budget(height), height)
+    st.caption(f"全市场 {len(quotes)} 只股票，{mapping['板块名称'].nunique()} 个行业；"
+               f"每个行业按{size_metric}占比显示最大的若干只，其余合并为“其他”")
+    st.plotly_chart(fig, use_container_width=True)
+
+# 获取A股股票列表，所有会话共享
+@cache_shared_frame(ttl=86400)  # 缓存24小时
 def get_stock_list():
+    return freeze_frame(fetch_stock_list())
+
+def fetch_stock_list(warn=st.warning):
     """
-    获取A股股票列表
+    获取A股股票列表，不使用缓存；warn 用于提示获取失败，后台任务中传入 job.note
     """
     try:
         # 使用akshare获取股票列表
@@ -134,7 +336,7 @@ def get_stock_list():
         
         return stock_list
     except Exception as e:
-        st.warning(f"通过akshare获取股票列表失败: {e}")
+        warn(f"通过akshare获取股票列表失败: {e}")
     
     # 尝试备用方法1：使用另一个akshare接口
     try:
@@ -165,7 +367,7 @@ def get_stock_list():
         
         return stock_list
     except Exception as e:
-        st.warning(f"通过备用方法获取股票列表失败: {e}")
+        warn(f"通过备用方法获取股票列表失败: {e}")
     
     # 尝试备用方法2：从本地文件加载（如果之前成功获取过）
     # try:
@@ -173,10 +375,10 @@ def get_stock_list():
     #     if not stock_list.empty:
     #         return stock_list
     # except Exception as e:
-    #     st.warning(f"从本地文件加载股票列表失败: {e}")
+    #     warn(f"从本地文件加载股票列表失败: {e}")
     
     # 所有方法都失败，返回一个默认股票列表（包含一些常见大盘股）
-    st.warning("无法获取完整的股票列表，使用有限的默认列表")
+    warn("无法获取完整的股票列表，使用有限的默认列表")
     default_stocks = [
         {"代码": "000001", "名称": "平安银行"},
         {"代码": "000002", "名称": "万科A"},
@@ -200,14 +402,14 @@ def get_stock_list():
 # 使用efinance获取股票数据
 def get_stock_data_from_efinance(stock_code, start_date, end_date):
     """
-    从efinance获取股票K线数据
+    从efinance获取股票的不复权K线数据，复权在本地由复权因子计算
     """
     # 确保股票代码格式正确（去除可能的后缀）
     stock_code = stock_code.strip().upper().replace('.SH', '').replace('.SZ', '').replace('.BJ', '')
     
     # 缓存文件路径
     os.makedirs("data_cache", exist_ok=True)
-    cache_file = f"data_cache/{stock_code}_{start_date}_{end_date}.csv"
+    cache_file = f"data_cache/{stock_code}_{start_date}_{end_date}_raw.csv"
     
     # 尝试从缓存加载
     if os.path.exists(cache_file):
@@ -223,7 +425,7 @@ def get_stock_data_from_efinance(stock_code, start_date, end_date):
     
     try:
         # 使用efinance获取数据
-        df = ef.stock.get_quote_history(stock_code, beg=start_date, end=end_date)
+        df = ef.stock.get_quote_history(stock_code, beg=start_date, end=end_date, fqt=0)
         
         if not df.empty:
             # 重命名列以匹配我们的格式
@@ -529,11 +731,22 @@ def get_fundamental_from_efinance(stock_code):
         "净利润增长率(%)": 5.0
     }])
 
+# 数据源返回的不复权K线转换为紧凑格式（数值列只读，供缓存共享），并检查其中的除权除息日以更新复权因子表
+def ingest_raw_klines(stock_code, df):
+    df = compact_klines(df)
+    try:
+        update_adjust_factors(stock_code, df)
+    except Exception as e:
+        st.warning(f"更新复权因子失败: {e}")
+    return freeze_frame(df)
+
 # 更新获取个股K线数据函数，改用efinance接口
-@st.cache_data(ttl=3600)
+@cache_shared_frame(ttl=3600)
 def get_stock_data(stock_code, start_date, end_date):
     """
-    获取股票K线数据，优先使用efinance接口
+    获取股票的不复权K线数据，优先使用efinance接口；返回紧凑格式（见 compact_klines），缓存中的数据占用更少内存
+    缓存中的K线由所有会话共享，每次调用返回浅复制
+    获取到的K线同时用于更新本地复权因子表，各种复权方式都由同一份数据在本地计算
     """
     # 使用spinner替代直接显示info消息
     with st.spinner(f"正在获取 {stock_code} 的行情数据..."):
@@ -544,7 +757,7 @@ def get_stock_data(stock_code, start_date, end_date):
             # 确保数据是按日期排序的
             if '日期' in df.columns:
                 df = df.sort_values(by='日期')
-            return df
+            return ingest_raw_klines(stock_code, df)
         
         # 如果efinance接口失败，尝试新浪接口
         try:
@@ -558,7 +771,7 @@ def get_stock_data(stock_code, start_date, end_date):
                 # 确保数据是按日期排序的
                 if '日期' in df.columns:
                     df = df.sort_values(by='日期')
-                return df
+                return ingest_raw_klines(stock_code, df)
         except Exception:
             pass
         
@@ -568,7 +781,7 @@ def get_stock_data(stock_code, start_date, end_date):
             formatted_code = format_stock_code(stock_code)
             
             # 尝试使用akshare获取数据
-            df = ak.stock_zh_a_hist(symbol=formatted_code, start_date=start_date, end_date=end_date, adjust="qfq")
+            df = ak.stock_zh_a_hist(symbol=formatted_code, start_date=start_date, end_date=end_date, adjust="")
             
             if not df.empty:
                 # 过滤非交易日（成交量为0的记录）
@@ -580,9 +793,9 @@ def get_stock_data(stock_code, start_date, end_date):
                     df = df.sort_values(by='日期')
                 
                 # 缓存数据
-                cache_file = f"data_cache/{stock_code}_{start_date}_{end_date}.csv"
+                cache_file = f"data_cache/{stock_code}_{start_date}_{end_date}_raw.csv"
                 df.to_csv(cache_file, index=False)
-                return df
+                return ingest_raw_klines(stock_code, df)
         except Exception:
             # 捕获但不显示错误信息
             pass
@@ -598,80 +811,84 @@ def get_stock_fundamental(stock_code):
     """
     # 使用可被隐藏的提示信息
     with st.spinner(f"正在获取 {stock_code} 的基本面数据..."):
-        # 使用efinance接口获取数据
-        df = get_fundamental_from_efinance(stock_code)
+        return fetch_stock_fundamental(stock_code)
+
+# 依次尝试各数据源获取基本面数据，不调用Streamlit组件，可在后台任务中使用
+def fetch_stock_fundamental(stock_code):
+    # 使用efinance接口获取数据
+    df = get_fundamental_from_efinance(stock_code)
+    
+    if not df.empty and not all(pd.isna(df.iloc[0])):
+        return df
+    
+    # 如果efinance接口失败，尝试新浪接口
+    df = get_fundamental_from_sina(stock_code)
+    
+    if not df.empty and not all(pd.isna(df.iloc[0])):
+        return df
+    
+    # 如果新浪接口失败，尝试原来的akshare方法
+    try:
+        # 格式化股票代码
+        formatted_code = format_stock_code(stock_code)
         
-        if not df.empty and not all(pd.isna(df.iloc[0])):
-            return df
+        # 尝试使用akshare获取数据
+        financial = ak.stock_financial_analysis_indicator(symbol=formatted_code)
         
-        # 如果efinance接口失败，尝试新浪接口
-        df = get_fundamental_from_sina(stock_code)
+        if financial is None or financial.empty:
+            financial = ak.stock_financial_analysis_indicator(symbol=stock_code)
         
-        if not df.empty and not all(pd.isna(df.iloc[0])):
-            return df
-        
-        # 如果新浪接口失败，尝试原来的akshare方法
-        try:
-            # 格式化股票代码
-            formatted_code = format_stock_code(stock_code)
+        if not financial.empty:
+            latest_financial = financial.iloc[0]
             
-            # 尝试使用akshare获取数据
-            financial = ak.stock_financial_analysis_indicator(symbol=formatted_code)
+            try:
+                stock_info = ak.stock_a_lg_indicator(symbol=formatted_code)
+                
+                if stock_info is None or stock_info.empty:
+                    stock_info = ak.stock_a_lg_indicator(symbol=stock_code)
+            except:
+                stock_info = pd.DataFrame()
             
-            if financial is None or financial.empty:
-                financial = ak.stock_financial_analysis_indicator(symbol=stock_code)
+            # 提取指标
+            pe = None
+            pb = None
             
-            if not financial.empty:
-                latest_financial = financial.iloc[0]
-                
-                try:
-                    stock_info = ak.stock_a_lg_indicator(symbol=formatted_code)
-                    
-                    if stock_info is None or stock_info.empty:
-                        stock_info = ak.stock_a_lg_indicator(symbol=stock_code)
-                except:
-                    stock_info = pd.DataFrame()
-                
-                # 提取指标
-                pe = None
-                pb = None
-                
-                if not stock_info.empty:
-                    if '市盈率(动态)' in stock_info.columns:
-                        pe = stock_info['市盈率(动态)'].values[0]
-                    elif '指标名称' in stock_info.columns:
-                        pe_row = stock_info.loc[stock_info['指标名称'] == '市盈率(动态)']
-                        if not pe_row.empty:
-                            pe = pe_row['最新值'].values[0]
-                    
-                    if '市净率' in stock_info.columns:
-                        pb = stock_info['市净率'].values[0]
-                    elif '指标名称' in stock_info.columns:
-                        pb_row = stock_info.loc[stock_info['指标名称'] == '市净率']
-                        if not pb_row.empty:
-                            pb = pb_row['最新值'].values[0]
-                
-                # 合并数据
-                result = {
-                    "股票代码": stock_code,
-                    "市盈率(动态)": pe,
-                    "市净率": pb,
-                    "ROE": latest_financial.get('净资产收益率加权(%)'),
-                    "营收增长率(%)": latest_financial.get('营业收入同比增长率(%)'),
-                    "净利润增长率(%)": latest_financial.get('净利润同比增长率(%)')
-                }
+            if not stock_info.empty:
+                if '市盈率(动态)' in stock_info.columns:
+                    pe = stock_info['市盈率(动态)'].values[0]
+                elif '指标名称' in stock_info.columns:
+                    pe_row = stock_info.loc[stock_info['指标名称'] == '市盈率(动态)']
+                    if not pe_row.empty:
+                        pe = pe_row['最新值'].values[0]
                 
-                result_df = pd.DataFrame([result])
-                
-                # 缓存数据
-                cache_file = f"data_cache/{stock_code}_fundamental.csv"
-                result_df.to_csv(cache_file, index=False)
-                
-                return result_df
-        except Exception as e:
-            # 捕获但不显示错误
-            pass
-    
+                if '市净率' in stock_info.columns:
+                    pb = stock_info['市净率'].values[0]
+                elif '指标名称' in stock_info.columns:
+                    pb_row = stock_info.loc[stock_info['指标名称'] == '市净率']
+                    if not pb_row.empty:
+                        pb = pb_row['最新值'].values[0]
+            
+            # 合并数据
+            result = {
+                "股票代码": stock_code,
+                "市盈率(动态)": pe,
+                "市净率": pb,
+                "ROE": latest_financial.get('净资产收益率加权(%)'),
+                "营收增长率(%)": latest_financial.get('营业收入同比增长率(%)'),
+                "净利润增长率(%)": latest_financial.get('净利润同比增长率(%)')
+            }
+            
+            result_df = pd.DataFrame([result])
+            
+            # 缓存数据
+            cache_file = f"data_cache/{stock_code}_fundamental.csv"
+            result_df.to_csv(cache_file, index=False)
+            
+            return result_df
+    except Exception as e:
+        # 捕获但不显示错误
+        pass
+
     # 所有方法都失败时返回默认值
     return pd.DataFrame([{
         "股票代码": stock_code,
@@ -705,54 +922,136 @@ def format_stock_code(code):
         # 默认返回原代码
         return code
 
-# 计算技术指标
-def calculate_indicators(df):
+# 选股结果的列
+SCREEN_RESULT_COLUMNS = ["代码", "名称", "市盈率", "市净率", "ROE(%)", "营收增长率(%)", "净利润增长率(%)"]
+# 股票池指标历史文件，位于 data_cache/fundamentals 下
+METRIC_HISTORY_FILE = "metric_history.csv"
+
+# 增量计算技术指标：复用该股票上次保存的指标状态，只为新增（或盘中变化）的K线更新指标
+# EMA的初值、MA的预热行都取决于序列起点，只有状态与当前区间的第一根K线相同时才沿用，
+# 此时结果与按当前区间重新计算逐位一致；区间起点不同（换了数据周期、或过了一天）时完整重算
+def calculate_indicators_incremental(state_key, df):
     if df.empty:
         return df
     
     # 确保必要的列存在
-    required_cols = ['收盘', '开盘', '最高', '最低', '成交量']
+    required_cols = ['日期', '收盘', '开盘', '最高', '最低', '成交量']
     if not all(col in df.columns for col in required_cols):
         return df
     
-    # 计算MA
-    df['MA5'] = df['收盘'].rolling(5).mean()
-    df['MA10'] = df['收盘'].rolling(10).mean()
-    df['MA20'] = df['收盘'].rolling(20).mean()
-    
-    # 计算MACD
-    df['EMA12'] = df['收盘'].ewm(span=12, adjust=False).mean()
-    df['EMA26'] = df['收盘'].ewm(span=26, adjust=False).mean()
-    df['DIF'] = df['EMA12'] - df['EMA26']
-    df['DEA'] = df['DIF'].ewm(span=9, adjust=False).mean()
-    df['MACD'] = 2 * (df['DIF'] - df['DEA'])
-    
-    # 计算KDJ
-    low_9 = df['最低'].rolling(window=9).min()
-    high_9 = df['最高'].rolling(window=9).max()
-    df['RSV'] = (df['收盘'] - low_9) / (high_9 - low_9) * 100
-    df['K'] = df['RSV'].ewm(alpha=1/3, adjust=False).mean()
-    df['D'] = df['K'].ewm(alpha=1/3, adjust=False).mean()
-    df['J'] = 3 * df['K'] - 2 * df['D']
-    
-    # 计算RSI
-    delta = df['收盘'].diff()
-    up = delta.clip(lower=0)
-    down = -1 * delta.clip(upper=0)
-    ema_up = up.ewm(com=13, adjust=False).mean()
-    ema_down = down.ewm(com=13, adjust=False).mean()
-    rs = ema_up / ema_down
-    df['RSI'] = 100 - (100 / (1 + rs))
-    
-    # 计算威廉指标WR (21日)，并取绝对值
-    period = 21
-    highest_high = df['最高'].rolling(window=period).max()
-    lowest_low = df['最低'].rolling(window=period).min()
-    # 计算原始WR值，然后取绝对值
-    df['WR21'] = abs(-100 * ((highest_high - df['收盘']) / (highest_high - lowest_low)))
+    dates = df['日期'].astype(str).tolist()
+    close = df['收盘'].to_numpy(dtype=float)
+    high = df['最高'].to_numpy(dtype=float)
+    low = df['最低'].to_numpy(dtype=float)
+    
+    cached = load_indicator_state(state_key)
+    if cached is not None:
+        state, history = cached
+        known = history.index.get_indexer(dates)
+        if state.last_date in dates:
+            pos = dates.index(state.last_date)
+        else:
+            pos = -1
+        
+        # 状态可以沿用的条件：起点相同，之前的K线都在历史中，且上次最后一根K线之前的数据未被改写
+        if pos >= 0 and state.first_date == dates[0] and state.can_revise and (known[:pos + 1] >= 0).all() \
+                and (pos == 0 or close[pos - 1] == state.close_before_last):
+            state = state.copy()
+            updates = {}
+            if (close[pos], high[pos], low[pos]) != state.last_bar:
+                # 最后一根K线在盘中发生了变化
+                updates[dates[pos]] = state.revise(dates[pos], close[pos], high[pos], low[pos])
+            for i in range(pos + 1, len(dates)):
+                updates[dates[i]] = state.append(dates[i], close[i], high[i], low[i], revisable=(i == len(dates) - 1))
+            
+            if updates:
+                update_df = pd.DataFrame.from_dict(updates, orient='index')[list(INDICATOR_COLUMNS)]
+                history = pd.concat([history.drop(index=update_df.index, errors='ignore'), update_df])
+                # 限制保存的历史长度
+                history = history.iloc[-INDICATOR_HISTORY_LIMIT:]
+                save_indicator_state(state_key, state, history)
+            
+            df[list(INDICATOR_COLUMNS)] = history.reindex(dates).to_numpy()
+            return df
     
+    # 没有可用的状态，完整计算一次并保存状态
+    state, values = IndicatorState.from_bars(dates, close, high, low)
+    history = pd.DataFrame(values, index=dates)[list(INDICATOR_COLUMNS)]
+    save_indicator_state(state_key, state, history.iloc[-INDICATOR_HISTORY_LIMIT:])
+    for name in INDICATOR_COLUMNS:
+        df[name] = values[name]
     return df
 
+# 个股分析页面可选的最长数据周期（自然日）
+STOCK_DAYS_MAX = 3650
+
+# 增量指标状态中保存的指标历史行数上限：必须覆盖页面上可选的最长区间，否则长区间的K线不会全部落在历史中，
+# 每次都只能完整重算；交易日数不超过自然日数，按最长周期的自然日数保存即可
+INDICATOR_HISTORY_LIMIT = STOCK_DAYS_MAX
+
+# 个股分析页面可额外叠加的指标
+EXTRA_INDICATOR_OPTIONS = ["BOLL", "MA30", "MA60", "EMA12", "EMA26", "ATR14", "OBV"]
+
+# 计算页面上额外选择的指标，只计算被选中的指标
+def calculate_extra_indicators(df, names):
+    if df.empty or not names:
+        return df
+    
+    arrays = {col: df[col].to_numpy(dtype=float) for col in ['开盘', '收盘', '最高', '最低', '成交量'] if col in df.columns}
+    try:
+        values = indicator_registry.compute(arrays, names)
+    except KeyError as e:
+        st.warning(f"指标计算失败: {e}")
+        return df
+    for name, value in values.items():
+        df[name] = value
+    return df
+
+# 按K线内容指纹和指标列表缓存指标结果，_df 不参与缓存键的计算：
+# 页面重跑时K线没有变化就直接取缓存，新增或修改任何一根K线都会改变指纹，从而重新计算
+@st.cache_data(max_entries=64, show_spinner=False)
+def get_indicator_frame(state_key, fingerprint, indicator_names, _df):
+    df = calculate_indicators_incremental(state_key, _df.copy())
+    df = calculate_extra_indicators(df, [name for name in indicator_names if name not in DEFAULT_INDICATORS])
+    return df[[col for col in df.columns if col not in _df.columns]]
+
+# 个股分析页面的K线周期：日K线直接使用，周/月K线由日K线重采样
+KLINE_PERIODS = {"日": None, "周": "W", "月": "M"}
+
+# 个股分析页面的复权方式
+ADJUST_MODES = {"前复权": ADJUST_QFQ, "后复权": ADJUST_HFQ, "不复权": ADJUST_NONE}
+
+# 历史交易数据表格默认显示的列，其余指标列可在表格上方选择
+KLINE_TABLE_COLUMNS = ("日期", "开盘", "收盘", "最高", "最低", "成交量", "成交额", "涨跌幅", "换手率") + INDICATOR_COLUMNS
+
+# 由不复权日K线得到页面展示的K线：按复权因子表在本地复权；
+# 周/月K线先合并本地日线仓库中更早的历史（同一日期以页面获取的为准），复权后再在本地重采样，
+# 已结束的周期按股票和复权方式缓存，新增K线时只重算最后一个周期
+def get_display_klines(stock_code, daily_df, adjust, period):
+    if period:
+        stored = load_klines(stock_code)
+        if stored is not None and not stored.empty:
+            daily_df = merge_klines(stored, daily_df)
+    daily_df = adjust_klines(daily_df, load_adjust_factors(stock_code), adjust)
+    if period:
+        return resample_klines(daily_df, period, cache_key=f"{stock_code}_{adjust}")
+    return daily_df
+
+# 判断指标列是否与价格同一刻度（叠加在K线图上）
+def is_price_overlay(name):
+    return name.startswith('BOLL_') or re.fullmatch(r'E?MA\d+', name) is not None
+
+# K线图表的序列化结果按 (图表键, 显示区间, 面板, 叠加指标, 主题) 和K线内容指纹缓存，所有会话共享，_df 不参与缓存键的计算：
+# 重跑页面或其他用户打开同一只股票的同一图表时，不再重新构建Figure，只需从JSON还原
+@st.cache_data(max_entries=64, show_spinner=False)
+def get_kline_figure_spec(chart_key, fingerprint, view, panels, overlays, extra_panels, theme, _df):
+    return compose_kline_figure(_df, panels=panels, overlays=overlays, extra_panels=extra_panels, theme=theme).to_json()
+
+# 图表配色跟随页面的亮色/暗色主题
+def current_chart_theme():
+    theme = getattr(getattr(st.context, 'theme', None), 'type', None)
+    return theme if theme in CHART_THEMES else 'light'
+
 # 数据处理函数
 def process_data(df):
     numeric_cols = ['开盘','收盘','最高','最低','成交量','成交额','振幅','涨跌幅','换手率']
@@ -768,62 +1067,76 @@ def process_data(df):
     df['涨跌幅'] = df['涨跌幅'] / 100  # 确保为百分比值
     return df.dropna(subset=['涨跌幅'])
 
-# 修改选股函数，使用efinance获取基本面数据
-def filter_stocks(pe_min, pe_max, pb_min, pb_max, roe_min, growth_min, max_stocks=200):
-    st.info("正在筛选股票，请稍候...")
-    progress_bar = st.progress(0)
-    status_text = st.empty()
+# 选股任务函数：在后台线程中汇总股票池的基本面数据，通过job汇报进度和提示；
+# 后台线程不在脚本运行中，只能调用不含Streamlit组件和缓存的函数（fetch_stock_list、fetch_stock_fundamental）
+# 筛选条件在页面上用表达式对汇总结果做向量化过滤，因此任务只与股票池大小有关，不同条件可共享同一任务
+def load_fundamentals_universe(params, job):
+    max_stocks = params['max_stocks']
+    
+    job.report(0.0, "正在获取股票列表...")
     
     # 获取股票列表
-    stock_list = get_stock_list()
+    stock_list = fetch_stock_list(warn=job.note)
     
     if stock_list.empty:
-        st.error("无法获取股票列表，选股功能无法继续")
-        return pd.DataFrame()
+        raise RuntimeError("无法获取股票列表，选股功能无法继续")
     
     # 限制处理的股票数量以提高性能
     if len(stock_list) > max_stocks:
-        st.warning(f"为提高性能，将只筛选前 {max_stocks} 只股票")
+        job.note(f"为提高性能，将只筛选前 {max_stocks} 只股票")
         stock_list = stock_list.head(max_stocks)
     
-    filtered_stocks = []
+    universe_rows = []
     total_stocks = len(stock_list)
     processed_count = 0
+    reused_count = 0
     error_count = 0
     
     # 尝试从缓存文件中获取已处理的结果
     cache_dir = "data_cache/fundamentals"
     os.makedirs(cache_dir, exist_ok=True)
+    cache_file = f"{cache_dir}/universe_{max_stocks}.csv"
     
-    # 创建一个包含所有筛选条件的标识符
-    filter_id = f"pe_{pe_min}_{pe_max}_pb_{pb_min}_{pb_max}_roe_{roe_min}_growth_{growth_min}"
-    cache_file = f"{cache_dir}/filter_{filter_id}.csv"
-    
-    # 检查是否有最近的缓存结果(1小时内)
+    # 上一次汇总的结果：过期后也保留，用于增量刷新
+    previous_rows = {}
+    previous_time = 0
     if os.path.exists(cache_file):
         cache_time = os.path.getmtime(cache_file)
-        if (time.time() - cache_time) < 3600:  # 1小时内的缓存
-            try:
-                cache_df = pd.read_csv(cache_file)
-                st.success("使用缓存的筛选结果")
+        try:
+            cache_df = pd.read_csv(cache_file, dtype={'代码': str})
+            # 检查是否有最近的缓存结果(1小时内)
+            if (time.time() - cache_time) < 3600:  # 1小时内的缓存
+                job.note("使用缓存的基本面数据")
                 return cache_df
-            except:
-                pass
+            previous_rows = {r['代码']: r for r in cache_df.to_dict('records')}
+            previous_time = cache_time
+        except:
+            pass
+    
+    required_fields = ['市盈率(动态)', '市净率', 'ROE', '营收增长率(%)', '净利润增长率(%)']
+    changed_rows = []
     
     for i, (_, row) in enumerate(stock_list.iterrows()):
-        # 更新进度条和状态
-        progress = min(i / total_stocks, 1.0)
-        progress_bar.progress(progress)
         processed_count += 1
         
         if i % 5 == 0:  # 每处理5只股票更新一次状态
-            status_text.text(f"已处理: {processed_count}/{total_stocks} | 符合条件: {len(filtered_stocks)} | 错误: {error_count}")
+            job.report(i / total_stocks, f"已处理: {processed_count}/{total_stocks} | 有效数据: {len(universe_rows)} | 沿用: {reused_count} | 错误: {error_count}")
         
         try:
             stock_code = row['代码']
             
             # 检查是否有个股缓存数据
             fund_cache_file = f"data_cache/{stock_code}_fundamental.csv"
+            
+            # 个股缓存文件在上次汇总之后没有变化，直接沿用上次的指标，不再读取
+            if stock_code in previous_rows and os.path.exists(fund_cache_file) \
+                    and os.path.getmtime(fund_cache_file) <= previous_time:
+                previous = dict(previous_rows[stock_code])
+                previous['名称'] = row['名称']
+                universe_rows.append(previous)
+                reused_count += 1
+                continue
+            
             if os.path.exists(fund_cache_file):
                 try:
                     fund_data = pd.read_csv(fund_cache_file)
@@ -836,43 +1149,34 @@ def filter_stocks(pe_min, pe_max, pb_min, pb_max, roe_min, growth_min, max_stock
                 
                 # 如果efinance接口失败，尝试其他方法
                 if fund_data.empty or all(pd.isna(fund_data.iloc[0])):
-                    fund_data = get_stock_fundamental(stock_code)
+                    fund_data = fetch_stock_fundamental(stock_code)
             
             if fund_data.empty:
                 continue
-                
-            # 应用筛选条件，增加健壮性检查
-            valid_data = True
-            required_fields = ['市盈率(动态)', '市净率', 'ROE', '营收增长率(%)', '净利润增长率(%)']
             
-            # 检查是否所有必需字段都存在且不是NaN
-            for field in required_fields:
-                if field not in fund_data.columns or pd.isna(fund_data.iloc[0][field]):
-                    valid_data = False
-                    break
+            # 缺少字段的股票不进入股票池
+            if not all(field in fund_data.columns for field in required_fields):
+                continue
             
-            if valid_data:
-                pe = float(fund_data.iloc[0]['市盈率(动态)'])
-                pb = float(fund_data.iloc[0]['市净率'])
-                roe = float(fund_data.iloc[0]['ROE'])
-                growth = float(fund_data.iloc[0]['营收增长率(%)'])
-                
-                # 排除负值和异常值
-                if pe < 0 or pb < 0 or pe > 2000 or pb > 100:
-                    continue
-                
-                if (pe_min <= pe <= pe_max or pe_min == pe_max == 0) and \
-                   (pb_min <= pb <= pb_max or pb_min == pb_max == 0) and \
-                   roe >= roe_min and growth >= growth_min:
-                    filtered_stocks.append({
-                        "代码": stock_code,
-                        "名称": row['名称'],
-                        "市盈率": pe,
-                        "市净率": pb,
-                        "ROE(%)": roe,
-                        "营收增长率(%)": growth,
-                        "净利润增长率(%)": fund_data.iloc[0]['净利润增长率(%)']
-                    })
+            latest = fund_data.iloc[0]
+            stock_row = {
+                "代码": stock_code,
+                "名称": row['名称'],
+                "市盈率": pd.to_numeric(latest['市盈率(动态)'], errors='coerce'),
+                "市净率": pd.to_numeric(latest['市净率'], errors='coerce'),
+                "ROE(%)": pd.to_numeric(latest['ROE'], errors='coerce'),
+                "营收增长率(%)": pd.to_numeric(latest['营收增长率(%)'], errors='coerce'),
+                "净利润增长率(%)": pd.to_numeric(latest['净利润增长率(%)'], errors='coerce')
+            }
+            universe_rows.append(stock_row)
+            
+            # 记录指标有变化的股票，形成指标历史
+            previous = previous_rows.get(stock_code)
+            if previous is None or any(
+                not (pd.isna(previous[col]) and pd.isna(stock_row[col])) and previous[col] != stock_row[col]
+                for col in SCREEN_RESULT_COLUMNS[2:]
+            ):
+                changed_rows.append(stock_row)
             
             # 为避免频繁请求导致API限制，添加短暂延迟
             if i % 10 == 0 and i > 0:
@@ -882,615 +1186,851 @@ def filter_stocks(pe_min, pe_max, pb_min, pb_max, roe_min, growth_min, max_stock
             error_count += 1
             # 如果错误太多，提前终止
             if error_count > 20:
-                st.warning(f"遇到过多错误，提前终止筛选: {e}")
+                job.note(f"遇到过多错误，提前终止: {e}")
                 break
             continue
     
-    progress_bar.progress(1.0)
-    status_text.text(f"筛选完成，共找到 {len(filtered_stocks)} 只符合条件的股票")
+    job.report(1.0, f"基本面数据汇总完成，共 {len(universe_rows)} 只股票，其中 {reused_count} 只沿用上次结果")
     
-    if not filtered_stocks:
-        st.warning("没有找到符合条件的股票，请尝试放宽筛选条件")
-        return pd.DataFrame()
+    universe_df = pd.DataFrame(universe_rows, columns=SCREEN_RESULT_COLUMNS)
     
     # 保存结果到缓存
-    result_df = pd.DataFrame(filtered_stocks)
-    result_df.to_csv(cache_file, index=False)
+    if not universe_df.empty:
+        universe_df.to_csv(cache_file, index=False)
+    
+    # 追加指标历史
+    if changed_rows:
+        history_df = pd.DataFrame(changed_rows, columns=SCREEN_RESULT_COLUMNS)
+        history_df.insert(0, "记录时间", datetime.now().strftime("%Y-%m-%d %H:%M"))
+        history_file = f"{cache_dir}/{METRIC_HISTORY_FILE}"
+        history_df.to_csv(history_file, mode='a', header=not os.path.exists(history_file), index=False)
     
-    return result_df
+    return universe_df
 
-# 辅助函数，获取月份标签
-def get_monthly_ticks(df):
-    """
-    从日期数据中提取每个月的第一个交易日作为刻度标签
-    """
-    if '月份' not in df.columns:
-        df = df.copy()
+# 原始数据表格每页的行数
+TABLE_PAGE_SIZE = 50
+
+# 原始数据表格的排序索引，同一份数据只构建一次，所有会话共享
+@st.cache_resource(max_entries=16)
+def get_table_index(table_key, fingerprint, _df):
+    return ColumnIndex(_df, columns=list(_df.columns))
+
+# 分页表格：在服务器端按缓存的排序索引取出当前页，只把这一页的选中列发送到页面
+def show_paged_table(df, key, fingerprint, sort_column, ascending=False, default_columns=None, column_config=None):
+    if df.empty:
+        st.info("暂无数据")
+        return
+    all_columns = list(df.columns)
+    default_columns = [col for col in (default_columns or all_columns) if col in all_columns]
     
-    df['月份'] = pd.to_datetime(df['日期']).dt.strftime('%Y-%m')
-    monthly_ticks = []
-    monthly_labels = []
-    prev_month = None
+    col1, col2, col3, col4 = st.columns([3, 2, 1, 1])
+    with col1:
+        columns = st.multiselect("显示列", options=all_columns, default=default_columns, key=f"{key}_columns")
+    with col2:
+        sort_by = st.selectbox("排序", options=all_columns, index=all_columns.index(sort_column),
+                               key=f"{key}_sort")
+    with col3:
+        order = st.radio("顺序", options=["降序", "升序"], index=1 if ascending else 0, horizontal=True,
+                         key=f"{key}_order")
+    page_count = -(-len(df) // TABLE_PAGE_SIZE)
+    with col4:
+        page = st.number_input("页码", min_value=1, max_value=page_count, value=1, step=1, key=f"{key}_page")
     
-    for i, row in df.iterrows():
-        current_month = row['月份']
-        if current_month != prev_month:
-            monthly_ticks.append(row['日期'])
-            monthly_labels.append(current_month)
-            prev_month = current_month
+    ordered = get_table_index(key, fingerprint, df).sort(sort_by, ascending=(order == "升序"))
+    start = (int(page) - 1) * TABLE_PAGE_SIZE
+    page_df = df.iloc[ordered[start:start + TABLE_PAGE_SIZE]][columns or default_columns]
+    st.dataframe(
+        page_df,
+        column_config=column_config,
+        height=min(35 * (len(page_df) + 1) + 3, 600),
+        hide_index=True
+    )
+    st.caption(f"第 {int(page)}/{page_count} 页，共 {len(df)} 行")
+
+# 用增量选股器得到筛选结果：同一次股票池刷新（任务）只求值一次，之后的重跑直接使用上次的结果；
+# 股票池刷新后只对指标有变化的股票重新求值。返回按排序列排好的命中股票和与上次结果的差异
+def refresh_screen(universe_df, predicates, expression, condition_text, sort_column, ascending, version):
+    screener, state_key = get_incremental_screener(condition_text, sort_column, ascending)
+    # 选股器在会话之间共享，刷新、保存和读取结果期间持有它的锁
+    with screener.lock:
+        previous_version = screener.version
+        diff = screener.refresh(
+            universe_df,
+            lambda frame: evaluate_rule(frame, predicates, expression),
+            version=version
+        )
+        if screener.version != previous_version:
+            save_incremental_screener(screener, state_key)
+        hits = screener.snapshot.loc[screener.ranks.index].reset_index()
+    return hits, diff
+
+# 显示与上次筛选结果的差异（新进入、移出、排名变化）
+def show_screen_diff(diff, universe_df):
+    if diff.initial:
+        st.caption("首次使用该条件筛选，下次刷新后将显示结果变化")
+        return
     
-    return monthly_ticks, monthly_labels
+    names = dict(zip(universe_df['代码'], universe_df['名称']))
+    with st.expander(f"与上次筛选相比：新进入 {len(diff.entered)} 只，移出 {len(diff.exited)} 只，"
+                     f"排名变化 {len(diff.rank_changed)} 只（本次重新评估 {diff.evaluated_count}/{diff.total_count} 只）"):
+        if diff.unchanged:
+            st.write("筛选结果没有变化")
+        if diff.entered:
+            st.write("新进入：" + "、".join(f"{names.get(code, '')}({code})" for code in diff.entered))
+        if diff.exited:
+            st.write("移出：" + "、".join(f"{names.get(code, '')}({code})" for code in diff.exited))
+        if not diff.rank_changed.empty:
+            rank_df = diff.rank_changed.copy()
+            rank_df.insert(1, "名称", rank_df['代码'].map(names))
+            st.dataframe(rank_df, hide_index=True)
 
-# 绘制K线图
-def plot_candlestick(df):
-    if df.empty:
-        return go.Figure()
-    
-    # 创建蜡烛图
-    fig = go.Figure()
-    
-    # 添加K线图
-    fig.add_trace(go.Candlestick(
-        x=df['日期'],
-        open=df['开盘'],
-        high=df['最高'],
-        low=df['最低'],
-        close=df['收盘'],
-        name='K线'
-    ))
-    
-    # 添加MA线
-    if 'MA5' in df.columns:
-        fig.add_trace(go.Scatter(
-            x=df['日期'],
-            y=df['MA5'],
-            mode='lines',
-            name='MA5',
-            line=dict(color='blue', width=1)
-        ))
-    
-    if 'MA10' in df.columns:
-        fig.add_trace(go.Scatter(
-            x=df['日期'],
-            y=df['MA10'],
-            mode='lines',
-            name='MA10',
-            line=dict(color='orange', width=1)
-        ))
-    
-    if 'MA20' in df.columns:
-        fig.add_trace(go.Scatter(
-            x=df['日期'],
-            y=df['MA20'],
-            mode='lines',
-            name='MA20',
-            line=dict(color='purple', width=1)
-        ))
-    
-    # 获取月份标签
-    monthly_ticks, monthly_labels = get_monthly_ticks(df)
-    
-    # 设置图表布局
-    fig.update_layout(
-        title='K线图表',
-        xaxis_title='日期',
-        yaxis_title='价格',
-        xaxis_rangeslider_visible=False,
-        height=500,
-        # 配置x轴只显示每个月的第一个交易日
-        xaxis=dict(
-            type='category',  # 使用category类型而不是date类型
-            categoryorder='array',
-            categoryarray=df['日期'].tolist(),  # 确保只显示有数据的日期
-            tickmode='array',
-            tickvals=monthly_ticks,  # 只在月份变化时显示刻度
-            ticktext=monthly_labels,  # 使用月份作为刻度标签
-        ),
-        # 添加网格线以提高可读性
-        xaxis_gridcolor='lightgrey',
-        yaxis_gridcolor='lightgrey',
-        plot_bgcolor='white'
-    )
+# 导出按钮：点击时才分块写出导出文件，平时重跑不生成。返回的文件句柄由Streamlit读取，
+# 本函数不再持有一份文件内容；但Streamlit会把整个文件读入内存中的下载存储再发送，
+# 所以峰值内存约为导出文件大小加一个数据块，不能低于文件大小
+def show_export_button(result_df, fmt, include_history):
+    history_file = f"data_cache/fundamentals/{METRIC_HISTORY_FILE}" if include_history else None
+    file_name = f"选股结果_{datetime.now().strftime('%Y%m%d_%H%M')}.{fmt}"
+    mime = 'text/csv' if fmt == 'csv' else 'application/octet-stream'
     
-    # 设置连线仅在有数据点处显示，不跨越非交易日
-    for trace in fig.data:
-        if trace.type == 'scatter':  # 确保只修改折线图，不影响K线图
-            trace.connectgaps = False
+    def make_export():
+        path = write_export_file(iter_export_chunks(result_df, history_file=history_file), fmt)
+        return ExportFile(path)
     
-    return fig
+    st.download_button(
+        label=f"导出为{fmt.upper()}",
+        data=make_export,
+        file_name=file_name,
+        mime=mime,
+        key="export_download"
+    )
 
-# 绘制成交量图
-def plot_volume(df):
-    if df.empty:
-        return go.Figure()
-    
-    colors = ['red' if row['收盘'] - row['开盘'] >= 0 else 'green' for _, row in df.iterrows()]
-    
-    fig = go.Figure()
-    fig.add_trace(go.Bar(
-        x=df['日期'],
-        y=df['成交量'],
-        marker_color=colors,
-        name='成交量'
-    ))
-    
-    # 获取月份标签
-    monthly_ticks, monthly_labels = get_monthly_ticks(df)
-    
-    fig.update_layout(
-        title='成交量',
-        xaxis_title='日期',
-        yaxis_title='成交量',
-        height=200,
-        # 配置x轴只显示每个月的第一个交易日
-        xaxis=dict(
-            type='category',  # 使用category类型而不是date类型
-            categoryorder='array',
-            categoryarray=df['日期'].tolist(),  # 确保只显示有数据的日期
-            tickmode='array',
-            tickvals=monthly_ticks,  # 只在月份变化时显示刻度
-            ticktext=monthly_labels,  # 使用月份作为刻度标签
-        ),
-        # 添加网格线以提高可读性
-        xaxis_gridcolor='lightgrey',
-        yaxis_gridcolor='lightgrey',
-        plot_bgcolor='white'
+# 后台任务的进度：在片段中每秒刷新一次，不占用脚本线程；任务结束后重跑页面以显示结果
+@st.fragment(run_every=1)
+def show_job_progress(job_id):
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return
+    state = job.snapshot()
+    st.progress(state['progress'])
+    st.text(state['message'])
+    if job.finished:
+        st.rerun()
+
+# 为本地日线仓库获取K线，在后台线程中调用，不使用Streamlit组件
+def fetch_klines_for_store(stock_code, start_date, end_date):
+    try:
+        df = ef.stock.get_quote_history(stock_code, beg=start_date, end=end_date, fqt=0)
+    except Exception:
+        return None
+    if df is None or df.empty:
+        return None
+    # 过滤非交易日（成交量为0的记录）
+    df = df[pd.to_numeric(df['成交量'], errors='coerce') > 0].copy()
+    # 与个股分析页面一致，涨跌幅转换为小数形式
+    df['涨跌幅'] = pd.to_numeric(df['涨跌幅'], errors='coerce') / 100
+    return df
+
+# 技术面选股任务：可选地先增量更新本地日线仓库，再由本地日线批量计算全市场的技术指标截面
+# 截面按仓库的数据版本缓存，数据没有变化时直接复用，同一交易日的信号只计算一次
+def prepare_technical_snapshot(params, job):
+    if params.get('update'):
+        job.report(0.0, "正在获取股票列表...")
+        stock_list = fetch_stock_list(warn=job.note)
+        if stock_list.empty:
+            raise RuntimeError("无法获取股票列表，无法更新本地日线")
+        codes = stock_list['代码'].astype(str).head(params['max_stocks']).tolist()
+        
+        counts = {KLINE_NEW: 0, KLINE_APPENDED: 0, KLINE_REFETCHED: 0}
+        error_count = 0
+        for i, stock_code in enumerate(codes):
+            if i % 10 == 0:
+                job.report(0.8 * i / len(codes), f"正在更新本地日线: {i}/{len(codes)} | 新增: {counts[KLINE_NEW]} | "
+                                                 f"追加: {counts[KLINE_APPENDED]} | 重新获取: {counts[KLINE_REFETCHED]} | 错误: {error_count}")
+            try:
+                _, status = update_klines(stock_code, fetch_klines_for_store)
+                if status in counts:
+                    counts[status] += 1
+            except Exception:
+                error_count += 1
+            
+            # 为避免频繁请求导致API限制，添加短暂延迟
+            if i % 20 == 0 and i > 0:
+                time.sleep(0.2)
+        
+        job.note(f"本地日线更新完成：新增 {counts[KLINE_NEW]} 只，追加 {counts[KLINE_APPENDED]} 只，"
+                 f"重新获取 {counts[KLINE_REFETCHED]} 只，失败 {error_count} 只")
+    
+    version = store_version()
+    snapshot = load_technical_snapshot(version)
+    if snapshot is not None:
+        return snapshot
+    
+    codes = stored_codes()
+    if not codes:
+        raise RuntimeError("本地日线仓库为空，请先更新本地日线")
+    
+    # 读取日线和计算指标都在计算进程池中完成，不占用页面所在进程的GIL
+    job.report(0.8, f"正在读取 {len(codes)} 只股票的本地日线...")
+    arrays, lengths, last_dates, previous_dates = load_stacked_klines(
+        codes, TECHNICAL_BAR_COLUMNS, TECHNICAL_HISTORY_LENGTH, adjust=ADJUST_QFQ
     )
     
-    return fig
-
-# 主程序
-def main():
-    st.set_page_config(
-        page_title="股票分析平台",
-        page_icon="📊",
-        layout="wide",
-        initial_sidebar_state="expanded"
+    job.report(0.9, f"正在计算 {len(codes)} 只股票的技术指标...")
+    snapshot = build_technical_snapshot_from_arrays(
+        codes, arrays, lengths, last_dates, previous_dates, version, compute=compute_indicators_parallel
     )
+    save_technical_snapshot(snapshot)
+    return snapshot
 
-    # 创建选项卡
-    tab1, tab2, tab3 = st.tabs(["板块热力图", "个股分析", "选股工具"])
-    
-    # 热力图选项卡
-    with tab1:
-        st.title("📈 实时板块资金流向热力图")
-        st.markdown("""
-        **数据说明：**
-        - 颜色映射：绿色表示下跌，红色表示上涨
-        - 数据更新：{}
-        """.format(datetime.now().strftime("%Y-%m-%d %H:%M")))
+# 技术面选股的信号模板
+TECHNICAL_PRESETS = {
+    "MA5上穿MA20": "cross_up(MA5, MA20)",
+    "MACD金叉": "cross_up(DIF, DEA)",
+    "KDJ低位金叉": "cross_up(K, D) and K < 30",
+    "RSI超卖且J<0": "RSI < 30 and J < 0",
+    "WR超卖": "WR21 > 80",
+    "自定义": "",
+}
 
-        # 侧边栏控件
-        col1, col2 = st.columns(2)
-        with col1:
-            color_metric = st.selectbox(
-                "颜色指标",
-                options=['涨跌幅','换手率','量价强度'],
-                index=0,
-                key="heatmap_color"
-            )
-            size_metric = st.selectbox(
-                "板块大小指标",
-                options=['成交额（亿）','成交量（万手）','换手率'],
-                index=0,
-                key="heatmap_size"
-            )
-        with col2:
-            date_range = st.slider(
-                "回溯天数",
-                min_value=1,
-                max_value=30,
-                value=7,
-                key="heatmap_days"
-            )
-            color_scale = st.selectbox(
-                "配色方案",
-                options=['RdYlGn_r','BrBG_r','PiYG_r','RdBu_r'], # 全部使用反转色阶
-                index=0,
-                key="heatmap_color_scale"
+# 技术面选股页面
+def show_technical_screener():
+    st.markdown("""
+    ### 使用说明
+    - 基于本地保存的日K线，一次性计算全市场的 MA、MACD、KDJ、RSI、WR 等指标，再按信号条件筛选
+    - 信号条件支持 `cross_up(MA5, MA20)`（当日上穿）、`cross_down(a, b)`（当日下穿）、`prev(J)`（前一交易日的值）
+    - 首次使用请先点击"更新本地日线并选股"，之后只会增量获取新的交易日
+    """)
+    
+    codes = stored_codes()
+    st.caption(f"本地日线仓库: {len(codes)} 只股票")
+    
+    preset = st.selectbox("信号模板", options=list(TECHNICAL_PRESETS), index=0, key="technical_preset")
+    technical_expression = st.text_input(
+        "信号条件",
+        value=TECHNICAL_PRESETS[preset],
+        placeholder="例如：cross_up(MA5, MA20) and RSI < 70",
+        help="可用列: 开盘 收盘 最高 最低 成交量 涨跌幅 MA5 MA10 MA20 DIF DEA MACD K D J RSI WR21",
+        key=f"technical_expression_{preset}"
+    ).strip()
+    
+    with st.expander("数据更新选项"):
+        update_max_stocks = st.slider("更新的最大股票数量", min_value=100, max_value=6000, value=6000, step=100,
+                                      key="technical_max_stocks")
+    
+    job_manager = get_job_manager()
+    button_col1, button_col2 = st.columns(2)
+    with button_col1:
+        if st.button("技术面选股", key="start_technical"):
+            if codes:
+                st.session_state['technical_job_id'] = job_manager.submit(
+                    prepare_technical_snapshot, {'update': False, 'version': store_version()})
+            else:
+                st.warning("本地还没有日线数据，请先更新本地日线")
+    with button_col2:
+        if st.button("更新本地日线并选股", key="update_technical"):
+            # 同一小时内重复点击共享同一个更新任务
+            st.session_state['technical_job_id'] = job_manager.submit(
+                prepare_technical_snapshot,
+                {'update': True, 'max_stocks': update_max_stocks, 'hour': datetime.now().strftime('%Y-%m-%d %H')}
             )
+    
+    technical_job_id = st.session_state.get('technical_job_id')
+    technical_job = job_manager.get(technical_job_id) if technical_job_id else None
+    if technical_job_id and technical_job is None:
+        st.warning("选股任务已过期，请重新选股")
+        del st.session_state['technical_job_id']
+    if technical_job is None:
+        return
+    
+    if not technical_job.finished:
+        st.info(f"技术面选股任务 {technical_job.job_id} 正在后台运行，可切换页面，稍后回来查看结果")
+        show_job_progress(technical_job.job_id)
+        return
+    for note in technical_job.snapshot()['notes']:
+        st.info(note)
+    if technical_job.status == JOB_FAILED:
+        st.error(f"技术面选股任务失败: {technical_job.snapshot()['message']}")
+        return
+    
+    snapshot = technical_job.result
+    if not technical_expression:
+        st.warning("请输入信号条件")
+        return
+    st.caption(f"信号日期: {snapshot.day}，参与计算 {len(snapshot)} 只股票，筛选条件: {technical_expression}")
+    
+    try:
+        positions = snapshot.screen(technical_expression)
+    except ExpressionError as e:
+        st.error(f"信号条件有误: {e}")
+        return
+    
+    if len(positions) == 0:
+        st.warning("当日没有符合条件的股票")
+        return
+    
+    st.success(f"共找到 {len(positions)} 只符合条件的股票")
+    result_df = snapshot.current.iloc[positions].copy()
+    names = get_stock_list().astype({'代码': str}).set_index('代码')['名称']
+    result_df.insert(1, '名称', result_df['代码'].map(names))
+    result_df = result_df.sort_values('涨跌幅', ascending=False) if '涨跌幅' in result_df.columns else result_df
+    st.dataframe(
+        result_df,
+        column_config={
+            "代码": st.column_config.TextColumn(width="small"),
+            "名称": st.column_config.TextColumn(width="medium"),
+        },
+        height=500,
+        hide_index=True
+    )
+    show_export_button(result_df, 'csv', False)
+
+# 热力图选项卡，作为独立片段运行：本选项卡内的控件变化只重跑本选项卡
+@st.fragment
+def show_board_heatmap():
+    st.title("📈 实时板块资金流向热力图")
+    st.markdown("""
+    **数据说明：**
+    - 颜色映射：绿色表示下跌，红色表示上涨
+    - 数据更新：{}
+    """.format(datetime.now().strftime("%Y-%m-%d %H:%M")))
+
+    map_level = st.radio(
+        "热力图层级",
+        options=["行业板块", "全市场个股"],
+        index=0,
+        horizontal=True,
+        help="全市场个股按行业分组，每个行业只显示面积最大的若干只股票，其余合并为“其他”",
+        key="heatmap_level"
+    )
+
+    # 侧边栏控件
+    col1, col2 = st.columns(2)
+    with col1:
+        color_metric = st.selectbox(
+            "颜色指标",
+            options=['涨跌幅','换手率','量价强度'],
+            index=0,
+            key="heatmap_color"
+        )
+        size_metric = st.selectbox(
+            "板块大小指标",
+            options=['成交额（亿）','成交量（万手）','换手率'],
+            index=0,
+            key="heatmap_size"
+        )
+    with col2:
+        date_range = st.slider(
+            "回溯天数",
+            min_value=1,
+            max_value=30,
+            value=7,
+            key="heatmap_days"
+        )
+        color_scale = st.selectbox(
+            "配色方案",
+            options=['RdYlGn_r','BrBG_r','PiYG_r','RdBu_r'], # 全部使用反转色阶
+            index=0,
+            key="heatmap_color_scale"
+        )
 
+    if map_level == "全市场个股":
+        show_market_map(size_metric, color_metric, color_scale)
+    else:
         # 数据加载
         with st.spinner('正在获取最新行情数据...'):
-            raw_df = get_board_data()
-            processed_df = process_data(raw_df)
+            processed_df = get_board_data()
 
         # 数据过滤
         filtered_df = processed_df[
             processed_df['日期'] >= (datetime.now() - timedelta(days=date_range)).strftime("%Y-%m-%d")
             ]
 
-        # 创建可视化
-        fig = px.treemap(
-            filtered_df,
-            path=['板块名称'],
-            values=size_metric,
-            color=color_metric,
-            color_continuous_scale=color_scale,
-            range_color=[filtered_df[color_metric].min(), filtered_df[color_metric].max()],
-            hover_data={
-                '涨跌幅':':.2f%',
-                '换手率':':.2f%',
-                '成交额（亿）':':.2f',
-                '量价强度':':.2f'
-            },
-            height=600
+        live_mode = st.toggle(
+            "实时刷新",
+            value=False,
+            help=f"交易时段每 {LIVE_REFRESH_SECONDS} 秒获取一次全部板块的最新涨跌幅和换手率，只刷新热力图，不重新加载整个页面",
+            key="heatmap_live"
         )
+        if live_mode:
+            st.fragment(show_live_board_treemap, run_every=LIVE_REFRESH_SECONDS)(
+                filtered_df, size_metric, color_metric, color_scale
+            )
+        else:
+            # 创建可视化
+            fig = px.treemap(
+                filtered_df,
+                path=['板块名称'],
+                values=size_metric,
+                color=color_metric,
+                color_continuous_scale=color_scale,
+                range_color=[filtered_df[color_metric].min(), filtered_df[color_metric].max()],
+                hover_data={
+                    '涨跌幅':':.2f%',
+                    '换手率':':.2f%',
+                    '成交额（亿）':':.2f',
+                    '量价强度':':.2f'
+                },
+                height=600
+            )
 
-        # 样式调整
-        fig.update_layout(
-            margin=dict(t=0, l=0, r=0, b=0),
-            coloraxis_colorbar=dict(
-                title=color_metric + (" (%)"if color_metric =="涨跌幅"else""),
-                tickformat=".1f"if color_metric =="涨跌幅"else".1f",
-                thickness=15
+            # 样式调整
+            fig.update_layout(
+                margin=dict(t=0, l=0, r=0, b=0),
+                coloraxis_colorbar=dict(
+                    title=color_metric + (" (%)"if color_metric =="涨跌幅"else""),
+                    tickformat=".1f"if color_metric =="涨跌幅"else".1f",
+                    thickness=15
+                )
             )
-        )
 
-        fig.update_traces(
-            texttemplate='%{label} %{customdata[0]:.2f} % ',
-            hovertemplate = ('<b>%{label}</b>'
-                f'{color_metric}: %{{color:.2f}}{"%" if color_metric == "涨跌幅" else ""}'
-                '换手率: %{customdata[1]:.2f}%'
-                '成交额: %{customdata[2]:.2f}亿'
+            fig.update_traces(
+                texttemplate='%{label} %{customdata[0]:.2f} % ',
+                hovertemplate = ('<b>%{label}</b>'
+                    f'{color_metric}: %{{color:.2f}}{"%" if color_metric == "涨跌幅" else ""}'
+                    '换手率: %{customdata[1]:.2f}%'
+                    '成交额: %{customdata[2]:.2f}亿'
+                )
             )
-        )
 
-        st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(fig, use_container_width=True)
+
+        # 板块下钻：只加载所选板块的成分股和行情
+        drill_options = filtered_df.sort_values(by=size_metric, ascending=False)['板块名称'].drop_duplicates().tolist()
+        drill_board = st.selectbox(
+            "查看板块成分股",
+            options=["不下钻"] + drill_options,
+            index=0,
+            help="选择板块后只获取该板块的成分股及最新行情，按个股绘制矩形树图",
+            key="heatmap_drill_board"
+        )
+        if drill_board != "不下钻":
+            with st.spinner(f"正在获取 {drill_board} 的成分股..."):
+                constituents = get_board_constituents(drill_board)
+            if constituents.empty:
+                st.warning(f"暂无 {drill_board} 的成分股数据")
+            else:
+                st.caption(f"{drill_board}：共 {len(constituents)} 只成分股")
+                st.plotly_chart(
+                    board_treemap(drill_board, constituents, size_metric, color_metric, color_scale),
+                    use_container_width=True
+                )
 
         # 数据表格
-        with st.expander("查看原始数据"):
-            st.dataframe(
-                filtered_df.sort_values(by='涨跌幅', ascending=False),
-                column_config={
-                    "日期":"日期",
-                    "板块名称": st.column_config.TextColumn(width="large"),
-                    "涨跌幅": st.column_config.NumberColumn(format="▁%.2f%%",help="颜色映射："),
-                    "换手率": st.column_config.NumberColumn(format="%.2f%%"),
-                    "成交额（亿）": st.column_config.NumberColumn(format="%.1f 亿")
-                },
-                height=300,
-                hide_index=True
-            )
+        # 折叠时不构建表格，展开后只发送当前页
+        raw_expander = st.expander("查看原始数据", key="board_raw_expander", on_change="rerun")
+        if raw_expander.open:
+            with raw_expander:
+                show_paged_table(
+                    filtered_df,
+                    "board_raw_table",
+                    frame_fingerprint(filtered_df, filtered_df.columns),
+                    sort_column='涨跌幅',
+                    column_config={
+                        "日期":"日期",
+                        "板块名称": st.column_config.TextColumn(width="large"),
+                        "涨跌幅": st.column_config.NumberColumn(format="▁%.2f%%",help="颜色映射："),
+                        "换手率": st.column_config.NumberColumn(format="%.2f%%"),
+                        "成交额（亿）": st.column_config.NumberColumn(format="%.1f 亿")
+                    }
+                )
 
-    # 个股分析选项卡
-    with tab2:
-        st.title("🔍 个股详细分析")
-        
-        # 获取股票列表用于搜索
-        with st.spinner("正在加载股票列表..."):
-            stock_list = get_stock_list()
+
+# 个股分析选项卡，作为独立片段运行：本选项卡内的控件变化只重跑本选项卡
+@st.fragment
+def show_stock_analysis():
+    st.title("🔍 个股详细分析")
+    
+    # 获取股票列表用于搜索
+    with st.spinner("正在加载股票列表..."):
+        stock_list = get_stock_list()
+    
+    if stock_list.empty:
+        st.error("无法获取股票列表，请检查网络连接或刷新页面重试")
+        return
+    
+    # 再次确认列名
+    if '代码' not in stock_list.columns or '名称' not in stock_list.columns:
+        st.error("股票列表数据格式错误，缺少'代码'或'名称'列")
+        # 尝试打印出实际的列名以便调试
+        st.write("实际列名:", stock_list.columns.tolist())
         
-        if stock_list.empty:
-            st.error("无法获取股票列表，请检查网络连接或刷新页面重试")
-            st.stop()
+        # 紧急措施：使用前两列并重命名
+        if len(stock_list.columns) >= 2:
+            cols = stock_list.columns.tolist()
+            st.warning(f"尝试将 '{cols[0]}' 列作为'代码'，'{cols[1]}' 列作为'名称'")
+            stock_list = stock_list.rename(columns={
+                cols[0]: '代码',
+                cols[1]: '名称'
+            })
+        else:
+            return
+    
+    # 创建股票代码和名称的映射字典
+    stock_dict = dict(zip(stock_list['名称'], stock_list['代码']))
+    
+    # 股票选择组件
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        # 添加手动输入股票代码的选项
+        input_option = st.radio(
+            "选择输入方式",
+            options=["从列表选择", "手动输入代码"],
+            index=0,
+            horizontal=True,
+            key="input_method"
+        )
         
-        # 再次确认列名
-        if '代码' not in stock_list.columns or '名称' not in stock_list.columns:
-            st.error("股票列表数据格式错误，缺少'代码'或'名称'列")
-            # 尝试打印出实际的列名以便调试
-            st.write("实际列名:", stock_list.columns.tolist())
-            
-            # 紧急措施：使用前两列并重命名
-            if len(stock_list.columns) >= 2:
-                cols = stock_list.columns.tolist()
-                st.warning(f"尝试将 '{cols[0]}' 列作为'代码'，'{cols[1]}' 列作为'名称'")
-                stock_list = stock_list.rename(columns={
-                    cols[0]: '代码',
-                    cols[1]: '名称'
-                })
+        if input_option == "从列表选择":
+            # 从列表选择股票
+            if len(stock_dict) > 0:
+                selected_stock = st.selectbox(
+                    "选择股票",
+                    options=list(stock_dict.keys()),
+                    key="stock_selector"
+                )
+                if selected_stock:
+                    stock_code = stock_dict[selected_stock]
             else:
-                st.stop()
-        
-        # 创建股票代码和名称的映射字典
-        stock_dict = dict(zip(stock_list['名称'], stock_list['代码']))
-        
-        # 股票选择组件
-        col1, col2 = st.columns([3, 1])
-        with col1:
-            # 添加手动输入股票代码的选项
-            input_option = st.radio(
-                "选择输入方式",
-                options=["从列表选择", "手动输入代码"],
-                index=0,
-                horizontal=True,
-                key="input_method"
+                st.error("股票列表为空，请使用手动输入方式")
+                selected_stock = None
+                stock_code = None
+        else:
+            # 手动输入股票代码
+            stock_code = st.text_input(
+                "输入股票代码（如：000001）",
+                key="manual_stock_code"
             )
-            
-            if input_option == "从列表选择":
-                # 从列表选择股票
-                if len(stock_dict) > 0:
-                    selected_stock = st.selectbox(
-                        "选择股票",
-                        options=list(stock_dict.keys()),
-                        key="stock_selector"
-                    )
-                    if selected_stock:
-                        stock_code = stock_dict[selected_stock]
+            selected_stock = None
+            # 验证输入的股票代码
+            if stock_code:
+                # 尝试在列表中找到对应名称
+                matching_stocks = stock_list[stock_list['代码'] == stock_code]
+                if not matching_stocks.empty:
+                    selected_stock = matching_stocks.iloc[0]['名称']
                 else:
-                    st.error("股票列表为空，请使用手动输入方式")
-                    selected_stock = None
-                    stock_code = None
-            else:
-                # 手动输入股票代码
-                stock_code = st.text_input(
-                    "输入股票代码（如：000001）",
-                    key="manual_stock_code"
-                )
-                selected_stock = None
-                # 验证输入的股票代码
-                if stock_code:
-                    # 尝试在列表中找到对应名称
-                    matching_stocks = stock_list[stock_list['代码'] == stock_code]
-                    if not matching_stocks.empty:
-                        selected_stock = matching_stocks.iloc[0]['名称']
-                    else:
-                        selected_stock = "未知股票"
+                    selected_stock = "未知股票"
+    
+    with col2:
+        days = st.number_input(
+            "数据周期(天)",
+            min_value=5,
+            max_value=STOCK_DAYS_MAX,
+            value=365,
+            key="stock_days"
+        )
+    
+    period_col, adjust_col, indicator_col = st.columns([1, 1, 2])
+    with period_col:
+        kline_period = st.radio(
+            "K线周期",
+            options=list(KLINE_PERIODS),
+            index=0,
+            horizontal=True,
+            help="周/月K线由日K线在本地合并得到，本地日线仓库中有该股票时使用仓库中的全部历史",
+            key="kline_period"
+        )
+    with adjust_col:
+        adjust_mode = st.radio(
+            "复权方式",
+            options=list(ADJUST_MODES),
+            index=0,
+            horizontal=True,
+            key="adjust_mode"
+        )
+    with indicator_col:
+        extra_indicators = st.multiselect(
+            "叠加指标",
+            options=EXTRA_INDICATOR_OPTIONS,
+            default=[],
+            key="extra_indicators"
+        )
+    
+    # 处理股票数据
+    if (selected_stock and input_option == "从列表选择") or (stock_code and input_option == "手动输入代码"):
+        # 确保stock_code是有效的
+        if input_option == "从列表选择":
+            stock_code = stock_dict[selected_stock]
         
-        with col2:
-            days = st.number_input(
-                "数据周期(天)",
-                min_value=5,
-                max_value=365,
-                value=365,
-                key="stock_days"
-            )
+        # 显示股票名称和代码
+        st.subheader(f"{selected_stock or '股票'} ({stock_code})")
         
-        # 处理股票数据
-        if (selected_stock and input_option == "从列表选择") or (stock_code and input_option == "手动输入代码"):
-            # 确保stock_code是有效的
-            if input_option == "从列表选择":
-                stock_code = stock_dict[selected_stock]
-            
-            # 显示股票名称和代码
-            st.subheader(f"{selected_stock or '股票'} ({stock_code})")
-            
-            start_date = (datetime.now() - timedelta(days=days)).strftime("%Y%m%d")
-            end_date = datetime.now().strftime("%Y%m%d")
+        start_date = (datetime.now() - timedelta(days=days)).strftime("%Y%m%d")
+        end_date = datetime.now().strftime("%Y%m%d")
+        
+        # 获取并处理数据
+        with st.spinner(f"正在获取 {selected_stock or stock_code} 数据..."):
+            try:
+                stock_data = get_stock_data(stock_code, start_date, end_date)
+                if not stock_data.empty:
+                    # 复权和周/月K线都在本地由不复权日线计算，不额外请求数据
+                    stock_data = get_display_klines(stock_code, stock_data, ADJUST_MODES[adjust_mode],
+                                                    KLINE_PERIODS[kline_period])
+                if not stock_data.empty:
+                    # 图表的x轴按类别显示日期，这里为本次绘图转换成日期文字，缓存中仍保留datetime64
+                    stock_data = stock_data.assign(日期=stock_data['日期'].dt.strftime('%Y-%m-%d'))
+                    # 计算技术指标（增量更新），结果按K线内容指纹缓存
+                    kline_fingerprint = frame_fingerprint(stock_data)
+                    indicator_df = get_indicator_frame(
+                        f"{stock_code}_{ADJUST_MODES[adjust_mode]}_{KLINE_PERIODS[kline_period] or 'D'}",
+                        kline_fingerprint,
+                        DEFAULT_INDICATORS + tuple(extra_indicators), stock_data
+                    )
+                    stock_data = pd.concat([stock_data, indicator_df], axis=1)
+            except Exception as e:
+                st.error(f"获取数据时出错: {e}")
+                stock_data = pd.DataFrame()
+        
+        if not stock_data.empty:
+            # 显示交易日期范围信息
+            if len(stock_data) > 0:
+                earliest_date = stock_data['日期'].min()
+                latest_date = stock_data['日期'].max()
+                trading_days = len(stock_data)
+                if KLINE_PERIODS[kline_period]:
+                    st.info(f"数据范围: {earliest_date} 至 {latest_date}，共 {trading_days} 根{kline_period}K线")
+                else:
+                    st.info(f"数据范围: {earliest_date} 至 {latest_date}，共 {trading_days} 个交易日")
             
-            # 获取并处理数据
-            with st.spinner(f"正在获取 {selected_stock or stock_code} 数据..."):
-                try:
-                    stock_data = get_stock_data(stock_code, start_date, end_date)
-                    if not stock_data.empty:
-                        # 计算技术指标
-                        stock_data = calculate_indicators(stock_data)
-                except Exception as e:
-                    st.error(f"获取数据时出错: {e}")
-                    stock_data = pd.DataFrame()
+            # K线、成交量和技术指标画在同一张共用x轴的图表中
+            with st.container():
+                st.subheader("K线与技术指标")
+                chart_panels = st.multiselect(
+                    "显示面板",
+                    options=list(INDICATOR_PANELS),
+                    default=list(INDICATOR_PANELS),
+                    key="chart_panels"
+                )
+                extra_columns = [col for col in stock_data.columns
+                                 if col not in INDICATOR_COLUMNS and (col in extra_indicators or col.startswith('BOLL_'))]
+                chart_data = stock_data
+                # K线较多时按图表宽度降采样；缩小显示区间到图表宽度以内即可看到逐根K线
+                if len(stock_data) > CHART_MAX_POINTS:
+                    first_day = datetime.strptime(stock_data['日期'].iloc[0], '%Y-%m-%d').date()
+                    last_day = datetime.strptime(stock_data['日期'].iloc[-1], '%Y-%m-%d').date()
+                    view_start, view_end = st.slider(
+                        "显示区间",
+                        min_value=first_day,
+                        max_value=last_day,
+                        value=(first_day, last_day),
+                        format="YYYY-MM-DD",
+                        key=f"chart_range_{stock_code}_{kline_period}_{days}"
+                    )
+                    chart_data = stock_data[stock_data['日期'].between(view_start.strftime('%Y-%m-%d'),
+                                                                     view_end.strftime('%Y-%m-%d'))]
+                    if len(chart_data) > CHART_MAX_POINTS:
+                        st.caption(f"显示区间内共 {len(chart_data)} 根K线，已按图表宽度合并为约 {CHART_MAX_POINTS} 根"
+                                   f"（指标线保留峰谷），缩小显示区间可查看逐根K线")
+                chart_key = f"{stock_code}_{ADJUST_MODES[adjust_mode]}_{KLINE_PERIODS[kline_period] or 'D'}"
+                kline_spec = get_kline_figure_spec(
+                    chart_key,
+                    kline_fingerprint,
+                    (chart_data['日期'].iloc[0], chart_data['日期'].iloc[-1]) if len(chart_data) else None,
+                    tuple(name for name in INDICATOR_PANELS if name in chart_panels),
+                    tuple(col for col in extra_columns if is_price_overlay(col)),
+                    # 额外选择的非价格类指标（ATR、OBV等）各占一个面板
+                    tuple(col for col in extra_columns if not is_price_overlay(col)),
+                    current_chart_theme(),
+                    chart_data
+                )
+                kline_fig = figure_from_spec(kline_spec)
+                st.plotly_chart(kline_fig, use_container_width=True)
             
-            if not stock_data.empty:
-                # 显示交易日期范围信息
-                if len(stock_data) > 0:
-                    earliest_date = stock_data['日期'].min()
-                    latest_date = stock_data['日期'].max()
-                    trading_days = len(stock_data)
-                    st.info(f"数据范围: {earliest_date} 至 {latest_date}，共 {trading_days} 个交易日")
-                
-                # 绘制K线图
-                with st.container():
-                    st.subheader("K线图")
-                    candlestick_fig = plot_candlestick(stock_data)
-                    st.plotly_chart(candlestick_fig, use_container_width=True)
-                
-                # 绘制成交量图
-                with st.container():
-                    st.subheader("成交量")
-                    volume_fig = plot_volume(stock_data)
-                    st.plotly_chart(volume_fig, use_container_width=True)
-                
-                # 绘制技术指标
-                with st.container():
-                    st.subheader("技术指标")
-                    
-                    # 切换成2行2列布局，每行两个指标
-                    indicator_row1 = st.columns(2)
-                    indicator_row2 = st.columns(2)
-                    
-                    # 获取月份标签
-                    monthly_ticks, monthly_labels = get_monthly_ticks(stock_data)
-                    
-                    # 第一行第一列：MACD
-                    with indicator_row1[0]:
-                        st.write("MACD")
-                        macd_fig = go.Figure()
-                        macd_fig.add_trace(go.Scatter(x=stock_data['日期'], y=stock_data['DIF'], mode='lines', name='DIF', connectgaps=False))
-                        macd_fig.add_trace(go.Scatter(x=stock_data['日期'], y=stock_data['DEA'], mode='lines', name='DEA', connectgaps=False))
-                        macd_fig.add_trace(go.Bar(x=stock_data['日期'], y=stock_data['MACD'], name='MACD柱'))
-                        macd_fig.update_layout(
-                            height=300, 
-                            margin=dict(l=10, r=10, t=30, b=10),
-                            xaxis=dict(
-                                type='category',
-                                categoryorder='array',
-                                categoryarray=stock_data['日期'].tolist(),
-                                tickmode='array',
-                                tickvals=monthly_ticks,  # 使用月份标签
-                                ticktext=monthly_labels,
-                            ),
-                            plot_bgcolor='white',
-                            xaxis_gridcolor='lightgrey',
-                            yaxis_gridcolor='lightgrey'
-                        )
-                        st.plotly_chart(macd_fig, use_container_width=True)
-                    
-                    # 第一行第二列：KDJ
-                    with indicator_row1[1]:
-                        st.write("KDJ")
-                        kdj_fig = go.Figure()
-                        kdj_fig.add_trace(go.Scatter(x=stock_data['日期'], y=stock_data['K'], mode='lines', name='K', connectgaps=False))
-                        kdj_fig.add_trace(go.Scatter(x=stock_data['日期'], y=stock_data['D'], mode='lines', name='D', connectgaps=False))
-                        kdj_fig.add_trace(go.Scatter(x=stock_data['日期'], y=stock_data['J'], mode='lines', name='J', connectgaps=False))
-                        kdj_fig.update_layout(
-                            height=300, 
-                            margin=dict(l=10, r=10, t=30, b=10),
-                            xaxis=dict(
-                                type='category',
-                                categoryorder='array',
-                                categoryarray=stock_data['日期'].tolist(),
-                                tickmode='array',
-                                tickvals=monthly_ticks,  # 使用月份标签
-                                ticktext=monthly_labels,
-                            ),
-                            plot_bgcolor='white',
-                            xaxis_gridcolor='lightgrey',
-                            yaxis_gridcolor='lightgrey'
-                        )
-                        st.plotly_chart(kdj_fig, use_container_width=True)
-                    
-                    # 第二行第一列：RSI
-                    with indicator_row2[0]:
-                        st.write("RSI")
-                        rsi_fig = go.Figure()
-                        rsi_fig.add_trace(go.Scatter(x=stock_data['日期'], y=stock_data['RSI'], mode='lines', name='RSI', connectgaps=False))
-                        # 添加超买超卖参考线
-                        rsi_fig.add_shape(type="line", x0=stock_data['日期'].iloc[0], y0=70, x1=stock_data['日期'].iloc[-1], y1=70,
-                                        line=dict(color="red", width=1, dash="dash"))
-                        rsi_fig.add_shape(type="line", x0=stock_data['日期'].iloc[0], y0=30, x1=stock_data['日期'].iloc[-1], y1=30,
-                                        line=dict(color="green", width=1, dash="dash"))
-                        rsi_fig.update_layout(
-                            height=300, 
-                            margin=dict(l=10, r=10, t=30, b=10),
-                            xaxis=dict(
-                                type='category',
-                                categoryorder='array',
-                                categoryarray=stock_data['日期'].tolist(),
-                                tickmode='array',
-                                tickvals=monthly_ticks,  # 使用月份标签
-                                ticktext=monthly_labels,
-                            ),
-                            plot_bgcolor='white',
-                            xaxis_gridcolor='lightgrey',
-                            yaxis_gridcolor='lightgrey'
-                        )
-                        st.plotly_chart(rsi_fig, use_container_width=True)
-                        
-                    # 第二行第二列：威廉WR指标
-                    with indicator_row2[1]:
-                        st.write("威廉WR指标")
-                        wr_fig = go.Figure()
-                        wr_fig.add_trace(go.Scatter(x=stock_data['日期'], y=stock_data['WR21'], mode='lines', name='WR(21)', connectgaps=False))
-                        
-                        # 添加超买超卖参考线（取绝对值后，原来的-20变成20，-80变成80）
-                        wr_fig.add_shape(type="line", x0=stock_data['日期'].iloc[0], y0=20, x1=stock_data['日期'].iloc[-1], y1=20,
-                                        line=dict(color="red", width=1, dash="dash"))
-                        wr_fig.add_shape(type="line", x0=stock_data['日期'].iloc[0], y0=80, x1=stock_data['日期'].iloc[-1], y1=80,
-                                        line=dict(color="green", width=1, dash="dash"))
-                        
-                        wr_fig.update_layout(
-                            height=300, 
-                            margin=dict(l=10, r=10, t=30, b=10),
-                            xaxis=dict(
-                                type='category',
-                                categoryorder='array',
-                                categoryarray=stock_data['日期'].tolist(),
-                                tickmode='array',
-                                tickvals=monthly_ticks,  # 使用月份标签
-                                ticktext=monthly_labels,
-                            ),
-                            yaxis=dict(
-                                range=[0, 100],  # 取绝对值后，范围变为0到100
-                                autorange=False
-                            ),
-                            plot_bgcolor='white',
-                            xaxis_gridcolor='lightgrey',
-                            yaxis_gridcolor='lightgrey'
-                        )
-                        st.plotly_chart(wr_fig, use_container_width=True)
-                
-                # 显示近期数据
-                with st.expander("查看历史交易数据（仅交易日）"):
-                    st.dataframe(
-                        stock_data.sort_values('日期', ascending=False),
-                        height=300
+            # 显示近期数据：折叠时不构建表格，展开后只发送当前页，默认不显示指标的中间列
+            history_expander = st.expander("查看历史交易数据（仅交易日）", key="kline_history_expander",
+                                           on_change="rerun")
+            if history_expander.open:
+                with history_expander:
+                    show_paged_table(
+                        stock_data,
+                        "kline_history_table",
+                        f"{kline_fingerprint}_{'_'.join(extra_indicators)}",
+                        sort_column='日期',
+                        default_columns=KLINE_TABLE_COLUMNS
                     )
-            else:
-                st.error(f"未能获取到 {selected_stock} 的数据，请尝试其他股票。")
+        else:
+            st.error(f"未能获取到 {selected_stock} 的数据，请尝试其他股票。")
+
+
+# 选股工具选项卡，作为独立片段运行：本选项卡内的控件变化只重跑本选项卡
+@st.fragment
+def show_stock_screener():
+    st.title("🔎 多维度选股工具")
     
-    # 选股工具选项卡
-    with tab3:
-        st.title("🔎 多维度选股工具")
-        
+    screen_mode = st.radio("选股方式", options=["基本面选股", "技术面选股"], index=0, horizontal=True, key="screen_mode")
+    if screen_mode == "技术面选股":
+        show_technical_screener()
+    else:
         st.markdown("""
         ### 使用说明
         - 设置下面的筛选条件，系统将为您从A股市场筛选符合条件的股票
         - 留空或设置为0表示不限制该条件
+        - 可在"自定义条件"中书写组合表达式，如 `ROE > 15 and 市盈率 < 30 and 净利润增长率 > 营收增长率`
         - 为提高性能，系统将只处理部分股票
         - 筛选可能需要一些时间，请耐心等待
         """)
-        
+    
         # 筛选条件输入
         col1, col2, col3 = st.columns(3)
-        
+    
         with col1:
             st.subheader("市盈率(PE)")
             pe_min = st.number_input("最小PE", min_value=0.0, max_value=1000.0, value=0.0, step=1.0)
             pe_max = st.number_input("最大PE", min_value=0.0, max_value=1000.0, value=50.0, step=1.0)
-        
+    
         with col2:
             st.subheader("市净率(PB)")
             pb_min = st.number_input("最小PB", min_value=0.0, max_value=100.0, value=0.0, step=0.1)
             pb_max = st.number_input("最大PB", min_value=0.0, max_value=100.0, value=5.0, step=0.1)
-        
+    
         with col3:
             st.subheader("其他指标")
             roe_min = st.number_input("最小ROE(%)", min_value=0.0, max_value=100.0, value=10.0, step=1.0)
             growth_min = st.number_input("最小营收增长率(%)", min_value=-100.0, max_value=1000.0, value=5.0, step=1.0)
-            
+    
+        # 自定义组合条件，与上面的基础条件同时生效
+        custom_expression = st.text_input(
+            "自定义条件（可选）",
+            placeholder="例如：ROE > 15 and 市盈率 < 30 and 净利润增长率 > 营收增长率",
+            help="支持 > >= < <= == != 比较，and/or/not 组合，+ - * / 运算及 abs/min/max 函数；"
+                 "含括号的列名请用反引号包裹，如 `营收增长率(%)`",
+            key="screen_expression"
+        )
+        screen_predicates = build_basic_predicates(pe_min, pe_max, pb_min, pb_max, roe_min, growth_min)
+        custom_expression = custom_expression.strip()
+    
         # 添加高级选项
         with st.expander("高级选项"):
             max_stocks = st.slider("最大处理股票数量", min_value=50, max_value=500, value=200, step=50,
                                 help="增加此值会提高筛选结果的全面性，但会降低性能")
-        
-        # 开始筛选按钮
+    
+        # 开始筛选按钮：提交后台任务汇总股票池基本面，相同股票池的任务在所有会话间共享
+        job_manager = get_job_manager()
         if st.button("开始筛选", key="start_filter"):
-            # 执行筛选
-            result_df = filter_stocks(pe_min, pe_max, pb_min, pb_max, roe_min, growth_min, max_stocks)
+            st.session_state['screen_job_id'] = job_manager.submit(load_fundamentals_universe, {'max_stocks': max_stocks})
+    
+        screen_job_id = st.session_state.get('screen_job_id')
+        screen_job = job_manager.get(screen_job_id) if screen_job_id else None
+        if screen_job_id and screen_job is None:
+            st.warning("筛选任务已过期，请重新筛选")
+            del st.session_state['screen_job_id']
+    
+        if screen_job is not None:
+            if not screen_job.finished:
+                st.info(f"筛选任务 {screen_job.job_id} 正在后台运行，可切换页面，稍后回来查看结果")
+                show_job_progress(screen_job.job_id)
+            else:
+                for note in screen_job.snapshot()['notes']:
+                    st.info(note)
+        
+            if screen_job.status == JOB_FAILED:
+                st.error(f"筛选任务失败: {screen_job.snapshot()['message']}")
+            elif screen_job.status == JOB_DONE:
+                universe_df = screen_job.result
+            
+                condition_text = describe_predicates(screen_predicates)
+                if custom_expression:
+                    condition_text = f"{condition_text} and ({custom_expression})"
+                st.caption(f"筛选条件: {condition_text}")
             
-            # 显示结果
-            if not result_df.empty:
-                st.success(f"共找到 {len(result_df)} 只符合条件的股票")
-                
                 # 添加排序选项
-                sort_column = st.selectbox(
-                    "排序依据",
-                    options=["ROE(%)", "市盈率", "市净率", "营收增长率(%)", "净利润增长率(%)"],
-                    index=0
-                )
+                sort_col1, sort_col2, sort_col3 = st.columns(3)
+                with sort_col1:
+                    sort_column = st.selectbox(
+                        "排序依据",
+                        options=["ROE(%)", "市盈率", "市净率", "营收增长率(%)", "净利润增长率(%)"],
+                        index=0
+                    )
+                with sort_col2:
+                    sort_order = st.radio(
+                        "排序方式",
+                        options=["降序", "升序"],
+                        index=0,
+                        horizontal=True
+                    )
+                with sort_col3:
+                    top_n = st.number_input("显示前N只（0为全部）", min_value=0, max_value=5000, value=0, step=10)
+            
+                # 结果由增量选股器给出：股票池没有刷新时不再求值，命中股票已按排序列排好
+                try:
+                    hits, diff = refresh_screen(universe_df, screen_predicates, custom_expression, condition_text,
+                                                sort_column, sort_order=="升序", screen_job.job_id)
+                    expression_ok = True
+                except ExpressionError as e:
+                    st.error(f"筛选条件有误: {e}")
+                    hits, diff = universe_df.iloc[:0], None
+                    expression_ok = False
+            
+                # 显示结果
+                if expression_ok and len(hits) > 0:
+                    st.success(f"共找到 {len(hits)} 只符合条件的股票")
+                    result_df = hits.head(int(top_n)) if top_n > 0 else hits
                 
-                sort_order = st.radio(
-                    "排序方式",
-                    options=["降序", "升序"],
-                    index=0,
-                    horizontal=True
-                )
+                    # 显示筛选结果
+                    st.dataframe(
+                        result_df,
+                        column_config={
+                            "代码": st.column_config.TextColumn(width="small"),
+                            "名称": st.column_config.TextColumn(width="medium"),
+                            "市盈率": st.column_config.NumberColumn(format="%.2f"),
+                            "市净率": st.column_config.NumberColumn(format="%.2f"),
+                            "ROE(%)": st.column_config.NumberColumn(format="%.2f%%"),
+                            "营收增长率(%)": st.column_config.NumberColumn(format="%.2f%%"),
+                            "净利润增长率(%)": st.column_config.NumberColumn(format="%.2f%%")
+                        },
+                        height=500,
+                        hide_index=True
+                    )
                 
-                # 显示筛选结果
-                st.dataframe(
-                    result_df.sort_values(by=sort_column, ascending=(sort_order=="升序")),
-                    column_config={
-                        "代码": st.column_config.TextColumn(width="small"),
-                        "名称": st.column_config.TextColumn(width="medium"),
-                        "市盈率": st.column_config.NumberColumn(format="%.2f"),
-                        "市净率": st.column_config.NumberColumn(format="%.2f"),
-                        "ROE(%)": st.column_config.NumberColumn(format="%.2f%%"),
-                        "营收增长率(%)": st.column_config.NumberColumn(format="%.2f%%"),
-                        "净利润增长率(%)": st.column_config.NumberColumn(format="%.2f%%")
-                    },
-                    height=500,
-                    hide_index=True
-                )
+                    # 与上次筛选结果比较
+                    show_screen_diff(diff, universe_df)
                 
-                # 提供导出功能
-                csv = result_df.to_csv(index=False).encode('utf-8')
-                st.download_button(
-                    label="导出为CSV",
-                    data=csv,
-                    file_name=f"选股结果_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
-                    mime='text/csv',
-                )
-            else:
-                st.warning("未找到符合条件的股票，请尝试放宽筛选条件")
+                    # 提供导出功能：文件只在点击时分块生成，平时重跑不产生任何导出开销
+                    export_col1, export_col2 = st.columns(2)
+                    with export_col1:
+                        export_format = st.radio(
+                            "导出格式",
+                            options=["CSV", "Parquet"] if PARQUET_AVAILABLE else ["CSV"],
+                            index=0,
+                            horizontal=True,
+                            key="export_format"
+                        )
+                    with export_col2:
+                        export_history = st.checkbox("包含指标历史", value=False, key="export_history",
+                                                     help="附带每只命中股票历次刷新时记录的基本面指标")
+                    show_export_button(result_df, export_format.lower(), export_history)
+                elif expression_ok:
+                    st.warning("未找到符合条件的股票，请尝试放宽筛选条件")
+
+
+# 进程内只启动一个导出文件清理线程，定时删除过期的导出文件
+@st.cache_resource
+def get_export_cleaner():
+    return start_export_cleaner()
+
+# 主程序
+def main():
+    st.set_page_config(
+        page_title="股票分析平台",
+        page_icon="📊",
+        layout="wide",
+        initial_sidebar_state="expanded"
+    )
+    get_export_cleaner()
+
+    # 创建选项卡：切换选项卡时重跑页面，只有当前选项卡的内容会执行，其余选项卡不获取数据也不计算
+    tab1, tab2, tab3 = st.tabs(["板块热力图", "个股分析", "选股工具"], key="main_tab", on_change="rerun")
+    
+    with tab1:
+        if tab1.open:
+            show_board_heatmap()
+    
+    with tab2:
+        if tab2.open:
+            show_stock_analysis()
+    
+    with tab3:
+        if tab3.open:
+            show_stock_screener()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,947 @@
+"""
+批量技术指标计算引擎
+
+把多只股票的K线对齐成 (股票数 × 交易日数) 的二维数组，一次性向量化计算
+MA、MACD、KDJ、RSI、WR 等指标，结果与 calculate_indicators 原先的 pandas 实现一致。
+一维数组按单只股票处理。
+
+对齐方式：各股票按最后一个交易日右对齐，较短的序列在左侧补NaN。
+补在前面的NaN不会影响指标的计算结果（与单独计算每只股票相同）。
+"""
+import hashlib
+import math
+import os
+import pickle
+import re
+import threading
+from collections import deque
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# 指标计算需要的K线列
+PRICE_COLUMNS = ("收盘", "最高", "最低")
+
+# 引擎输出的指标列
+INDICATOR_COLUMNS = ("MA5", "MA10", "MA20", "DIF", "DEA", "MACD", "K", "D", "J", "RSI", "WR21")
+
+
+def _as_2d(values):
+    values = np.asarray(values, dtype=float)
+    return values[np.newaxis, :] if values.ndim == 1 else values
+
+
+def _restore_dim(result, ndim):
+    return result[0] if ndim == 1 else result
+
+
+def rolling_mean(values, window):
+    """
+    沿最后一维计算滚动均值，窗口内有效值不足时结果为NaN（等同 rolling(window).mean()）
+
+    与 pandas 一样使用带补偿的滑动求和（Kahan求和），保证结果逐位一致。
+    """
+    values = np.asarray(values, dtype=float)
+    data = np.ascontiguousarray(_as_2d(values).T)
+    out = np.empty_like(data)
+    width = data.shape[1]
+
+    nobs = np.zeros(width)
+    neg_ct = np.zeros(width)
+    sum_x = np.zeros(width)
+    comp_add = np.zeros(width)
+    comp_remove = np.zeros(width)
+    same_count = np.zeros(width)
+    prev_value = data[0].copy() if len(data) else np.zeros(width)
+
+    for i in range(data.shape[0]):
+        if i >= window:
+            # 移出窗口的值
+            old = data[i - window]
+            valid = ~np.isnan(old)
+            y = np.where(valid, -old - comp_remove, 0.0)
+            t = sum_x + y
+            comp_remove = np.where(valid, t - sum_x - y, comp_remove)
+            sum_x = np.where(valid, t, sum_x)
+            nobs -= valid
+            neg_ct -= valid & np.signbit(old)
+
+        # 加入窗口的值
+        val = data[i]
+        valid = ~np.isnan(val)
+        y = np.where(valid, val - comp_add, 0.0)
+        t = sum_x + y
+        comp_add = np.where(valid, t - sum_x - y, comp_add)
+        sum_x = np.where(valid, t, sum_x)
+        nobs += valid
+        neg_ct += valid & np.signbit(val)
+        same_count = np.where(valid, np.where(val == prev_value, same_count + 1, 1), same_count)
+        prev_value = np.where(valid, val, prev_value)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result = sum_x / nobs
+        # 连续相同的值直接取该值，避免浮点误差；全正/全负窗口不允许出现符号翻转
+        result = np.where(same_count >= nobs, prev_value, result)
+        result = np.where((neg_ct == 0) & (result < 0), 0.0, result)
+        result = np.where((neg_ct == nobs) & (result > 0), 0.0, result)
+        out[i] = np.where((nobs >= window) & (nobs > 0), result, np.nan)
+
+    return _restore_dim(np.ascontiguousarray(out.T), values.ndim)
+
+
+def _block_extrema(data, window, ufunc, fill):
+    """
+    van Herk/Gil-Werman算法：按窗口长度分块，块内前缀与后缀极值各累计一次，
+    任一窗口恰好跨越相邻两块，取一个后缀值和一个前缀值即可，与窗口大小无关
+    """
+    rows, n = data.shape
+    length = n + window - 1
+    padded_length = -(-length // window) * window
+    padded = np.full((rows, padded_length), fill)
+    padded[:, window - 1:length] = data
+    blocks = padded.reshape(rows, -1, window)
+    prefix = ufunc.accumulate(blocks, axis=2).reshape(rows, -1)
+    suffix = ufunc.accumulate(blocks[:, :, ::-1], axis=2)[:, :, ::-1].reshape(rows, -1)
+    return ufunc(suffix[:, :n], prefix[:, window - 1:length])
+
+
+def rolling_extrema(values, windows, kind="max", min_periods=None):
+    """
+    沿最后一维一次计算多个窗口的滚动最大/最小值，返回 {窗口: 数组}
+
+    NaN的处理与 pandas 的 rolling(window, min_periods).max()/min() 一致：
+    窗口内有效值个数不足 min_periods（默认等于窗口长度）时结果为NaN，否则忽略NaN。
+    与 pandas 相同，±inf 也按NaN处理。
+    每个窗口的耗时都是 O(n)，有效值计数等预处理在多个窗口间共享。
+    """
+    if kind == "max":
+        ufunc, fill = np.maximum, -np.inf
+    elif kind == "min":
+        ufunc, fill = np.minimum, np.inf
+    else:
+        raise ValueError(f"kind 只能是 'max' 或 'min'，不支持 '{kind}'")
+
+    values = np.asarray(values, dtype=float)
+    data = _as_2d(values)
+    valid = np.isfinite(data)
+    filled = np.where(valid, data, fill)
+    counts = np.zeros((data.shape[0], data.shape[1] + 1), dtype=np.int64)
+    np.cumsum(valid, axis=1, out=counts[:, 1:])
+
+    result = {}
+    for window in windows:
+        if window < 1:
+            raise ValueError(f"窗口长度必须为正整数: {window}")
+        required = max(window if min_periods is None else min_periods, 1)
+        out = _block_extrema(filled, window, ufunc, fill)
+        count = counts[:, 1:].copy()
+        if window < data.shape[1]:
+            count[:, window:] -= counts[:, 1:data.shape[1] + 1 - window]
+        out[count < required] = np.nan
+        result[window] = _restore_dim(out, values.ndim)
+    return result
+
+
+def rolling_max(values, window, min_periods=None):
+    """
+    沿最后一维计算滚动最大值（等同 rolling(window, min_periods).max()）
+    """
+    return rolling_extrema(values, (window,), "max", min_periods)[window]
+
+
+def rolling_min(values, window, min_periods=None):
+    """
+    沿最后一维计算滚动最小值（等同 rolling(window, min_periods).min()）
+    """
+    return rolling_extrema(values, (window,), "min", min_periods)[window]
+
+
+def ewm_alpha(com=None, span=None, alpha=None):
+    """
+    按 pandas 的换算方式得到平滑系数：先统一换算为com，再由 1 / (1 + com) 得到alpha
+    """
+    if span is not None:
+        com = (span - 1) / 2.0
+    elif alpha is not None:
+        com = (1 - alpha) / alpha
+    if com is None:
+        raise ValueError("必须指定 com、span 或 alpha 之一")
+    return 1.0 / (1.0 + com)
+
+
+def ewm_mean(values, alpha):
+    """
+    沿最后一维计算指数加权均值，等同 pandas 的 ewm(adjust=False).mean()，
+    alpha 应由 ewm_alpha 换算得到
+
+    按时间逐日递推、在股票维度上向量化，完全复刻 pandas 对NaN的处理：
+    序列从第一个有效值开始，遇到NaN时沿用上一个值，但权重照常衰减。
+    """
+    values = np.asarray(values, dtype=float)
+    # 转置为 (交易日, 股票) 的连续数组，逐日取一行
+    data = np.ascontiguousarray(_as_2d(values).T)
+    out = np.empty_like(data)
+    old_wt_factor = 1.0 - alpha
+    new_wt = alpha
+
+    weighted = data[0].copy()
+    old_wt = np.ones_like(weighted)
+    out[0] = weighted
+    for i in range(1, data.shape[0]):
+        cur = data[i]
+        is_observation = ~np.isnan(cur)
+        started = ~np.isnan(weighted)
+
+        old_wt = np.where(started, old_wt * old_wt_factor, old_wt)
+        update = started & is_observation & (weighted != cur)
+        blended = (old_wt * weighted + new_wt * cur) / (old_wt + new_wt)
+        weighted = np.where(update, blended, weighted)
+        old_wt = np.where(started & is_observation, 1.0, old_wt)
+        # 尚未开始的序列遇到第一个有效值
+        weighted = np.where(~started & is_observation, cur, weighted)
+        out[i] = weighted
+
+    return _restore_dim(np.ascontiguousarray(out.T), values.ndim)
+
+
+def diff(values):
+    """
+    沿最后一维计算一阶差分，首个元素为NaN（等同 Series.diff()）
+    """
+    values = np.asarray(values, dtype=float)
+    data = _as_2d(values)
+    out = np.full(data.shape, np.nan)
+    out[:, 1:] = data[:, 1:] - data[:, :-1]
+    return _restore_dim(out, values.ndim)
+
+
+def rolling_std(values, window):
+    """
+    沿最后一维计算滚动标准差（样本标准差，ddof=1），窗口内存在NaN或数据不足时为NaN
+    """
+    values = np.asarray(values, dtype=float)
+    data = _as_2d(values)
+    out = np.full(data.shape, np.nan)
+    if data.shape[1] >= window:
+        out[:, window - 1:] = sliding_window_view(data, window, axis=1).std(axis=-1, ddof=1)
+    return _restore_dim(out, values.ndim)
+
+
+def shift(values, periods=1):
+    """
+    沿最后一维向后平移，空出的位置为NaN（等同 Series.shift(periods)）
+    """
+    values = np.asarray(values, dtype=float)
+    data = _as_2d(values)
+    out = np.full(data.shape, np.nan)
+    if periods < data.shape[1]:
+        out[:, periods:] = data[:, :data.shape[1] - periods]
+    return _restore_dim(out, values.ndim)
+
+
+def nan_cumsum(values):
+    """
+    沿最后一维累加，NaN按0处理
+    """
+    return np.cumsum(np.nan_to_num(np.asarray(values, dtype=float), nan=0.0), axis=-1)
+
+
+# ---------------------------------------------------------------------------
+# 指标注册表：每个指标声明输入和参数，构成依赖图，按需求值
+# ---------------------------------------------------------------------------
+
+class Node:
+    """
+    指标依赖图中的节点
+
+    节点按 (运算, 参数) 的结构判等，结构相同的中间结果（如同一列的同一窗口滚动极值、
+    同一周期的EMA）在一次求值中只计算一次。支持 + - * / 和 abs() 组合节点。
+    """
+    __slots__ = ("op", "args", "key")
+
+    def __init__(self, op, *args):
+        self.op = op
+        self.args = args
+        self.key = (op,) + tuple(arg.key if isinstance(arg, Node) else ("const", arg) for arg in args)
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        return isinstance(other, Node) and self.key == other.key
+
+    def __repr__(self):
+        return f"Node{self.key}"
+
+    def __add__(self, other):
+        return Node("add", self, other)
+
+    def __radd__(self, other):
+        return Node("add", other, self)
+
+    def __sub__(self, other):
+        return Node("sub", self, other)
+
+    def __rsub__(self, other):
+        return Node("sub", other, self)
+
+    def __mul__(self, other):
+        return Node("mul", self, other)
+
+    def __rmul__(self, other):
+        return Node("mul", other, self)
+
+    def __truediv__(self, other):
+        return Node("div", self, other)
+
+    def __rtruediv__(self, other):
+        return Node("div", other, self)
+
+    def __neg__(self):
+        return Node("neg", self)
+
+    def __abs__(self):
+        return Node("abs", self)
+
+
+# 节点运算的实现
+NODE_OPS = {
+    "input": None,
+    "add": np.add,
+    "sub": np.subtract,
+    "mul": np.multiply,
+    "div": np.divide,
+    "neg": np.negative,
+    "abs": np.abs,
+    "maximum": np.maximum,
+    "sign": np.sign,
+    "clip": np.clip,
+    "rolling_mean": rolling_mean,
+    "rolling_max": rolling_max,
+    "rolling_min": rolling_min,
+    "rolling_std": rolling_std,
+    "ewm": ewm_mean,
+    "diff": diff,
+    "shift": shift,
+    "cumsum": nan_cumsum,
+}
+
+
+def col(name):
+    """
+    输入列节点，name 为K线中的列名，如 "收盘"
+    """
+    return Node("input", name)
+
+
+CLOSE = col("收盘")
+OPEN = col("开盘")
+HIGH = col("最高")
+LOW = col("最低")
+VOLUME = col("成交量")
+
+
+def sma(node, window):
+    return Node("rolling_mean", node, window)
+
+
+def ema(node, com=None, span=None, alpha=None):
+    return Node("ewm", node, ewm_alpha(com=com, span=span, alpha=alpha))
+
+
+def highest(node, window):
+    return Node("rolling_max", node, window)
+
+
+def lowest(node, window):
+    return Node("rolling_min", node, window)
+
+
+def stddev(node, window):
+    return Node("rolling_std", node, window)
+
+
+def delta(node):
+    return Node("diff", node)
+
+
+def ref(node, periods=1):
+    return Node("shift", node, periods)
+
+
+def clip(node, lower=None, upper=None):
+    return Node("clip", node, lower, upper)
+
+
+def maximum(a, b):
+    return Node("maximum", a, b)
+
+
+def evaluate_nodes(nodes, arrays):
+    """
+    对一组节点求值，返回 {节点: 数组}；共享的中间节点只计算一次
+    """
+    memo = {}
+
+    def run(node):
+        if not isinstance(node, Node):
+            return node
+        if node in memo:
+            return memo[node]
+        if node.op == "input":
+            name = node.args[0]
+            if name not in arrays:
+                raise KeyError(f"缺少指标计算所需的列 '{name}'")
+            value = np.asarray(arrays[name], dtype=float)
+        else:
+            value = NODE_OPS[node.op](*[run(arg) for arg in node.args])
+        memo[node] = value
+        return value
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {node: run(node) for node in nodes}
+
+
+class IndicatorSpec:
+    """
+    指标定义：build(**params) 返回 {输出列名: 节点}
+    """
+
+    def __init__(self, name, build, params=None, pattern=None, param_name=None, description=""):
+        self.name = name
+        self.build = build
+        self.params = dict(params or {})
+        self.pattern = re.compile(pattern) if pattern else None
+        self.param_name = param_name
+        self.description = description
+
+    def outputs(self, **params):
+        merged = dict(self.params, **params)
+        return self.build(**merged)
+
+
+class IndicatorRegistry:
+    """
+    指标注册表
+
+    - register: 注册指标，声明默认参数；pattern 用于 MA30、ATR20 之类带参数的名称
+    - compute: 只计算请求的指标，共享的中间结果只算一次
+    请求的名称可以是指标名（如 KDJ，返回全部输出）或输出列名（如 K、BOLL_UP、MA30）。
+    """
+
+    def __init__(self):
+        self._specs = {}
+
+    def register(self, name, build, params=None, pattern=None, param_name=None, description=""):
+        self._specs[name] = IndicatorSpec(name, build, params, pattern, param_name, description)
+        return self._specs[name]
+
+    def indicator(self, name, params=None, pattern=None, param_name=None, description=""):
+        """
+        以装饰器方式注册指标
+        """
+        def decorator(build):
+            self.register(name, build, params, pattern, param_name, description)
+            return build
+        return decorator
+
+    @property
+    def names(self):
+        return list(self._specs)
+
+    def resolve(self, name):
+        """
+        把请求的名称解析为 {输出列名: 节点}
+        """
+        spec = self._specs.get(name)
+        if spec is not None:
+            return spec.outputs()
+        # 默认参数下的输出列名，如 K、DIF、BOLL_UP
+        for spec in self._specs.values():
+            outputs = spec.outputs()
+            if name in outputs:
+                return {name: outputs[name]}
+        # 带参数的名称，如 MA30、ATR20
+        for spec in self._specs.values():
+            if spec.pattern is None:
+                continue
+            match = spec.pattern.fullmatch(name)
+            if match:
+                outputs = spec.outputs(**{spec.param_name: int(match.group(1))})
+                return {name: outputs[name]} if name in outputs else outputs
+        raise KeyError(f"未注册的指标 '{name}'")
+
+    def build(self, names):
+        """
+        把请求的名称列表解析为按请求顺序排列的 {输出列名: 节点}
+        """
+        outputs = {}
+        for name in names:
+            outputs.update(self.resolve(name))
+        return outputs
+
+    def compute(self, arrays, names):
+        """
+        计算请求的指标，arrays 为 {列名: 一维或二维数组}，返回 {输出列名: 数组}
+        """
+        outputs = self.build(names)
+        values = evaluate_nodes(list(outputs.values()), arrays)
+        return {name: values[node] for name, node in outputs.items()}
+
+
+registry = IndicatorRegistry()
+
+
+@registry.indicator("MA", params={"window": 5}, pattern=r"MA(\d+)", param_name="window", description="简单移动平均")
+def _build_ma(window):
+    return {f"MA{window}": sma(CLOSE, window)}
+
+
+@registry.indicator("EMA", params={"window": 12}, pattern=r"EMA(\d+)", param_name="window", description="指数移动平均")
+def _build_ema(window):
+    return {f"EMA{window}": ema(CLOSE, span=window)}
+
+
+@registry.indicator("MACD", params={"fast": 12, "slow": 26, "signal": 9}, description="平滑异同移动平均")
+def _build_macd(fast, slow, signal):
+    dif = ema(CLOSE, span=fast) - ema(CLOSE, span=slow)
+    dea = ema(dif, span=signal)
+    return {"DIF": dif, "DEA": dea, "MACD": 2 * (dif - dea)}
+
+
+@registry.indicator("KDJ", params={"window": 9}, description="随机指标")
+def _build_kdj(window):
+    low_n = lowest(LOW, window)
+    high_n = highest(HIGH, window)
+    rsv = (CLOSE - low_n) / (high_n - low_n) * 100
+    k = ema(rsv, alpha=1 / 3)
+    d = ema(k, alpha=1 / 3)
+    return {"K": k, "D": d, "J": 3 * k - 2 * d}
+
+
+@registry.indicator("RSI", params={"window": 14}, pattern=r"RSI(\d+)", param_name="window", description="相对强弱指标")
+def _build_rsi(window):
+    change = delta(CLOSE)
+    up = clip(change, lower=0)
+    down = -1 * clip(change, upper=0)
+    rs = ema(up, com=window - 1) / ema(down, com=window - 1)
+    name = "RSI" if window == 14 else f"RSI{window}"
+    return {name: 100 - (100 / (1 + rs))}
+
+
+@registry.indicator("WR", params={"window": 21}, pattern=r"WR(\d+)", param_name="window", description="威廉指标（取绝对值）")
+def _build_wr(window):
+    highest_high = highest(HIGH, window)
+    lowest_low = lowest(LOW, window)
+    return {f"WR{window}": abs(-100 * ((highest_high - CLOSE) / (highest_high - lowest_low)))}
+
+
+@registry.indicator("BOLL", params={"window": 20, "width": 2}, description="布林线")
+def _build_boll(window, width):
+    mid = sma(CLOSE, window)
+    band = width * stddev(CLOSE, window)
+    return {"BOLL_MID": mid, "BOLL_UP": mid + band, "BOLL_LOW": mid - band}
+
+
+@registry.indicator("ATR", params={"window": 14}, pattern=r"ATR(\d+)", param_name="window", description="平均真实波幅")
+def _build_atr(window):
+    prev_close = ref(CLOSE)
+    true_range = maximum(maximum(HIGH - LOW, abs(HIGH - prev_close)), abs(LOW - prev_close))
+    return {f"ATR{window}": sma(true_range, window)}
+
+
+@registry.indicator("OBV", description="能量潮")
+def _build_obv():
+    return {"OBV": Node("cumsum", Node("sign", delta(CLOSE)) * VOLUME)}
+
+
+# 个股分析页面默认展示的指标
+DEFAULT_INDICATORS = ("MA5", "MA10", "MA20", "MACD", "KDJ", "RSI", "WR21")
+
+
+def compute_indicators(close, high, low, names=DEFAULT_INDICATORS):
+    """
+    计算技术指标，输入为一维（单只股票）或二维（股票 × 交易日）数组，
+    返回 {指标名: 与输入同形状的数组}；默认计算 MA/MACD/KDJ/RSI/WR
+    """
+    return registry.compute({"收盘": close, "最高": high, "最低": low}, names)
+
+
+# 计算指标依赖的K线列，用于生成内容指纹
+FINGERPRINT_COLUMNS = ("日期", "开盘", "收盘", "最高", "最低", "成交量")
+
+
+def frame_fingerprint(df, columns=FINGERPRINT_COLUMNS):
+    """
+    K线内容的指纹：任何一根K线的日期或价格、成交量变化都会改变指纹
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(len(df)).encode())
+    for col in columns:
+        if col not in df.columns:
+            continue
+        values = df[col].to_numpy()
+        digest.update(col.encode())
+        if values.dtype.kind in "biufcmM":
+            digest.update(str(values.dtype).encode())
+            digest.update(np.ascontiguousarray(values).tobytes())
+        else:
+            digest.update("\x1f".join(map(str, values)).encode())
+    return digest.hexdigest()
+
+
+def stack_frames(frames, columns=PRICE_COLUMNS, length=None):
+    """
+    把多只股票的K线DataFrame按最后一个交易日右对齐，堆叠为二维数组
+
+    frames: {代码: DataFrame}，每个DataFrame按日期升序排列
+    length: 保留的最大交易日数，默认取最长的序列
+    返回 (代码列表, {列名: 二维数组}, 每只股票的有效长度)
+    """
+    codes = list(frames)
+    lengths = np.array([len(frames[code]) for code in codes], dtype=np.int64)
+    if length is None:
+        length = int(lengths.max()) if len(lengths) else 0
+    lengths = np.minimum(lengths, length)
+
+    arrays = {col: np.full((len(codes), length), np.nan) for col in columns}
+    for row, code in enumerate(codes):
+        n = lengths[row]
+        if n == 0:
+            continue
+        frame = frames[code]
+        for col in columns:
+            arrays[col][row, length - n:] = frame[col].to_numpy(dtype=float, na_value=np.nan)[-n:]
+    return codes, arrays, lengths
+
+
+def compute_universe_indicators(frames, length=None):
+    """
+    批量计算多只股票的技术指标
+
+    返回 (代码列表, {指标名: 二维数组}, 每只股票的有效长度)，数组按最后一个交易日右对齐
+    """
+    codes, arrays, lengths = stack_frames(frames, PRICE_COLUMNS, length)
+    result = compute_indicators(arrays["收盘"], arrays["最高"], arrays["最低"])
+    return codes, result, lengths
+
+
+# ---------------------------------------------------------------------------
+# 增量指标状态：新K线到来时以O(1)代价更新全部指标
+# ---------------------------------------------------------------------------
+
+def _safe_div(a, b):
+    """
+    按numpy的规则做标量除法：除以0得到inf或NaN而不是抛出异常
+    """
+    if b != 0 or b != b:
+        return a / b
+    if a != a or a == 0:
+        return math.nan
+    return math.copysign(math.inf, a) * math.copysign(1.0, b)
+
+
+class _RollingMeanState:
+    """
+    滚动均值的增量状态，复刻 pandas 带补偿的滑动求和
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.values = deque(maxlen=window)
+        self.nobs = 0
+        self.neg_ct = 0
+        self.sum_x = 0.0
+        self.comp_add = 0.0
+        self.comp_remove = 0.0
+        self.same_count = 0
+        self.prev_value = None
+
+    def clone(self):
+        other = object.__new__(_RollingMeanState)
+        other.__dict__.update(self.__dict__)
+        other.values = deque(self.values, maxlen=self.window)
+        return other
+
+    def push(self, val):
+        if self.prev_value is None:
+            self.prev_value = val
+        if len(self.values) == self.window:
+            old = self.values[0]
+            if old == old:
+                y = -old - self.comp_remove
+                t = self.sum_x + y
+                self.comp_remove = t - self.sum_x - y
+                self.sum_x = t
+                self.nobs -= 1
+                self.neg_ct -= math.copysign(1.0, old) < 0
+        self.values.append(val)
+        if val == val:
+            y = val - self.comp_add
+            t = self.sum_x + y
+            self.comp_add = t - self.sum_x - y
+            self.sum_x = t
+            self.nobs += 1
+            self.neg_ct += math.copysign(1.0, val) < 0
+            self.same_count = self.same_count + 1 if val == self.prev_value else 1
+            self.prev_value = val
+
+        if self.nobs < self.window or self.nobs == 0:
+            return math.nan
+        if self.same_count >= self.nobs:
+            return self.prev_value
+        result = self.sum_x / self.nobs
+        if self.neg_ct == 0 and result < 0:
+            return 0.0
+        if self.neg_ct == self.nobs and result > 0:
+            return 0.0
+        return result
+
+
+class _EwmState:
+    """
+    指数加权均值的增量状态，复刻 pandas ewm(adjust=False) 的递推
+    """
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.weighted = None
+        self.old_wt = 1.0
+
+    def clone(self):
+        other = object.__new__(_EwmState)
+        other.__dict__.update(self.__dict__)
+        return other
+
+    def push(self, cur):
+        if self.weighted is None:
+            self.weighted = cur
+            return cur
+        weighted = self.weighted
+        if weighted == weighted:
+            self.old_wt *= 1.0 - self.alpha
+            if cur == cur:
+                if weighted != cur:
+                    weighted = (self.old_wt * weighted + self.alpha * cur) / (self.old_wt + self.alpha)
+                self.old_wt = 1.0
+        elif cur == cur:
+            weighted = cur
+        self.weighted = weighted
+        return weighted
+
+
+class _RollingExtremumState:
+    """
+    滚动最大/最小值的增量状态（单调队列），窗口内有NaN或数据不足时为NaN
+    """
+
+    def __init__(self, window, is_max):
+        self.window = window
+        self.is_max = is_max
+        self.queue = deque()
+        self.index = -1
+        self.last_nan = -1
+
+    def clone(self):
+        other = object.__new__(_RollingExtremumState)
+        other.__dict__.update(self.__dict__)
+        other.queue = deque(self.queue)
+        return other
+
+    def push(self, val):
+        self.index += 1
+        if val != val:
+            self.last_nan = self.index
+        else:
+            queue = self.queue
+            if self.is_max:
+                while queue and queue[-1][1] <= val:
+                    queue.pop()
+            else:
+                while queue and queue[-1][1] >= val:
+                    queue.pop()
+            queue.append((self.index, val))
+        while self.queue and self.queue[0][0] <= self.index - self.window:
+            self.queue.popleft()
+        if self.index + 1 < self.window or self.last_nan > self.index - self.window:
+            return math.nan
+        return self.queue[0][1]
+
+
+class IndicatorState:
+    """
+    单只股票的增量指标状态
+
+    保存EMA累加器、滚动窗口、RSI平均涨跌幅以及K/D值等，append每根新K线的代价与历史长度无关。
+    从同一序列起点逐根追加得到的指标与 compute_indicators 的批量结果逐位一致。
+    revise 用于盘中更新：用新的数值替换最后一根K线。
+    """
+
+    def __init__(self):
+        self.ma = {window: _RollingMeanState(window) for window in (5, 10, 20)}
+        self.ema12 = _EwmState(ewm_alpha(span=12))
+        self.ema26 = _EwmState(ewm_alpha(span=26))
+        self.dea = _EwmState(ewm_alpha(span=9))
+        self.low_9 = _RollingExtremumState(9, is_max=False)
+        self.high_9 = _RollingExtremumState(9, is_max=True)
+        self.k = _EwmState(ewm_alpha(alpha=1 / 3))
+        self.d = _EwmState(ewm_alpha(alpha=1 / 3))
+        self.ema_up = _EwmState(ewm_alpha(com=13))
+        self.ema_down = _EwmState(ewm_alpha(com=13))
+        self.high_21 = _RollingExtremumState(21, is_max=True)
+        self.low_21 = _RollingExtremumState(21, is_max=False)
+        self.prev_close = None
+        self.count = 0
+        self.first_date = None
+        self.last_date = None
+        self.last_bar = None
+        self._before_last = None
+
+    # 各子状态的属性名
+    _EWM_FIELDS = ("ema12", "ema26", "dea", "k", "d", "ema_up", "ema_down")
+    _EXTREMUM_FIELDS = ("low_9", "high_9", "high_21", "low_21")
+
+    def _copy(self):
+        # 状态的大小只与窗口长度有关、与历史长度无关，复制代价为常数
+        clone = object.__new__(IndicatorState)
+        clone.__dict__.update(self.__dict__)
+        clone.ma = {window: state.clone() for window, state in self.ma.items()}
+        for name in self._EWM_FIELDS + self._EXTREMUM_FIELDS:
+            setattr(clone, name, getattr(self, name).clone())
+        clone._before_last = None
+        return clone
+
+    def copy(self):
+        """
+        复制状态（含替换最后一根K线所需的信息），供多个会话共享的状态在修改前使用
+        """
+        clone = self._copy()
+        clone._before_last = self._before_last
+        return clone
+
+    @property
+    def can_revise(self):
+        return self._before_last is not None
+
+    @property
+    def close_before_last(self):
+        """
+        最后一根K线之前一根的收盘价，用于判断历史数据是否被改写
+        """
+        return self._before_last.prev_close if self._before_last is not None else None
+
+    def append(self, date, close, high, low, revisable=True):
+        """
+        追加一根新K线，返回该K线的全部指标 {指标名: 值}
+
+        revisable 为 True 时保留追加前的状态，之后可用 revise 替换这根K线
+        """
+        self._before_last = self._copy() if revisable else None
+        return self._apply(date, float(close), float(high), float(low))
+
+    def revise(self, date, close, high, low):
+        """
+        用新的数值替换最后一根K线（盘中行情更新），返回该K线的全部指标
+        """
+        if self._before_last is None:
+            raise ValueError("没有可以替换的K线")
+        before = self._before_last
+        self.__dict__.update(before._copy().__dict__)
+        self._before_last = before
+        return self._apply(date, float(close), float(high), float(low))
+
+    def _apply(self, date, close, high, low):
+        result = {}
+        for window, state in self.ma.items():
+            result[f"MA{window}"] = state.push(close)
+
+        # MACD
+        dif = self.ema12.push(close) - self.ema26.push(close)
+        dea = self.dea.push(dif)
+        result["DIF"] = dif
+        result["DEA"] = dea
+        result["MACD"] = 2 * (dif - dea)
+
+        # KDJ
+        low_9 = self.low_9.push(low)
+        high_9 = self.high_9.push(high)
+        rsv = _safe_div(close - low_9, high_9 - low_9) * 100
+        k = self.k.push(rsv)
+        d = self.d.push(k)
+        result["K"] = k
+        result["D"] = d
+        result["J"] = 3 * k - 2 * d
+
+        # RSI
+        delta = math.nan if self.prev_close is None else close - self.prev_close
+        up = delta if delta != delta else max(delta, 0.0)
+        down = delta if delta != delta else -1 * min(delta, 0.0)
+        rs = _safe_div(self.ema_up.push(up), self.ema_down.push(down))
+        result["RSI"] = 100 - _safe_div(100, 1 + rs)
+
+        # 威廉指标WR (21日)，取绝对值
+        highest_high = self.high_21.push(high)
+        lowest_low = self.low_21.push(low)
+        result["WR21"] = abs(-100 * _safe_div(highest_high - close, highest_high - lowest_low))
+
+        self.prev_close = close
+        self.count += 1
+        if self.first_date is None:
+            self.first_date = date
+        self.last_date = date
+        self.last_bar = (close, high, low)
+        return result
+
+    @classmethod
+    def from_bars(cls, dates, close, high, low):
+        """
+        从完整的K线序列建立状态，返回 (状态, {指标名: 数组})
+        """
+        state = cls()
+        history = {name: np.empty(len(dates)) for name in INDICATOR_COLUMNS}
+        last = len(dates) - 1
+        for i, date in enumerate(dates):
+            values = state.append(date, close[i], high[i], low[i], revisable=(i == last))
+            for name in INDICATOR_COLUMNS:
+                history[name][i] = values[name]
+        return state, history
+
+
+INDICATOR_STATE_DIR = "data_cache/indicator_state"
+_indicator_states = {}
+_indicator_states_lock = threading.Lock()
+
+
+def load_indicator_state(key):
+    """
+    读取增量指标状态，返回 (IndicatorState, 指标历史DataFrame) 或 None
+    """
+    with _indicator_states_lock:
+        cached = _indicator_states.get(key)
+    if cached is not None:
+        return cached
+    state_file = os.path.join(INDICATOR_STATE_DIR, f"{key}.pkl")
+    if not os.path.exists(state_file):
+        return None
+    try:
+        with open(state_file, "rb") as f:
+            cached = pickle.load(f)
+    except Exception:
+        return None
+    with _indicator_states_lock:
+        _indicator_states[key] = cached
+    return cached
+
+
+def save_indicator_state(key, state, history):
+    """
+    保存增量指标状态和指标历史，进程内共享并写入磁盘
+    """
+    with _indicator_states_lock:
+        _indicator_states[key] = (state, history)
+    os.makedirs(INDICATOR_STATE_DIR, exist_ok=True)
+    state_file = os.path.join(INDICATOR_STATE_DIR, f"{key}.pkl")
+    tmp_file = f"{state_file}.{threading.get_ident()}.tmp"
+    with open(tmp_file, "wb") as f:
+        pickle.dump((state, history), f)
+    os.replace(tmp_file, state_file)
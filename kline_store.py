@@ -0,0 +1,440 @@
+"""
+本地日线数据仓库
+
+每只股票的不复权日K线保存为 data_cache/klines/{代码}.csv，按日期升序、日期唯一。
+更新时只向数据源请求最近两个已保存交易日及之后的数据；已收盘的重叠交易日
+收盘价与已保存的不一致时（数据源修正了历史数据），重新获取全部历史。
+全市场技术面选股等批量计算只读取本地数据，不访问网络。
+
+复权因子表保存在 data_cache/adjust_factors/{代码}.csv，由不复权K线的涨跌额推算：
+交易所公布的前收盘 = 收盘 - 涨跌额，与上一交易日的收盘价不同的日期即为除权除息日。
+前复权、后复权价格由不复权价格乘以累计因子得到，见 adjust_klines。
+
+K线进入内存（缓存、仓库读取）时统一转换为紧凑格式，见 compact_klines；在会话之间共享的
+缓存对象用 freeze_frame 把数值列设为只读；
+涨跌幅统一为小数。周/月/季K线由日K线在本地重采样得到，见 resample_klines。
+"""
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+KLINE_DIR = "data_cache/klines"
+
+# 仓库中保存的列
+KLINE_COLUMNS = ("日期", "开盘", "收盘", "最高", "最低", "成交量", "成交额", "涨跌幅", "涨跌额", "换手率")
+
+# 紧凑格式中存为float32的数值列
+KLINE_FLOAT_COLUMNS = ("开盘", "收盘", "最高", "最低", "成交额", "涨跌幅", "涨跌额", "振幅", "换手率")
+
+# 紧凑格式中存为category的文字列
+KLINE_CATEGORY_COLUMNS = ("代码", "名称", "股票代码", "股票名称", "行业", "板块名称")
+
+# 首次获取的历史长度（自然日）
+HISTORY_DAYS = 730
+
+FACTOR_DIR = "data_cache/adjust_factors"
+
+# 复权方式：前复权、后复权、不复权
+ADJUST_QFQ = "qfq"
+ADJUST_HFQ = "hfq"
+ADJUST_NONE = ""
+
+# 复权时需要调整的价格列
+ADJUST_PRICE_COLUMNS = ("开盘", "收盘", "最高", "最低", "涨跌额")
+
+# update_klines 返回的状态
+KLINE_NEW = "new"
+KLINE_APPENDED = "appended"
+KLINE_REFETCHED = "refetched"
+KLINE_UNCHANGED = "unchanged"
+
+
+def kline_path(code):
+    return os.path.join(KLINE_DIR, f"{code}.csv")
+
+
+def compact_klines(df):
+    """
+    把K线转换为紧凑的规范格式，在数据进入缓存或内存时调用一次
+
+    日期为datetime64，价格等数值列为float32，成交量为整数，代码、名称、行业为category，
+    其余列保持不变。
+    """
+    df = df.copy()
+    if "日期" in df.columns and not pd.api.types.is_datetime64_any_dtype(df["日期"]):
+        df["日期"] = pd.to_datetime(df["日期"])
+    for col in KLINE_FLOAT_COLUMNS:
+        if col in df.columns and df[col].dtype != np.float32:
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype(np.float32)
+    if "成交量" in df.columns and df["成交量"].dtype != np.int32:
+        volume = pd.to_numeric(df["成交量"], errors="coerce")
+        if volume.notna().all() and (volume == volume.round()).all():
+            # 成交量以手为单位，绝大多数股票用int32即可
+            df["成交量"] = volume.astype(np.int32 if volume.abs().max() < 2 ** 31 else np.int64)
+        else:
+            df["成交量"] = volume.astype(float)
+    for col in KLINE_CATEGORY_COLUMNS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(str).astype("category")
+    return df
+
+
+def freeze_frame(df):
+    """
+    返回数值列为只读数组的DataFrame，用于在会话之间共享的缓存对象（st.cache_resource）
+
+    只读数组只能防止就地修改取值（未启用Copy-on-Write的pandas中，浅复制与原对象共享数组）；
+    增删列、inplace 排序等仍会修改对象本身，因此共享对象应只通过浅复制 copy(deep=False) 交给调用方。
+    """
+    columns = {}
+    for col in df.columns:
+        values = df[col]
+        if isinstance(values.dtype, np.dtype) and values.dtype.kind in "biufcmM":
+            values = values.to_numpy(copy=True)
+            values.flags.writeable = False
+        columns[col] = values
+    return pd.DataFrame(columns, index=df.index, copy=False)
+
+
+def load_klines(code, length=None):
+    """
+    读取本地保存的日K线（紧凑格式），不存在时返回None；length 为保留的最近交易日数
+    """
+    path = kline_path(code)
+    if not os.path.exists(path):
+        return None
+    try:
+        df = pd.read_csv(path)
+    except Exception:
+        return None
+    if length is not None:
+        df = df.iloc[-length:].reset_index(drop=True)
+    return compact_klines(df)
+
+
+def normalize_klines(df):
+    """
+    整理数据源返回的K线：只保留仓库的列并转换为紧凑格式，按日期去重排序
+    """
+    df = compact_klines(df[[col for col in KLINE_COLUMNS if col in df.columns]])
+    df = df.drop_duplicates(subset="日期", keep="last")
+    return df.sort_values("日期").reset_index(drop=True)
+
+
+def save_klines(code, df):
+    """
+    写入本地仓库，先写临时文件再替换，避免读到写了一半的文件
+    """
+    os.makedirs(KLINE_DIR, exist_ok=True)
+    path = kline_path(code)
+    tmp_path = f"{path}.tmp"
+    df.to_csv(tmp_path, index=False, date_format="%Y-%m-%d")
+    os.replace(tmp_path, path)
+
+
+def merge_klines(existing, new):
+    """
+    合并新旧K线，同一日期以新数据为准
+    """
+    if existing is None or existing.empty:
+        return new
+    merged = pd.concat([existing[~existing["日期"].isin(new["日期"])], new])
+    return merged.sort_values("日期").reset_index(drop=True)
+
+
+def update_klines(code, fetch, today=None):
+    """
+    增量更新一只股票的日K线，返回 (DataFrame, 状态)
+
+    fetch(code, start_date, end_date) 返回数据源的K线，日期参数格式为 YYYYMMDD。
+    """
+    today = today or datetime.now()
+    end_date = today.strftime("%Y%m%d")
+    existing = load_klines(code)
+
+    if existing is None or existing.empty:
+        start_date = (today - timedelta(days=HISTORY_DAYS)).strftime("%Y%m%d")
+        fetched = fetch(code, start_date, end_date)
+        if fetched is None or fetched.empty:
+            return existing, KLINE_UNCHANGED
+        df = normalize_klines(fetched)
+        save_klines(code, df)
+        update_adjust_factors(code, df)
+        return df, KLINE_NEW
+
+    # 从倒数第二个交易日开始获取：它一定已经收盘，用来判断历史数据是否被修正；
+    # 最后一个交易日可能是盘中数据，允许被覆盖
+    last_date = existing["日期"].iloc[-1]
+    anchor_date = existing["日期"].iloc[-2] if len(existing) > 1 else last_date
+    fetched = fetch(code, anchor_date.strftime("%Y%m%d"), end_date)
+    if fetched is None or fetched.empty:
+        return existing, KLINE_UNCHANGED
+    new = normalize_klines(fetched)
+
+    anchor = new[new["日期"] == anchor_date]
+    stored_close = existing.loc[existing["日期"] == anchor_date, "收盘"].iloc[0]
+    if not anchor.empty and not np.isclose(anchor["收盘"].iloc[0], stored_close):
+        # 历史数据发生了变化，已保存的数据不再可用
+        start_date = existing["日期"].iloc[0].strftime("%Y%m%d")
+        fetched = fetch(code, start_date, end_date)
+        if fetched is None or fetched.empty:
+            return existing, KLINE_UNCHANGED
+        df = normalize_klines(fetched)
+        save_klines(code, df)
+        update_adjust_factors(code, df)
+        return df, KLINE_REFETCHED
+
+    overlap = new[new["日期"] == last_date]
+    # 有新的交易日，或最后一天的数据在盘中发生了变化
+    columns = [col for col in KLINE_COLUMNS[1:] if col in new.columns and col in existing.columns]
+    revised = not overlap.empty and not np.allclose(
+        overlap[columns].to_numpy(dtype=float), existing[columns].iloc[[-1]].to_numpy(dtype=float), equal_nan=True
+    )
+    if revised or (new["日期"] > last_date).any():
+        df = merge_klines(existing, new)
+        save_klines(code, df)
+        # 只需检查新获取的K线中是否出现了新的除权除息
+        update_adjust_factors(code, new)
+        return df, KLINE_APPENDED
+    return existing, KLINE_UNCHANGED
+
+
+def stored_codes():
+    """
+    本地仓库中已有日线的股票代码
+    """
+    if not os.path.isdir(KLINE_DIR):
+        return []
+    return sorted(entry.name[:-4] for entry in os.scandir(KLINE_DIR) if entry.name.endswith(".csv"))
+
+
+def store_version():
+    """
+    仓库的版本标识（文件数与最后修改时间），任何股票的数据更新都会改变它
+    """
+    if not os.path.isdir(KLINE_DIR):
+        return "empty"
+    count = 0
+    latest = 0.0
+    for entry in os.scandir(KLINE_DIR):
+        if entry.name.endswith(".csv"):
+            count += 1
+            latest = max(latest, entry.stat().st_mtime)
+    return f"{count}-{latest:.6f}"
+
+
+def load_universe_klines(codes=None, length=None, progress=None, adjust=ADJUST_NONE):
+    """
+    读取多只股票的本地日线，返回 {代码: DataFrame}；progress(已完成比例) 用于汇报进度，
+    adjust 为复权方式
+    """
+    codes = stored_codes() if codes is None else list(codes)
+    frames = {}
+    for i, code in enumerate(codes):
+        df = load_klines(code, length)
+        if df is not None and not df.empty:
+            frames[code] = adjust_klines(df, load_adjust_factors(code), adjust) if adjust else df
+        if progress is not None and i % 200 == 0:
+            progress(i / max(len(codes), 1))
+    return frames
+
+
+def detect_adjust_events(df):
+    """
+    从不复权K线中找出除权除息日，返回 DataFrame[日期, 因子]
+
+    因子 = 上一交易日收盘价 / 交易所公布的前收盘价（收盘 - 涨跌额）。
+    价格和涨跌额都精确到分，两者相差不到半分时视为没有除权除息。
+    第一根K线没有上一交易日的数据，不参与判断。
+    """
+    if df is None or len(df) < 2 or "涨跌额" not in df.columns:
+        return pd.DataFrame({"日期": pd.Series(dtype="datetime64[ns]"), "因子": pd.Series(dtype=float)})
+    close = df["收盘"].to_numpy(dtype=float)
+    change = df["涨跌额"].to_numpy(dtype=float)
+    exchange_prev = close[1:] - change[1:]
+    prev_close = close[:-1]
+    events = (np.abs(prev_close - exchange_prev) >= 0.005) & (exchange_prev > 0) & np.isfinite(prev_close)
+    index = np.flatnonzero(events)
+    return pd.DataFrame({
+        "日期": pd.to_datetime(df["日期"].to_numpy()[1:][index]),
+        "因子": prev_close[index] / exchange_prev[index],
+    })
+
+
+def factor_path(code):
+    return os.path.join(FACTOR_DIR, f"{code}.csv")
+
+
+def load_adjust_factors(code):
+    """
+    读取复权因子表，没有记录时返回空表
+    """
+    path = factor_path(code)
+    if os.path.exists(path):
+        try:
+            factors = pd.read_csv(path)
+            factors["日期"] = pd.to_datetime(factors["日期"])
+            return factors
+        except Exception:
+            pass
+    return detect_adjust_events(None)
+
+
+def update_adjust_factors(code, df):
+    """
+    用一段不复权K线更新复权因子表：这段K线覆盖的日期内以新检测的结果为准，其余保留，
+    因此每次只需传入新获取的K线。返回更新后的因子表
+    """
+    existing = load_adjust_factors(code)
+    if df is None or len(df) < 2 or "涨跌额" not in df.columns:
+        return existing
+    detected = detect_adjust_events(df)
+    dates = pd.to_datetime(df["日期"])
+    covered = (existing["日期"] > dates.min()) & (existing["日期"] <= dates.max())
+    kept = existing[~covered]
+    if len(detected) == covered.sum() and np.array_equal(
+            existing.loc[covered, "日期"].to_numpy(), detected["日期"].to_numpy()) \
+            and np.allclose(existing.loc[covered, "因子"].to_numpy(), detected["因子"].to_numpy()):
+        return existing
+    factors = pd.concat([kept, detected]).sort_values("日期").reset_index(drop=True)
+    os.makedirs(FACTOR_DIR, exist_ok=True)
+    path = factor_path(code)
+    tmp_path = f"{path}.tmp"
+    factors.to_csv(tmp_path, index=False, date_format="%Y-%m-%d")
+    os.replace(tmp_path, path)
+    return factors
+
+
+def adjust_klines(df, factors, mode=ADJUST_QFQ):
+    """
+    由不复权K线和复权因子表计算复权K线，mode 为 qfq（前复权）、hfq（后复权）或空（不复权）
+
+    后复权价格 = 不复权价格 × 截至当日的累计因子；前复权再除以最新的累计因子，
+    使最近的价格与不复权价格一致。成交量、涨跌幅不受复权影响。
+    """
+    if not mode or df is None or df.empty or factors is None or factors.empty:
+        return df
+    if mode not in (ADJUST_QFQ, ADJUST_HFQ):
+        raise ValueError(f"不支持的复权方式: {mode}")
+    cumulative = np.r_[1.0, np.cumprod(factors["因子"].to_numpy(dtype=float))]
+    position = np.searchsorted(factors["日期"].to_numpy(), pd.to_datetime(df["日期"]).to_numpy(), side="right")
+    scale = cumulative[position]
+    if mode == ADJUST_QFQ:
+        scale = scale / cumulative[-1]
+    df = df.copy()
+    for col in ADJUST_PRICE_COLUMNS:
+        if col in df.columns:
+            df[col] = (df[col].to_numpy(dtype=float) * scale).astype(df[col].dtype)
+    return df
+
+
+# 重采样周期：周、月、季
+RESAMPLE_PERIODS = {"W": "周", "M": "月", "Q": "季"}
+
+# 重采样时按周期累加的列
+_SUM_COLUMNS = ("成交量", "成交额", "换手率")
+
+
+def _period_keys(dates, period):
+    dates = pd.DatetimeIndex(dates)
+    if period == "W":
+        iso = dates.isocalendar()
+        return iso["year"].to_numpy() * 100 + iso["week"].to_numpy()
+    if period == "M":
+        return dates.year.to_numpy() * 100 + dates.month.to_numpy()
+    if period == "Q":
+        return dates.year.to_numpy() * 10 + dates.quarter.to_numpy()
+    raise ValueError(f"不支持的重采样周期: {period}，可用: {', '.join(RESAMPLE_PERIODS)}")
+
+
+def _resample(df, period, prev_close=None):
+    """
+    把按日期升序的日K线合并为周期K线，返回 {列名: 数组}，日期取该周期最后一个交易日
+    """
+    keys = _period_keys(df["日期"], period)
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    ends = np.r_[starts[1:], len(df)] - 1
+
+    result = {"日期": df["日期"].to_numpy()[ends]}
+    if "开盘" in df.columns:
+        result["开盘"] = df["开盘"].to_numpy()[starts]
+    result["收盘"] = df["收盘"].to_numpy()[ends]
+    if "最高" in df.columns:
+        result["最高"] = np.maximum.reduceat(df["最高"].to_numpy(), starts)
+    if "最低" in df.columns:
+        result["最低"] = np.minimum.reduceat(df["最低"].to_numpy(), starts)
+    for col in _SUM_COLUMNS:
+        if col in df.columns:
+            values = df[col].to_numpy()
+            result[col] = np.add.reduceat(values.astype(np.int64 if values.dtype.kind in "iu" else float), starts)
+
+    # 涨跌幅相对上一周期的收盘价；第一个周期用首日涨跌幅反推前收盘
+    close = result["收盘"].astype(float)
+    previous = np.r_[np.nan, close[:-1]]
+    if prev_close is not None:
+        previous[0] = prev_close
+    elif "涨跌幅" in df.columns:
+        previous[0] = float(df["收盘"].iloc[0]) / (1 + float(df["涨跌幅"].iloc[0]))
+    result["涨跌幅"] = close / previous - 1
+    return result
+
+
+_resampled = OrderedDict()
+_resampled_lock = threading.Lock()
+_RESAMPLE_CACHE_SIZE = 256
+
+
+def resample_klines(df, period, cache_key=None):
+    """
+    由日K线生成周/月/季K线（紧凑格式），period 为 W、M 或 Q
+
+    周期边界按实际交易日划分：同一自然周（ISO周）、月或季度内的交易日合并为一根K线，
+    日期为该周期最后一个交易日，最后一个周期可能尚未结束。
+    涨跌幅为相对上一周期收盘价的变化，单位与日K线相同（小数）。
+
+    给定 cache_key 时增量计算：已经结束的周期保存在进程内缓存中，日K线只新增或修改了
+    最近的数据时，只重新合并最后一个周期及之后的日K线。
+    """
+    if df is None or df.empty:
+        return df
+    if not df["日期"].is_monotonic_increasing:
+        df = df.sort_values("日期")
+    df = df.reset_index(drop=True)
+    if cache_key is None:
+        return compact_klines(pd.DataFrame(_resample(df, period)))
+
+    key = (cache_key, period)
+    with _resampled_lock:
+        cached = _resampled.get(key)
+        if cached is not None:
+            _resampled.move_to_end(key)
+
+    result = None
+    if cached is not None:
+        complete, consumed, first_date, last_date, last_close = cached
+        # 已合并的日K线没有变化（首尾日期和最后一天的收盘价都一致），只处理之后的部分
+        if 0 < consumed < len(df) and df["日期"].iloc[0] == first_date \
+                and df["日期"].iloc[consumed - 1] == last_date and df["收盘"].iloc[consumed - 1] == last_close:
+            tail = _resample(df.iloc[consumed:], period, prev_close=float(last_close))
+            result = {col: np.concatenate([complete[col], tail[col]]) for col in tail}
+    if result is None:
+        result = _resample(df, period)
+        consumed = 0
+
+    # 保存已经结束的周期：除最后一根以外的K线
+    dates = result["日期"]
+    complete_rows = len(dates) - 1
+    new_consumed = int(np.searchsorted(df["日期"].to_numpy(), dates[-2], side="right")) if complete_rows > 0 else 0
+    if new_consumed > 0 and new_consumed != consumed:
+        entry = ({col: values[:complete_rows] for col, values in result.items()}, new_consumed,
+                 df["日期"].iloc[0], df["日期"].iloc[new_consumed - 1], df["收盘"].iloc[new_consumed - 1])
+        with _resampled_lock:
+            _resampled[key] = entry
+            _resampled.move_to_end(key)
+            while len(_resampled) > _RESAMPLE_CACHE_SIZE:
+                _resampled.popitem(last=False)
+    return compact_klines(pd.DataFrame(result))
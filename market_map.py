@@ -0,0 +1,469 @@
+"""
+板块热力图的个股层级
+
+- 板块下钻：只加载所选板块的成分股及其最新行情，画成该板块的个股矩形树图
+- 成分股列表按板块保存在本地，接口失败时用本地保存的最近一次结果
+- 实时模式：所有会话共享一个行情快照轮询器（SnapshotPoller），页面只按变化的板块修改图表中的颜色/数值
+- 全市场个股地图：全市场行情快照按行业映射分组，每个行业只显示面积最大的若干只，其余合并为"其他"
+
+行情快照统一整理成与板块热力图相同的指标列（涨跌幅、换手率、量价强度、成交额（亿）、成交量（万手）），
+页面上的颜色/大小指标选项对板块和个股通用。只依赖 numpy、pandas 和 plotly，不依赖Streamlit。
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+BOARD_DIR = "data_cache/boards"
+
+# 股票代码 -> 所属行业板块的映射
+INDUSTRY_MAP_FILE = os.path.join(BOARD_DIR, "industry_map.csv")
+
+# 没有行业映射的股票归入的分组
+UNCLASSIFIED = "未分类"
+
+# 全市场个股地图的假定宽度（像素）和每个方块的最小面积（平方像素），用于按图表尺寸决定显示多少个方块
+MARKET_MAP_WIDTH = 1200
+MARKET_TILE_AREA = 1600
+
+# A股连续竞价时段
+TRADING_SESSIONS = (("09:30", "11:30"), ("13:00", "15:00"))
+
+# 个股行情快照保留的列
+QUOTE_COLUMNS = ("代码", "名称", "最新价", "涨跌幅", "涨跌额", "成交量", "成交额", "换手率", "总市值", "流通市值")
+
+
+def normalize_quotes(df):
+    """
+    整理个股行情快照：统一列名和数值类型，计算与板块热力图相同的指标列
+    """
+    df = df.rename(columns={"股票代码": "代码", "股票名称": "名称"})
+    df = df[[col for col in QUOTE_COLUMNS if col in df.columns]].copy()
+    df["代码"] = df["代码"].astype(str).str.zfill(6)
+    for col in df.columns:
+        if col not in ("代码", "名称"):
+            df[col] = pd.to_numeric(df[col], errors="coerce")
+    df["成交额（亿）"] = df["成交额"] / 1e8
+    df["成交量（万手）"] = df["成交量"] / 10000
+    df["量价强度"] = df["涨跌幅"] * df["换手率"]
+    return df.drop_duplicates(subset="代码").reset_index(drop=True)
+
+
+def board_path(board_name):
+    key = hashlib.sha1(board_name.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(BOARD_DIR, f"cons_{key}.csv")
+
+
+def save_board_constituents(board_name, df):
+    """
+    保存板块成分股及行情（整理后的格式），作为接口失败时的备用数据
+    """
+    os.makedirs(BOARD_DIR, exist_ok=True)
+    path = board_path(board_name)
+    tmp_path = f"{path}.tmp"
+    df.assign(板块名称=board_name).to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def load_board_constituents(board_name):
+    """
+    读取本地保存的板块成分股，不存在时返回None
+    """
+    path = board_path(board_name)
+    if not os.path.exists(path):
+        return None
+    try:
+        df = pd.read_csv(path, dtype={"代码": str})
+    except Exception:
+        return None
+    return df.drop(columns=["板块名称"], errors="ignore")
+
+
+def save_industry_map(mapping):
+    """
+    保存行业映射（代码、板块名称两列）
+    """
+    os.makedirs(BOARD_DIR, exist_ok=True)
+    tmp_path = f"{INDUSTRY_MAP_FILE}.tmp"
+    mapping[["代码", "板块名称"]].to_csv(tmp_path, index=False)
+    os.replace(tmp_path, INDUSTRY_MAP_FILE)
+
+
+def load_industry_map():
+    """
+    读取本地保存的行业映射，不存在时返回None
+    """
+    if not os.path.exists(INDUSTRY_MAP_FILE):
+        return None
+    try:
+        return pd.read_csv(INDUSTRY_MAP_FILE, dtype={"代码": str, "板块名称": str})
+    except Exception:
+        return None
+
+
+def build_industry_map(board_names, fetch_constituents, progress=None):
+    """
+    逐个板块获取成分股，得到 代码 -> 板块名称 的映射；同一只股票出现在多个板块时取第一个
+
+    fetch_constituents(板块名称) 返回含 代码 列的DataFrame，progress(已完成数, 总数) 报告进度
+    返回 (映射DataFrame, 失败的板块数)
+    """
+    parts = []
+    failed = 0
+    for i, board_name in enumerate(board_names):
+        if progress is not None:
+            progress(i, len(board_names))
+        try:
+            df = fetch_constituents(board_name)
+        except Exception:
+            df = None
+        if df is None or df.empty:
+            failed += 1
+            continue
+        parts.append(pd.DataFrame({"代码": df["代码"].astype(str).str.zfill(6), "板块名称": board_name}))
+    if not parts:
+        return pd.DataFrame(columns=["代码", "板块名称"]), failed
+    mapping = pd.concat(parts, ignore_index=True).drop_duplicates(subset="代码")
+    return mapping.reset_index(drop=True), failed
+
+
+def _weighted_mean(values, weights):
+    valid = np.isfinite(values) & np.isfinite(weights) & (weights > 0)
+    if not valid.any():
+        return np.nan
+    return float(np.average(values[valid], weights=weights[valid]))
+
+
+def treemap_figure(ids, labels, parents, values, colors, customdata, color_metric, color_scale, height=600):
+    """
+    由节点数组构建矩形树图，父节点的值等于子节点之和（branchvalues="total"）
+
+    customdata 每行为 [涨跌幅, 换手率, 成交额（亿）]，用于标签和悬停信息
+    """
+    colors = np.asarray(colors, dtype=float)
+    finite = colors[np.isfinite(colors)]
+    percent = "%" if color_metric == "涨跌幅" else ""
+    fig = go.Figure(go.Treemap(
+        ids=ids,
+        labels=labels,
+        parents=parents,
+        values=values,
+        branchvalues="total",
+        customdata=customdata,
+        marker=dict(
+            colors=colors,
+            colorscale=color_scale,
+            cmin=float(finite.min()) if len(finite) else None,
+            cmax=float(finite.max()) if len(finite) else None,
+            colorbar=dict(title=color_metric + (" (%)" if percent else ""), tickformat=".1f", thickness=15)
+        ),
+        texttemplate="%{label} %{customdata[0]:.2f}%",
+        hovertemplate=(
+            "<b>%{label}</b><br>"
+            f"{color_metric}: %{{color:.2f}}{percent}<br>"
+            "换手率: %{customdata[1]:.2f}%<br>"
+            "成交额: %{customdata[2]:.2f}亿<extra></extra>"
+        )
+    ))
+    fig.update_layout(margin=dict(t=0, l=0, r=0, b=0), height=height)
+    return fig
+
+
+def board_treemap(board_name, df, size_metric, color_metric, color_scale, height=600):
+    """
+    板块成分股的个股矩形树图：板块为根节点，成分股按 size_metric 划分面积、按 color_metric 着色
+    """
+    df = df[np.isfinite(df[size_metric]) & (df[size_metric] > 0)]
+    sizes = df[size_metric].to_numpy(dtype=float)
+    colors = df[color_metric].to_numpy(dtype=float)
+    custom = df[["涨跌幅", "换手率", "成交额（亿）"]].to_numpy(dtype=float)
+    # 根节点按面积加权平均着色
+    root_custom = [_weighted_mean(custom[:, i], sizes) if i != 2 else np.nansum(custom[:, 2]) for i in range(3)]
+    return treemap_figure(
+        ids=[board_name] + df["代码"].tolist(),
+        labels=[board_name] + df["名称"].tolist(),
+        parents=[""] + [board_name] * len(df),
+        values=np.concatenate([[sizes.sum()], sizes]),
+        colors=np.concatenate([[_weighted_mean(colors, sizes)], colors]),
+        customdata=np.vstack([root_custom, custom]),
+        color_metric=color_metric,
+        color_scale=color_scale,
+        height=height
+    )
+
+
+def boards_treemap(df, size_metric, color_metric, color_scale, height=600):
+    """
+    板块矩形树图（每个板块一个节点），节点顺序与 df 的行顺序一致，便于之后按行修改（见 patch_boards_treemap）
+
+    df: 含 板块名称 及各指标列
+    """
+    return treemap_figure(
+        ids=df["板块名称"].tolist(),
+        labels=df["板块名称"].tolist(),
+        parents=[""] * len(df),
+        values=np.nan_to_num(df[size_metric].to_numpy(dtype=float)).clip(min=0),
+        colors=df[color_metric].to_numpy(dtype=float),
+        customdata=df[["涨跌幅", "换手率", "成交额（亿）"]].to_numpy(dtype=float),
+        color_metric=color_metric,
+        color_scale=color_scale,
+        height=height
+    )
+
+
+def patch_boards_treemap(fig, df, changed, size_metric, color_metric):
+    """
+    只修改变化板块的面积、颜色和悬停数据，其余节点和图表布局保持不变；返回修改的节点数
+    （只节省服务端重建图表的时间，显示时仍会发送整张图表）
+
+    df: 与构建图表时行顺序相同的最新数据；changed: 变化的板块名称
+    """
+    trace = fig.data[0]
+    positions = {name: i for i, name in enumerate(trace.ids)}
+    rows = [positions[name] for name in changed if name in positions]
+    if not rows:
+        return 0
+    latest = df.set_index("板块名称")
+    names = [trace.ids[i] for i in rows]
+    values = np.array(trace.values, dtype=float)
+    colors = np.array(trace.marker.colors, dtype=float)
+    custom = np.array(trace.customdata, dtype=float)
+    values[rows] = np.nan_to_num(latest.loc[names, size_metric].to_numpy(dtype=float)).clip(min=0)
+    colors[rows] = latest.loc[names, color_metric].to_numpy(dtype=float)
+    custom[rows] = latest.loc[names, ["涨跌幅", "换手率", "成交额（亿）"]].to_numpy(dtype=float)
+    finite = colors[np.isfinite(colors)]
+    trace.values = values
+    trace.customdata = custom
+    trace.marker.colors = colors
+    if len(finite):
+        trace.marker.cmin = float(finite.min())
+        trace.marker.cmax = float(finite.max())
+    return len(rows)
+
+
+def tile_budget(height, width=MARKET_MAP_WIDTH):
+    """
+    按图表尺寸估算能清晰显示的个股方块数量
+    """
+    return max(50, int(width * height // MARKET_TILE_AREA))
+
+
+def allocate_tiles(totals, counts, budget):
+    """
+    按各行业的面积占比分配个股方块数量，每个行业至少1个、不超过成分股数量；
+    只剩1只未显示时直接显示，不再合并为"其他"
+    """
+    quota = (totals / totals.sum() * budget).round().clip(lower=1)
+    quota = np.minimum(quota, counts)
+    return quota.where(counts - quota > 1, counts).astype(int)
+
+
+def _group_weighted_mean(df, column, weights, groups):
+    values = df[column].to_numpy(dtype=float)
+    valid = np.isfinite(values)
+    numerator = pd.Series(np.where(valid, values * weights, 0.0), index=df.index).groupby(groups).sum()
+    denominator = pd.Series(np.where(valid, weights, 0.0), index=df.index).groupby(groups).sum()
+    return numerator / denominator.replace(0, np.nan)
+
+
+def _group_nodes(df, size_metric, color_metric, groups):
+    # 分组节点的面积、颜色和悬停数据：面积与成交额求和，其余按面积加权平均
+    weights = df[size_metric].to_numpy(dtype=float)
+    nodes = pd.DataFrame({
+        "value": df[size_metric].groupby(groups).sum(),
+        "color": _group_weighted_mean(df, color_metric, weights, groups),
+        "涨跌幅": _group_weighted_mean(df, "涨跌幅", weights, groups),
+        "换手率": _group_weighted_mean(df, "换手率", weights, groups),
+        "成交额（亿）": df["成交额（亿）"].groupby(groups).sum(),
+        "count": df.groupby(groups).size(),
+    })
+    return nodes
+
+
+def market_treemap(quotes, mapping, size_metric, color_metric, color_scale, budget, height=800):
+    """
+    全市场个股矩形树图：个股按行业分组，每个行业按面积占比分配显示的个股数量（共约 budget 个），
+    其余个股合并为该行业下的一个"其他"方块
+
+    quotes: normalize_quotes 整理后的全市场行情；mapping: 代码、板块名称 两列
+    """
+    df = quotes.merge(mapping[["代码", "板块名称"]], on="代码", how="left")
+    df["板块名称"] = df["板块名称"].fillna(UNCLASSIFIED)
+    df = df[np.isfinite(df[size_metric]) & (df[size_metric] > 0)]
+    df = df.sort_values(["板块名称", size_metric], ascending=[True, False], kind="stable")
+
+    industries = _group_nodes(df, size_metric, color_metric, df["板块名称"])
+    quota = allocate_tiles(industries["value"], industries["count"], budget)
+    rank = df.groupby("板块名称").cumcount().to_numpy()
+    keep = rank < df["板块名称"].map(quota).to_numpy()
+    top, rest = df[keep], df[~keep]
+    others = _group_nodes(rest, size_metric, color_metric, rest["板块名称"])
+
+    custom_columns = ["涨跌幅", "换手率", "成交额（亿）"]
+    return treemap_figure(
+        ids=industries.index.tolist() + top["代码"].tolist() + [f"{name}/其他" for name in others.index],
+        labels=industries.index.tolist() + top["名称"].tolist() + [f"其他{n}只" for n in others["count"]],
+        parents=[""] * len(industries) + top["板块名称"].tolist() + others.index.tolist(),
+        values=np.concatenate([industries["value"], top[size_metric], others["value"]]),
+        colors=np.concatenate([industries["color"], top[color_metric], others["color"]]),
+        customdata=np.vstack([
+            industries[custom_columns].to_numpy(dtype=float).reshape(-1, 3),
+            top[custom_columns].to_numpy(dtype=float).reshape(-1, 3),
+            others[custom_columns].to_numpy(dtype=float).reshape(-1, 3),
+        ]),
+        color_metric=color_metric,
+        color_scale=color_scale,
+        height=height
+    )
+
+
+# 实时板块快照中更新的列，成交额、成交量仍取板块历史行情中的值
+LIVE_BOARD_COLUMNS = ("涨跌幅", "换手率", "量价强度")
+
+
+def normalize_board_snapshot(df):
+    """
+    整理全部行业板块的实时行情快照，只保留 板块名称 和 LIVE_BOARD_COLUMNS
+    """
+    df = df[["板块名称", "涨跌幅", "换手率"]].copy()
+    for col in ("涨跌幅", "换手率"):
+        df[col] = pd.to_numeric(df[col], errors="coerce")
+    df["量价强度"] = df["涨跌幅"] * df["换手率"]
+    return df
+
+
+def merge_live_boards(base, live):
+    """
+    用实时快照替换板块数据中的 LIVE_BOARD_COLUMNS，行顺序与 base 一致，只保留两边都有的板块
+    """
+    base = base.drop(columns=[col for col in LIVE_BOARD_COLUMNS if col in base.columns])
+    return base.merge(live[["板块名称", *LIVE_BOARD_COLUMNS]], on="板块名称", how="inner")
+
+
+def market_open(now=None):
+    """
+    当前是否处于A股交易时段（工作日的连续竞价时间，不考虑节假日）
+    """
+    now = now or datetime.now()
+    if now.weekday() >= 5:
+        return False
+    clock = now.strftime("%H:%M")
+    return any(start <= clock <= end for start, end in TRADING_SESSIONS)
+
+
+def changed_keys(old, new):
+    """
+    比较两次快照（以键为索引），返回数值有变化的键；键的集合不同时返回None，表示需要整体重建
+    """
+    if not old.index.equals(new.index):
+        return None
+    columns = [col for col in new.columns if col in old.columns]
+    before, after = old[columns], new[columns]
+    same = (before == after) | (before.isna() & after.isna())
+    return new.index[~same.all(axis=1)].tolist()
+
+
+class SnapshotPoller:
+    """
+    多个会话共享的行情快照轮询器
+
+    后台线程每 interval 秒调用一次 fetch()，与上一次快照比较得到变化的键并递增版本号；
+    各会话凭自己看到的版本号取变化（见 changes_since）。非交易时段、以及超过 idle_timeout 秒
+    没有会话访问时不再请求接口，线程在空闲时退出，下次访问时重新启动。
+    只有后台线程请求接口，会话在第一次获取完成前用 wait_first 等待，不另行请求。
+    """
+
+    def __init__(self, fetch, key_column, interval=30, idle_timeout=120, history=50, trading_only=True):
+        self.fetch = fetch
+        self.key_column = key_column
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.trading_only = trading_only
+        self.version = 0
+        self.frame = None
+        self.updated_at = None
+        self.error = None
+        self._changes = deque(maxlen=history)
+        self._last_access = 0.0
+        self._thread = None
+        self._lock = threading.Lock()
+        self._first_fetch = threading.Event()
+
+    def subscribe(self):
+        """
+        会话每次刷新时调用，保持轮询线程运行
+        """
+        with self._lock:
+            self._last_access = time.time()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="snapshot-poller", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if time.time() - self._last_access > self.idle_timeout:
+                    self._thread = None
+                    return
+                stale = self.frame is None
+            if stale or not self.trading_only or market_open():
+                self.poll()
+            time.sleep(self.interval)
+
+    def wait_first(self, timeout=None):
+        """
+        等待后台线程的第一次获取结束（成功或失败），返回是否已有快照
+        """
+        self._first_fetch.wait(timeout)
+        return self.frame is not None
+
+    def poll(self):
+        """
+        获取一次快照并记录变化
+        """
+        try:
+            self._poll()
+        finally:
+            self._first_fetch.set()
+
+    def _poll(self):
+        try:
+            new = self.fetch()
+        except Exception as e:
+            with self._lock:
+                self.error = str(e)
+            return
+        if new is None or new.empty:
+            return
+        new = new.drop_duplicates(subset=self.key_column).set_index(self.key_column).sort_index()
+        with self._lock:
+            changed = None if self.frame is None else changed_keys(self.frame, new)
+            self.updated_at = datetime.now()
+            self.error = None
+            if changed == []:
+                return
+            self.version += 1
+            self.frame = new
+            self._changes.append((self.version, changed))
+
+    def changes_since(self, version):
+        """
+        返回 (当前版本, 当前快照, 变化的键)
+
+        变化的键为自 version 之后所有变化的并集；为None表示需要整体重建
+        （第一次获取、键的集合发生变化，或 version 太旧、中间的变化记录已丢弃）
+        """
+        with self._lock:
+            frame = None if self.frame is None else self.frame.reset_index()
+            if version == self.version:
+                return self.version, frame, []
+            newer = [changed for v, changed in self._changes if v > version]
+            if version < 0 or len(newer) != self.version - version or any(c is None for c in newer):
+                return self.version, frame, None
+            return self.version, frame, sorted(set().union(*newer))
@@ -0,0 +1,178 @@
+"""
+后台选股任务管理
+
+选股任务在进程内共享的线程池中执行，与Streamlit的脚本重跑解耦：
+提交任务立即返回任务ID，界面凭任务ID轮询进度、获取结果；
+参数完全相同的任务只执行一次，多个会话会拿到同一个任务ID。
+"""
+import hashlib
+import json
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# 任务状态
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+def make_job_key(name, params):
+    """
+    根据任务名称和参数生成去重用的键
+    """
+    payload = json.dumps({"name": name, "params": params}, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class ScreenJob:
+    """
+    单个后台任务的状态，由工作线程写入、界面线程读取
+    """
+
+    def __init__(self, job_id, key, name, params):
+        self.job_id = job_id
+        self.key = key
+        self.name = name
+        self.params = params
+        self.status = JOB_PENDING
+        self.progress = 0.0
+        self.message = "排队中..."
+        self.notes = []
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def report(self, progress=None, message=None):
+        """
+        供任务函数回调，更新进度(0~1)和状态文字
+        """
+        with self._lock:
+            if progress is not None:
+                self.progress = min(max(float(progress), 0.0), 1.0)
+            if message is not None:
+                self.message = message
+
+    def note(self, message):
+        """
+        记录需要在界面上提示给用户的信息
+        """
+        with self._lock:
+            self.notes.append(message)
+
+    @property
+    def finished(self):
+        return self.status in (JOB_DONE, JOB_FAILED)
+
+    def snapshot(self):
+        """
+        返回当前状态的一致性快照
+        """
+        with self._lock:
+            return {
+                "job_id": self.job_id,
+                "status": self.status,
+                "progress": self.progress,
+                "message": self.message,
+                "notes": list(self.notes),
+                "error": self.error,
+            }
+
+
+class JobManager:
+    """
+    共享的后台任务调度器
+
+    - submit: 提交任务，参数相同且未失败/未过期的任务直接复用
+    - get: 按任务ID查询任务
+    """
+
+    def __init__(self, max_workers=2, result_ttl=3600):
+        self.result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="screen-job")
+        self._jobs = {}
+        self._jobs_by_key = {}
+        self._lock = threading.Lock()
+
+    def submit(self, func, params, name=None):
+        """
+        提交任务，返回任务ID
+
+        func 的签名为 func(params, job)，通过 job.report / job.note 汇报进度，
+        返回值作为任务结果。
+        """
+        name = name or getattr(func, "__name__", "job")
+        key = make_job_key(name, params)
+
+        with self._lock:
+            self._purge_expired()
+            existing_id = self._jobs_by_key.get(key)
+            if existing_id is not None:
+                existing = self._jobs[existing_id]
+                if existing.status != JOB_FAILED:
+                    return existing_id
+
+            job = ScreenJob(uuid.uuid4().hex[:12], key, name, params)
+            self._jobs[job.job_id] = job
+            self._jobs_by_key[key] = job.job_id
+
+        self._executor.submit(self._run, job, func)
+        return job.job_id
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def active_jobs(self):
+        """
+        返回仍在排队或执行中的任务
+        """
+        with self._lock:
+            return [job for job in self._jobs.values() if not job.finished]
+
+    def _run(self, job, func):
+        job.status = JOB_RUNNING
+        job.report(0.0, "正在执行...")
+        try:
+            job.result = func(job.params, job)
+            job.report(1.0)
+            status = JOB_DONE
+        except Exception as e:
+            job.error = f"{e}\n{traceback.format_exc()}"
+            job.report(message=f"任务失败: {e}")
+            status = JOB_FAILED
+        # 其他线程看到任务结束时，结果和结束时间必须已经写好，因此最后才更新状态
+        job.finished_at = time.time()
+        job.status = status
+
+    def _purge_expired(self):
+        # 调用方需持有 self._lock
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished and job.finished_at is not None and now - job.finished_at > self.result_ttl
+        ]
+        for job_id in expired:
+            job = self._jobs.pop(job_id)
+            if self._jobs_by_key.get(job.key) == job_id:
+                del self._jobs_by_key[job.key]
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_job_manager():
+    """
+    获取进程内唯一的任务调度器，所有会话共享
+    """
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = JobManager()
+        return _manager
@@ -0,0 +1,1036 @@
+"""
+选股表达式引擎
+
+支持类似 `ROE > 15 and 市盈率 < 30 and 净利润增长率 > 营收增长率` 的组合条件，
+表达式被解析成语法树后编译为对整张基本面表的向量化列运算，不使用eval。
+解析结果按表达式文本缓存。
+
+语法：
+- 比较: > >= < <= == !=，支持连写如 `10 < 市盈率 < 30`
+- 逻辑: and / or / not（也可写作 且 / 或 / 非、&& / || / !）
+- 算术: + - * / 和括号
+- 函数: abs(x)、min(x, y)、max(x, y)；
+  技术面选股还可用 cross_up(a, b)、cross_down(a, b)（当日上穿/下穿）和 prev(x)（前一交易日的值）
+- 列名: 直接书写，含括号等符号的列名用反引号包裹，如 `营收增长率(%)`；
+  列名匹配时忽略 "(%)"、"(动态)" 之类的后缀，并支持 PE/PB 等别名
+"""
+import hashlib
+import io
+import os
+import pickle
+import re
+import threading
+import time
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from indicators import DEFAULT_INDICATORS, registry, stack_frames
+
+
+class ExpressionError(ValueError):
+    """
+    表达式语法错误或无法求值
+    """
+
+
+# 列名别名，键统一为小写
+COLUMN_ALIASES = {
+    "pe": "市盈率",
+    "pb": "市净率",
+    "roe": "ROE",
+    "营收增长": "营收增长率",
+    "净利润增长": "净利润增长率",
+}
+
+# 比较列名时忽略的后缀
+_NAME_SUFFIXES = re.compile(r"[(（](%|％|动态|ttm|TTM)[)）]$")
+
+_KEYWORDS = {
+    "and": "and", "且": "and",
+    "or": "or", "或": "or",
+    "not": "not", "非": "not",
+    "true": "true", "false": "false",
+}
+
+_TOKEN_RE = re.compile(r"""
+    (?P<ws>\s+)
+  | (?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?)
+  | (?P<quoted>`[^`]+`)
+  | (?P<name>[A-Za-z_一-鿿][A-Za-z0-9_一-鿿]*)
+  | (?P<op>>=|<=|==|!=|&&|\|\||[<>=!+\-*/(),])
+""", re.VERBOSE)
+
+
+def tokenize(text):
+    """
+    把表达式拆分为 (类型, 值, 位置) 的列表
+    """
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = _TOKEN_RE.match(text, pos)
+        if match is None:
+            raise ExpressionError(f"无法识别的字符 '{text[pos]}' (位置 {pos + 1})")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "number":
+            tokens.append(("number", float(value), pos))
+        elif kind == "quoted":
+            tokens.append(("name", value[1:-1].strip(), pos))
+        elif kind == "name":
+            keyword = _KEYWORDS.get(value.lower())
+            tokens.append(("keyword", keyword, pos) if keyword else ("name", value, pos))
+        elif kind == "op":
+            op = {"&&": "and", "||": "or", "!": "not", "=": "=="}.get(value, value)
+            tokens.append(("keyword", op, pos) if op in ("and", "or", "not") else ("op", op, pos))
+        pos = match.end()
+    tokens.append(("end", None, pos))
+    return tokens
+
+
+# 语法树节点使用元组表示：
+# ("num", value) ("name", column) ("neg", x) ("not", x)
+# ("bin", op, left, right) ("and", [..]) ("or", [..]) ("call", func, [args])
+
+_COMPARE_OPS = (">", ">=", "<", "<=", "==", "!=")
+
+
+class _Parser:
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.index = 0
+
+    def peek(self):
+        return self.tokens[self.index]
+
+    def take(self):
+        token = self.tokens[self.index]
+        self.index += 1
+        return token
+
+    def accept(self, kind, value=None):
+        token = self.peek()
+        if token[0] == kind and (value is None or token[1] == value):
+            self.index += 1
+            return token
+        return None
+
+    def expect(self, kind, value=None):
+        token = self.accept(kind, value)
+        if token is None:
+            found = self.peek()
+            desc = "表达式结尾" if found[0] == "end" else f"'{found[1]}'"
+            raise ExpressionError(f"位置 {found[2] + 1} 处应为 '{value or kind}'，实际为 {desc}")
+        return token
+
+    def parse(self):
+        if self.peek()[0] == "end":
+            raise ExpressionError("表达式为空")
+        node = self.parse_or()
+        token = self.peek()
+        if token[0] != "end":
+            raise ExpressionError(f"位置 {token[2] + 1} 处存在多余内容 '{token[1]}'")
+        return node
+
+    def parse_or(self):
+        items = [self.parse_and()]
+        while self.accept("keyword", "or"):
+            items.append(self.parse_and())
+        return items[0] if len(items) == 1 else ("or", items)
+
+    def parse_and(self):
+        items = [self.parse_not()]
+        while self.accept("keyword", "and"):
+            items.append(self.parse_not())
+        return items[0] if len(items) == 1 else ("and", items)
+
+    def parse_not(self):
+        if self.accept("keyword", "not"):
+            return ("not", self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        left = self.parse_additive()
+        comparisons = []
+        while self.peek()[0] == "op" and self.peek()[1] in _COMPARE_OPS:
+            op = self.take()[1]
+            right = self.parse_additive()
+            comparisons.append(("bin", op, left, right))
+            left = right
+        if not comparisons:
+            return left
+        return comparisons[0] if len(comparisons) == 1 else ("and", comparisons)
+
+    def parse_additive(self):
+        node = self.parse_term()
+        while self.peek()[0] == "op" and self.peek()[1] in ("+", "-"):
+            op = self.take()[1]
+            node = ("bin", op, node, self.parse_term())
+        return node
+
+    def parse_term(self):
+        node = self.parse_unary()
+        while self.peek()[0] == "op" and self.peek()[1] in ("*", "/"):
+            op = self.take()[1]
+            node = ("bin", op, node, self.parse_unary())
+        return node
+
+    def parse_unary(self):
+        if self.accept("op", "-"):
+            return ("neg", self.parse_unary())
+        if self.accept("op", "+"):
+            return self.parse_unary()
+        return self.parse_primary()
+
+    def parse_primary(self):
+        token = self.take()
+        kind, value, pos = token
+        if kind == "number":
+            return ("num", value)
+        if kind == "keyword" and value in ("true", "false"):
+            return ("num", value == "true")
+        if kind == "name":
+            if self.accept("op", "("):
+                args = []
+                if not self.accept("op", ")"):
+                    args.append(self.parse_or())
+                    while self.accept("op", ","):
+                        args.append(self.parse_or())
+                    self.expect("op", ")")
+                return ("call", value.lower(), args)
+            return ("name", value)
+        if kind == "op" and value == "(":
+            node = self.parse_or()
+            self.expect("op", ")")
+            return node
+        desc = "表达式结尾" if kind == "end" else f"'{value}'"
+        raise ExpressionError(f"位置 {pos + 1} 处不应出现 {desc}")
+
+
+def _normalize_name(name):
+    return _NAME_SUFFIXES.sub("", name.strip()).lower()
+
+
+def resolve_column(name, columns):
+    """
+    把表达式中的列名解析为表中的实际列名
+    """
+    if name in columns:
+        return name
+    target = _normalize_name(name)
+    target = _normalize_name(COLUMN_ALIASES.get(target, target))
+    for col in columns:
+        if _normalize_name(str(col)) == target:
+            return col
+    raise ExpressionError(f"未知的列名 '{name}'，可用列: {', '.join(map(str, columns))}")
+
+
+class FrameEnv:
+    """
+    表达式求值环境：按需取出列并转换为float数组，同一次求值中每列只转换一次
+
+    previous 为前一交易日的同结构表（行顺序一致），供 cross_up、prev 等函数使用
+    """
+
+    def __init__(self, frame, previous=None):
+        self.frame = frame
+        self.columns = list(frame.columns)
+        self._arrays = {}
+        if previous is not None and not isinstance(previous, FrameEnv):
+            previous = FrameEnv(previous)
+        self.previous = previous
+
+    def shifted(self, func_name):
+        """
+        返回前一交易日的求值环境
+        """
+        if self.previous is None:
+            raise ExpressionError(f"函数 '{func_name}' 需要前一交易日的数据，只能用于技术面选股")
+        return self.previous
+
+    def __len__(self):
+        return len(self.frame)
+
+    def column(self, name):
+        col = resolve_column(name, self.columns)
+        if col not in self._arrays:
+            series = self.frame[col]
+            if series.dtype == bool:
+                self._arrays[col] = series.to_numpy()
+            else:
+                self._arrays[col] = pd.to_numeric(series, errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+        return self._arrays[col]
+
+
+def _as_bool(value):
+    if isinstance(value, np.ndarray):
+        if value.dtype == bool:
+            return value
+        # 数值参与逻辑运算时，NaN和0视为False
+        return np.nan_to_num(value, nan=0.0) != 0
+    return bool(value)
+
+
+_BINARY_FUNCS = {
+    "+": np.add, "-": np.subtract, "*": np.multiply, "/": np.divide,
+    ">": np.greater, ">=": np.greater_equal, "<": np.less, "<=": np.less_equal,
+    "==": np.equal, "!=": np.not_equal,
+}
+
+
+def _call_abs(args):
+    return np.abs(args[0])
+
+
+def _call_min(args):
+    return np.fmin.reduce(np.broadcast_arrays(*args)) if len(args) > 1 else args[0]
+
+
+def _call_max(args):
+    return np.fmax.reduce(np.broadcast_arrays(*args)) if len(args) > 1 else args[0]
+
+
+# 表达式中可用的函数：名称 -> (实现, 最少参数, 最多参数)
+FUNCTIONS = {
+    "abs": (_call_abs, 1, 1),
+    "min": (_call_min, 1, None),
+    "max": (_call_max, 1, None),
+}
+
+
+def _call_prev(env, args):
+    return args[0](env.shifted("prev"))
+
+
+def _call_cross_up(env, args):
+    previous = env.shifted("cross_up")
+    a, b = args
+    return np.greater(a(env), b(env)) & np.less_equal(a(previous), b(previous))
+
+
+def _call_cross_down(env, args):
+    previous = env.shifted("cross_down")
+    a, b = args
+    return np.less(a(env), b(env)) & np.greater_equal(a(previous), b(previous))
+
+
+# 需要访问求值环境（前一交易日数据）的函数，实现接收 (env, 编译后的参数)
+ENV_FUNCTIONS = {
+    "prev": (_call_prev, 1, 1),
+    "cross_up": (_call_cross_up, 2, 2),
+    "cross_down": (_call_cross_down, 2, 2),
+}
+
+
+def _compile_node(node):
+    """
+    把语法树节点编译为 env -> ndarray 的闭包
+    """
+    kind = node[0]
+    if kind == "num":
+        value = node[1]
+        return lambda env: value
+    if kind == "name":
+        name = node[1]
+        return lambda env: env.column(name)
+    if kind == "neg":
+        inner = _compile_node(node[1])
+        return lambda env: np.negative(inner(env))
+    if kind == "not":
+        inner = _compile_node(node[1])
+        return lambda env: np.logical_not(_as_bool(inner(env)))
+    if kind in ("and", "or"):
+        parts = [_compile_node(item) for item in node[1]]
+        combine = np.logical_and if kind == "and" else np.logical_or
+
+        def run_logical(env):
+            result = _as_bool(parts[0](env))
+            for part in parts[1:]:
+                result = combine(result, _as_bool(part(env)))
+            return result
+        return run_logical
+    if kind == "bin":
+        func = _BINARY_FUNCS[node[1]]
+        left, right = _compile_node(node[2]), _compile_node(node[3])
+        return lambda env: func(left(env), right(env))
+    if kind == "call":
+        name, arg_nodes = node[1], node[2]
+        if name not in FUNCTIONS and name not in ENV_FUNCTIONS:
+            available = ', '.join(sorted([*FUNCTIONS, *ENV_FUNCTIONS]))
+            raise ExpressionError(f"未知的函数 '{name}'，可用函数: {available}")
+        impl, min_args, max_args = FUNCTIONS.get(name) or ENV_FUNCTIONS[name]
+        if len(arg_nodes) < min_args or (max_args is not None and len(arg_nodes) > max_args):
+            raise ExpressionError(f"函数 '{name}' 的参数个数不正确")
+        args = [_compile_node(arg) for arg in arg_nodes]
+        if name in ENV_FUNCTIONS:
+            return lambda env: impl(env, args)
+        return lambda env: impl([arg(env) for arg in args])
+    raise ExpressionError(f"无法编译的节点 {kind}")
+
+
+def _collect_names(node, names):
+    kind = node[0]
+    if kind == "name":
+        names.append(node[1])
+    elif kind in ("neg", "not"):
+        _collect_names(node[1], names)
+    elif kind in ("and", "or"):
+        for item in node[1]:
+            _collect_names(item, names)
+    elif kind == "bin":
+        _collect_names(node[2], names)
+        _collect_names(node[3], names)
+    elif kind == "call":
+        for arg in node[2]:
+            _collect_names(arg, names)
+    return names
+
+
+class CompiledExpression:
+    """
+    编译后的选股表达式
+    """
+
+    def __init__(self, text, tree):
+        self.text = text
+        self.tree = tree
+        self.names = tuple(dict.fromkeys(_collect_names(tree, [])))
+        self._func = _compile_node(tree)
+
+    def evaluate(self, frame, previous=None):
+        """
+        对整张表求值，返回与行数等长的布尔数组；previous 为前一交易日的同结构表
+        """
+        env = frame if isinstance(frame, FrameEnv) else FrameEnv(frame, previous)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result = self._func(env)
+        if isinstance(result, np.ndarray):
+            if result.dtype != bool:
+                raise ExpressionError("表达式结果不是筛选条件，请使用比较运算符")
+            return result
+        if isinstance(result, (bool, np.bool_)):
+            return np.full(len(env), bool(result))
+        raise ExpressionError("表达式结果不是筛选条件，请使用比较运算符")
+
+    def __repr__(self):
+        return f"CompiledExpression({self.text!r})"
+
+
+@lru_cache(maxsize=256)
+def compile_expression(text):
+    """
+    解析并编译表达式，结果按文本缓存
+    """
+    text = text.strip()
+    return CompiledExpression(text, _Parser(text).parse())
+
+
+def screen_frame(frame, text):
+    """
+    用表达式筛选DataFrame，返回符合条件的行
+    """
+    if frame.empty:
+        return frame
+    mask = compile_expression(text).evaluate(frame)
+    return frame[mask]
+
+
+def _format_number(value):
+    return f"{value:g}"
+
+
+def build_basic_predicates(pe_min, pe_max, pb_min, pb_max, roe_min, growth_min):
+    """
+    把选股页面上的四个基础条件转换为区间条件列表 [(列名, 下限, 上限)]，None表示不限
+    """
+    # 排除负值和异常值；上下限都为0表示不限制该条件
+    pe_low, pe_high = (0.0, 2000.0) if pe_min == pe_max == 0 else (max(pe_min, 0.0), min(pe_max, 2000.0))
+    pb_low, pb_high = (0.0, 100.0) if pb_min == pb_max == 0 else (max(pb_min, 0.0), min(pb_max, 100.0))
+    return [
+        ("市盈率", pe_low, pe_high),
+        ("市净率", pb_low, pb_high),
+        ("ROE(%)", roe_min, None),
+        ("营收增长率(%)", growth_min, None),
+    ]
+
+
+def describe_predicates(predicates):
+    """
+    把区间条件列表转换为便于阅读的文字
+    """
+    parts = []
+    for column, low, high in predicates:
+        if low is not None and high is not None:
+            parts.append(f"{_format_number(low)} <= {column} <= {_format_number(high)}")
+        elif low is not None:
+            parts.append(f"{column} >= {_format_number(low)}")
+        elif high is not None:
+            parts.append(f"{column} <= {_format_number(high)}")
+    return " and ".join(parts)
+
+
+def _index_values(series):
+    """
+    返回 (用于排序的取值, 有效值掩码)：数值列和可转换为数值的文字列按数值排序，日期、其余文字列按其自身的顺序
+    """
+    if pd.api.types.is_numeric_dtype(series) or pd.api.types.is_object_dtype(series):
+        values = pd.to_numeric(series, errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+        valid = ~np.isnan(values)
+        if valid.any() or pd.api.types.is_numeric_dtype(series):
+            return values, valid
+    return series.to_numpy(), series.notna().to_numpy()
+
+
+class ColumnIndex:
+    """
+    股票池的列排序索引，每次股票池刷新时构建一次
+
+    为每个数值列保存按值升序排列的行号和对应的取值，NaN不进入索引：
+    - range: 二分查找得到区间内的行号，O(log n + k)
+    - query: 多个区间条件分别查找后求交集
+    - top_k / sort: 借助预先排好的顺序输出，无需对整表重新排序
+    columns 中显式给出的日期、文字列按其自身的顺序建立索引，可用于 sort 和 range。
+    """
+
+    def __init__(self, frame, columns=None):
+        self.size = len(frame)
+        if columns is None:
+            columns = [col for col in frame.columns if pd.api.types.is_numeric_dtype(frame[col])]
+        self._order = {}
+        self._sorted_values = {}
+        self._rank = {}
+        for col in columns:
+            values, valid = _index_values(frame[col])
+            # NaN排在最后，只保留有效值部分
+            order = np.flatnonzero(valid)
+            order = np.concatenate([order[np.argsort(values[order], kind="stable")], np.flatnonzero(~valid)])
+            valid_count = int(np.count_nonzero(valid))
+            self._order[col] = order
+            self._sorted_values[col] = values[order[:valid_count]]
+            rank = np.empty(self.size, dtype=np.int64)
+            rank[order] = np.arange(self.size)
+            self._rank[col] = rank
+
+    @property
+    def columns(self):
+        return list(self._order)
+
+    def _check(self, column):
+        if column not in self._order:
+            raise KeyError(f"列 '{column}' 没有建立索引")
+
+    def range(self, column, low=None, high=None, include_low=True, include_high=True):
+        """
+        返回 low <= column <= high 的行号（按该列升序），NaN不参与比较
+        """
+        self._check(column)
+        sorted_values = self._sorted_values[column]
+        start = 0 if low is None else np.searchsorted(sorted_values, low, side="left" if include_low else "right")
+        stop = len(sorted_values) if high is None else np.searchsorted(sorted_values, high, side="right" if include_high else "left")
+        return self._order[column][start:max(start, stop)]
+
+    def query(self, predicates):
+        """
+        多个区间条件 [(列名, 下限, 上限)] 求交集，返回按行号升序的行号
+        """
+        if not predicates:
+            return np.arange(self.size)
+        matches = sorted((self.range(col, low, high) for col, low, high in predicates), key=len)
+        result = np.sort(matches[0])
+        for positions in matches[1:]:
+            if len(result) == 0:
+                break
+            result = np.intersect1d(result, positions, assume_unique=True)
+        return result
+
+    def sort(self, column, ascending=True, positions=None):
+        """
+        按列排序返回行号，NaN始终排在最后；positions 给定时只输出其中的行
+        """
+        self._check(column)
+        order = self._order[column]
+        valid_count = len(self._sorted_values[column])
+        if ascending:
+            ordered = order
+        else:
+            ordered = np.concatenate([order[:valid_count][::-1], order[valid_count:]])
+        if positions is None:
+            return ordered
+        # 用布尔掩码从全局顺序中挑出子集，O(n)且无需排序
+        selected = np.zeros(self.size, dtype=bool)
+        selected[positions] = True
+        return ordered[selected[ordered]]
+
+    def top_k(self, column, k, ascending=False, positions=None):
+        """
+        返回按列排名前k的行号，只对候选的前k名排序
+        """
+        self._check(column)
+        order = self._order[column]
+        valid_count = len(self._sorted_values[column])
+        if positions is None:
+            head = order[:valid_count]
+            return head[:k] if ascending else head[::-1][:k]
+        positions = np.asarray(positions)
+        rank = self._rank[column][positions]
+        # NaN行排名靠后，只取有效值
+        valid = rank < valid_count
+        positions, rank = positions[valid], rank[valid]
+        if not ascending:
+            rank = -rank
+        if k < len(positions):
+            part = np.argpartition(rank, k)[:k]
+            positions, rank = positions[part], rank[part]
+        return positions[np.argsort(rank, kind="stable")]
+
+
+def evaluate_rule(frame, predicates=(), expression=None):
+    """
+    对表中每一行计算是否满足区间条件和自定义表达式，返回布尔数组
+    """
+    mask = np.ones(len(frame), dtype=bool)
+    with np.errstate(invalid="ignore"):
+        for column, low, high in predicates:
+            values = pd.to_numeric(frame[column], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+            if low is not None:
+                mask &= values >= low
+            if high is not None:
+                mask &= values <= high
+    if expression:
+        mask &= compile_expression(expression).evaluate(frame)
+    return mask
+
+
+class ScreenDiff:
+    """
+    两次筛选结果的差异
+    """
+
+    def __init__(self, entered, exited, rank_changed, evaluated_count, total_count, initial=False):
+        self.entered = entered            # 新进入结果的代码列表
+        self.exited = exited              # 移出结果的代码列表
+        self.rank_changed = rank_changed  # DataFrame: 代码, 原排名, 新排名
+        self.evaluated_count = evaluated_count
+        self.total_count = total_count
+        self.initial = initial
+        self.created_at = time.time()
+
+    @property
+    def unchanged(self):
+        return not self.entered and not self.exited and self.rank_changed.empty
+
+
+class IncrementalScreener:
+    """
+    增量选股：记住每只股票上次的指标快照和筛选结论，刷新时只对指标有变化的股票重新求值，
+    并给出与上次结果相比新进入、移出和排名变化的股票
+
+    同一条件的选股器在所有会话之间共享，refresh 和保存状态时需持有 lock
+    """
+
+    def __init__(self, rule, sort_column, ascending=False, key_column="代码"):
+        self.rule = rule
+        self.sort_column = sort_column
+        self.ascending = ascending
+        self.key_column = key_column
+        self.version = None
+        self.snapshot = None
+        self.passed = pd.Series(dtype=bool)
+        self.ranks = pd.Series(dtype="int64")
+        self.last_diff = None
+        self.lock = threading.RLock()
+
+    def __getstate__(self):
+        # 锁不能序列化，保存状态时去掉
+        state = self.__dict__.copy()
+        state.pop("lock", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def refresh(self, universe, rule_func, version=None):
+        """
+        用新的股票池刷新结果；version 与上次相同时直接返回上次的差异
+
+        rule_func(frame) 返回布尔数组，只会对新增或指标变化的股票调用
+        """
+        with self.lock:
+            return self._refresh(universe, rule_func, version)
+
+    def _refresh(self, universe, rule_func, version):
+        if version is not None and version == self.version and self.last_diff is not None:
+            return self.last_diff
+
+        frame = universe.set_index(self.key_column)
+        frame = frame[~frame.index.duplicated(keep="last")]
+
+        if self.snapshot is None:
+            changed = frame.index
+        else:
+            common = frame.index.intersection(self.snapshot.index)
+            columns = [col for col in frame.columns if col in self.snapshot.columns]
+            old = self.snapshot.loc[common, columns]
+            new = frame.loc[common, columns]
+            same = ((old == new) | (old.isna() & new.isna())).all(axis=1)
+            changed = frame.index.difference(self.snapshot.index).append(common[~same.to_numpy()])
+
+        passed = self.passed.reindex(frame.index, fill_value=False).astype(bool)
+        if len(changed) > 0:
+            passed.loc[changed] = np.asarray(rule_func(frame.loc[changed].reset_index()), dtype=bool)
+
+        # 排名只在命中的股票之间计算，NaN排在最后
+        hits = frame.loc[passed.to_numpy(), [self.sort_column]]
+        ordered = hits.sort_values(self.sort_column, ascending=self.ascending, na_position="last", kind="stable")
+        ranks = pd.Series(np.arange(1, len(ordered) + 1), index=ordered.index)
+
+        before = set(self.ranks.index)
+        after = set(ranks.index)
+        common_hits = ranks.index.intersection(self.ranks.index)
+        moved = common_hits[(ranks.loc[common_hits] != self.ranks.loc[common_hits]).to_numpy()]
+        rank_changed = pd.DataFrame({
+            self.key_column: moved,
+            "原排名": self.ranks.loc[moved].to_numpy(),
+            "新排名": ranks.loc[moved].to_numpy(),
+        })
+
+        diff = ScreenDiff(
+            entered=[code for code in ranks.index if code not in before],
+            exited=[code for code in self.ranks.index if code not in after],
+            rank_changed=rank_changed,
+            evaluated_count=len(changed),
+            total_count=len(frame),
+            initial=self.snapshot is None,
+        )
+
+        self.snapshot = frame
+        self.passed = passed
+        self.ranks = ranks
+        self.version = version
+        self.last_diff = diff
+        return diff
+
+
+_screeners = {}
+_screeners_lock = threading.Lock()
+SCREENER_STATE_DIR = "data_cache/screener_state"
+
+
+def get_incremental_screener(rule, sort_column, ascending=False):
+    """
+    按筛选条件和排序方式获取增量选股器，进程内共享并持久化到磁盘
+    """
+    key = hashlib.sha1(f"{rule}|{sort_column}|{ascending}".encode("utf-8")).hexdigest()
+    with _screeners_lock:
+        screener = _screeners.get(key)
+        if screener is None:
+            state_file = os.path.join(SCREENER_STATE_DIR, f"{key}.pkl")
+            if os.path.exists(state_file):
+                try:
+                    with open(state_file, "rb") as f:
+                        screener = pickle.load(f)
+                except Exception:
+                    screener = None
+            if screener is None:
+                screener = IncrementalScreener(rule, sort_column, ascending)
+            _screeners[key] = screener
+        return screener, key
+
+
+def save_incremental_screener(screener, key):
+    """
+    把增量选股器的状态写入磁盘，重启后可继续与上次结果比较
+    """
+    os.makedirs(SCREENER_STATE_DIR, exist_ok=True)
+    state_file = os.path.join(SCREENER_STATE_DIR, f"{key}.pkl")
+    # 临时文件按线程区分，写入时持有选股器的锁，避免与其他会话的刷新交错
+    tmp_file = f"{state_file}.{threading.get_ident()}.tmp"
+    with screener.lock:
+        with open(tmp_file, "wb") as f:
+            pickle.dump(screener, f)
+        os.replace(tmp_file, state_file)
+
+
+# Parquet导出依赖pyarrow，未安装时只提供CSV
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PARQUET_AVAILABLE = True
+except ImportError:
+    pa = pq = None
+    PARQUET_AVAILABLE = False
+
+EXPORT_DIR = "data_cache/exports"
+
+
+def iter_export_chunks(frame, chunk_size=20000, history_file=None, key_column="代码"):
+    """
+    按块产出待导出的数据；给定 history_file 时附带命中股票的全部指标历史，
+    历史文件同样分块读取，不会一次性载入内存
+    """
+    if history_file is None:
+        for start in range(0, len(frame), chunk_size):
+            yield frame.iloc[start:start + chunk_size]
+        return
+
+    # 带历史时统一为长表：最新值的记录时间标记为"当前"
+    for start in range(0, len(frame), chunk_size):
+        chunk = frame.iloc[start:start + chunk_size]
+        yield chunk.assign(记录时间="当前")[["记录时间"] + list(frame.columns)]
+
+    if not os.path.exists(history_file):
+        return
+    codes = set(frame[key_column].astype(str))
+    for chunk in pd.read_csv(history_file, chunksize=chunk_size, dtype={key_column: str}):
+        chunk = chunk[chunk[key_column].isin(codes)]
+        if not chunk.empty:
+            yield chunk.reindex(columns=["记录时间"] + list(frame.columns))
+
+
+def write_export_file(chunks, fmt="csv"):
+    """
+    把分块数据依次写入导出文件，返回文件路径
+    """
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    cleanup_exports()
+    path = os.path.join(EXPORT_DIR, f"export_{time.time_ns()}.{fmt}")
+
+    if fmt == "csv":
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            header = True
+            for chunk in chunks:
+                chunk.to_csv(f, header=header, index=False)
+                header = False
+        return path
+
+    if fmt == "parquet":
+        if not PARQUET_AVAILABLE:
+            raise RuntimeError("导出Parquet需要安装pyarrow")
+        writer = None
+        try:
+            for chunk in chunks:
+                # 每块写成一个row group，后续块按首块的schema对齐
+                table = pa.Table.from_pandas(chunk, schema=writer.schema if writer else None, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+        return path
+
+    raise ValueError(f"不支持的导出格式: {fmt}")
+
+
+def cleanup_exports(max_age=3600):
+    """
+    删除超过max_age秒的导出文件
+    """
+    if not os.path.isdir(EXPORT_DIR):
+        return
+    now = time.time()
+    for name in os.listdir(EXPORT_DIR):
+        path = os.path.join(EXPORT_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def start_export_cleaner(interval=600, max_age=3600):
+    """
+    启动后台线程，每隔interval秒清理一次过期的导出文件；即使之后没有人再导出，旧文件也会被删除
+    """
+    def run():
+        while True:
+            cleanup_exports(max_age)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="export-cleaner", daemon=True)
+    thread.start()
+    return thread
+
+
+class ExportFile(io.FileIO):
+    """
+    导出文件的只读句柄，整个读出后自动关闭
+
+    Streamlit的下载按钮读取传入的文件后不会关闭它，交给它这个句柄不会遗留打开的文件
+    """
+
+    def __init__(self, path):
+        super().__init__(path, "rb")
+
+    def read(self, size=-1):
+        if size is not None and size >= 0:
+            return super().read(size)
+        return self.readall()
+
+    def readall(self):
+        try:
+            return super().readall()
+        finally:
+            self.close()
+
+
+# 技术面选股使用的最近交易日数，足以让MACD等指标收敛
+TECHNICAL_HISTORY_LENGTH = 250
+
+# 技术面截面表中K线本身的列
+TECHNICAL_BAR_COLUMNS = ("开盘", "收盘", "最高", "最低", "成交量", "涨跌幅", "换手率")
+
+TECHNICAL_DIR = "data_cache/technical"
+
+
+class TechnicalSnapshot:
+    """
+    某个交易日全市场的技术指标截面
+
+    current / previous 分别为当日和前一交易日的表，行顺序一致，
+    只包含最后一个交易日为 day 的股票（停牌的股票不参与当日的信号判断）。
+    同一截面上相同的表达式只求值一次。
+    """
+
+    def __init__(self, day, version, current, previous):
+        self.day = day
+        self.version = version
+        self.current = current
+        self.previous = previous
+        self._positions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.current)
+
+    def screen(self, text):
+        """
+        返回符合条件的行号
+        """
+        text = text.strip()
+        with self._lock:
+            positions = self._positions.get(text)
+        if positions is None:
+            mask = compile_expression(text).evaluate(self.current, previous=self.previous)
+            positions = np.flatnonzero(mask)
+            with self._lock:
+                self._positions[text] = positions
+        return positions
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+def build_technical_snapshot(frames, version, length=TECHNICAL_HISTORY_LENGTH, names=DEFAULT_INDICATORS):
+    """
+    由多只股票的日K线批量计算指标，得到最近交易日的技术面截面
+
+    frames: {代码: DataFrame}，DataFrame 需含 日期/收盘/最高/最低 列，按日期升序
+    """
+    frames = {code: df for code, df in frames.items() if len(df) > 0}
+    bar_columns = [col for col in TECHNICAL_BAR_COLUMNS if all(col in df.columns for df in frames.values())]
+    codes, arrays, lengths = stack_frames(frames, bar_columns, length)
+    last_dates = [pd.Timestamp(frames[code]["日期"].iloc[-1]).strftime("%Y-%m-%d") for code in codes]
+    previous_dates = [
+        pd.Timestamp(frames[code]["日期"].iloc[-2]).strftime("%Y-%m-%d") if lengths[row] > 1 else None
+        for row, code in enumerate(codes)
+    ]
+    return build_technical_snapshot_from_arrays(codes, arrays, lengths, last_dates, previous_dates, version, names)
+
+
+def build_technical_snapshot_from_arrays(codes, arrays, lengths, last_dates, previous_dates, version,
+                                         names=DEFAULT_INDICATORS, compute=None):
+    """
+    由已经右对齐堆叠的K线数组得到最近交易日的技术面截面
+
+    last_dates / previous_dates: 每只股票最后一个和前一个交易日，没有数据的股票为None
+    compute: 替换指标计算的函数 compute(arrays, names)，如 compute_pool.compute_indicators_parallel
+    """
+    rows = [row for row in range(len(codes)) if lengths[row] > 0 and last_dates[row]]
+    if not rows:
+        empty = pd.DataFrame(columns=["代码", "日期"])
+        return TechnicalSnapshot(None, version, empty, empty)
+
+    day = max(last_dates[row] for row in rows)
+    rows = [row for row in rows if last_dates[row] == day]
+    codes = [codes[row] for row in rows]
+    previous_dates = [previous_dates[row] for row in rows]
+    if len(rows) < len(lengths):
+        arrays = {col: value[rows] for col, value in arrays.items()}
+
+    bar_columns = [col for col in TECHNICAL_BAR_COLUMNS if col in arrays]
+    values = (compute or registry.compute)(arrays, names)
+    columns = {**{col: arrays[col] for col in bar_columns}, **values}
+
+    tables = []
+    for offset, dates in ((1, [day] * len(codes)), (2, previous_dates)):
+        table = {"代码": codes, "日期": dates}
+        for name, value in columns.items():
+            table[name] = value[:, -offset] if value.shape[1] >= offset else np.full(len(codes), np.nan)
+        tables.append(pd.DataFrame(table))
+    return TechnicalSnapshot(day, version, tables[0], tables[1])
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def _snapshot_file(version):
+    key = hashlib.sha1(str(version).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(TECHNICAL_DIR, f"snapshot_{key}.pkl")
+
+
+def load_technical_snapshot(version):
+    """
+    取出与数据版本对应的技术面截面（进程内共享，并持久化到磁盘），不存在时返回None
+    """
+    with _snapshots_lock:
+        snapshot = _snapshots.get(version)
+    if snapshot is not None:
+        return snapshot
+    path = _snapshot_file(version)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            snapshot = pickle.load(f)
+    except Exception:
+        return None
+    with _snapshots_lock:
+        _snapshots[version] = snapshot
+    return snapshot
+
+
+def save_technical_snapshot(snapshot):
+    """
+    保存技术面截面，磁盘上只保留最近的几个版本
+    """
+    with _snapshots_lock:
+        for version in [v for v, s in _snapshots.items() if s.day == snapshot.day and v != snapshot.version]:
+            del _snapshots[version]
+        _snapshots[snapshot.version] = snapshot
+    os.makedirs(TECHNICAL_DIR, exist_ok=True)
+    path = _snapshot_file(snapshot.version)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(snapshot, f)
+    os.replace(tmp_path, path)
+    files = sorted(
+        (os.path.join(TECHNICAL_DIR, name) for name in os.listdir(TECHNICAL_DIR) if name.endswith(".pkl")),
+        key=os.path.getmtime
+    )
+    for old in files[:-3]:
+        try:
+            os.remove(old)
+        except OSError:
+            pass